@@ -0,0 +1,81 @@
+"""
+Compare the old chunk assembly of audio_creator (temp file per chunk, += and an mp3 export after every chunk) with
+decode_mp3 + assemble, on synthetic TTS chunks.
+
+    python -m benchmarks.bench_audio_assembly --chunks 5 10 20 40
+"""
+import argparse
+import os
+import time
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+
+from pydub import AudioSegment
+from pydub.generators import Sine
+
+from quiz.audio_creator import decode_mp3, assemble, ffmpeg_exe
+
+
+def make_chunk(nr, duration):
+    buffer = BytesIO()
+    Sine(200 + nr * 10, sample_rate=24000).to_audio_segment(duration=duration).set_channels(1).export(
+        buffer, format="mp3")
+    return buffer.getvalue()
+
+
+def legacy_decode(audio_data):
+    # generate_audio_chunk wrote the response to a temp file to decode it. Without ffprobe on the PATH pydub can only
+    # decode wav, so decode the temp file with ffmpeg like decode_mp3 does.
+    with NamedTemporaryFile(suffix=".mp3", delete=False) as temp_file:
+        temp_file_path = temp_file.name
+        temp_file.write(audio_data)
+    with open(temp_file_path, "rb") as f:
+        chunk_audio = decode_mp3(f.read())
+    os.remove(temp_file_path)
+    return chunk_audio
+
+
+def legacy_assembly(chunks):
+    concatenated_audio = AudioSegment.empty()
+    for audio_data in chunks:
+        concatenated_audio += legacy_decode(audio_data)
+        concatenated_audio += AudioSegment.silent(duration=500)
+
+        # Export concatenated audio to a file
+        with NamedTemporaryFile(suffix=".mp3", delete=True) as temp_file:
+            concatenated_audio.export(temp_file.name, format="mp3")
+            with open(temp_file.name, "rb") as f:
+                f.read()
+    return concatenated_audio
+
+
+def new_assembly(chunks):
+    return assemble([decode_mp3(audio_data) for audio_data in chunks], gap=500)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the audio assembly.')
+    parser.add_argument('--chunks', type=int, nargs='+', default=[5, 10, 20, 40], help='Numbers of chunks.')
+    parser.add_argument('--duration', type=int, default=6000, help='Milliseconds per chunk.')
+    args = parser.parse_args()
+
+    print(f"ffmpeg: {ffmpeg_exe()}, {args.duration} ms per chunk")
+    print(f"{'chunks':>6}{'legacy':>10}{'per chunk':>11}{'new':>10}{'per chunk':>11}")
+    for nbr_chunks in args.chunks:
+        chunks = [make_chunk(nr, args.duration) for nr in range(nbr_chunks)]
+
+        start = time.perf_counter()
+        legacy = legacy_assembly(chunks)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        new = new_assembly(chunks)
+        new_time = time.perf_counter() - start
+
+        assert abs(len(legacy) - len(new)) < 10
+        print(f"{nbr_chunks:>6}{legacy_time:>9.2f}s{legacy_time / nbr_chunks * 1000:>9.0f}ms"
+              f"{new_time:>9.2f}s{new_time / nbr_chunks * 1000:>9.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
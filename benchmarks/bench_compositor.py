@@ -0,0 +1,57 @@
+"""
+Compare the per frame cost of add_logo_on_top/add_boarder with FrameCompositor, for the mobile 1080x1920 video.
+
+    python -m benchmarks.bench_compositor --frames 20
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from quiz.street_view_collector import add_logo_on_top, add_boarder, FrameCompositor
+
+
+def make_frame(seed, size=(390, 610)):
+    pixels = np.random.default_rng(seed).integers(0, 256, (size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+    return Image.fromarray(pixels).resize(size, Image.BILINEAR)
+
+
+def per_frame(function, frames):
+    start = time.perf_counter()
+    results = [function(frame.copy()) for frame in frames]
+    return (time.perf_counter() - start) / len(frames), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the frame compositing.')
+    parser.add_argument('--frames', type=int, default=20, help='Number of frames.')
+    parser.add_argument('--width', type=int, default=1080, help='Width of the video.')
+    parser.add_argument('--height', type=int, default=1920, help='Height of the video.')
+    parser.add_argument('--logo', type=str, default='./static/logo.png', help='Path to the logo.')
+    args = parser.parse_args()
+
+    frames = [make_frame(seed) for seed in range(args.frames)]
+    # add_logo_on_top needs a logo with an alpha channel
+    logo_path = os.path.join(tempfile.mkdtemp(), "logo.png")
+    Image.open(args.logo).convert("RGBA").save(logo_path)
+    compositor = FrameCompositor(logo_path)
+
+    logo_before, _ = per_frame(lambda frame: add_logo_on_top(frame, logo_path), frames)
+    logo_after, _ = per_frame(compositor.add_logo, frames)
+    border_before, expected = per_frame(lambda frame: add_boarder(frame, args.width, args.height), frames)
+    border_after, actual = per_frame(lambda frame: compositor.add_border(frame, args.width, args.height), frames)
+
+    diff = np.abs(np.stack([np.asarray(image, dtype=np.int16) for image in expected]) -
+                  np.stack([np.asarray(image, dtype=np.int16) for image in actual]))
+
+    print(f"{args.frames} frames, 390x610 -> {args.width}x{args.height}")
+    print(f"logo:   {logo_before * 1000:7.1f} ms -> {logo_after * 1000:7.1f} ms per frame")
+    print(f"border: {border_before * 1000:7.1f} ms -> {border_after * 1000:7.1f} ms per frame")
+    print(f"border difference: mean {diff.mean():.2f}, max {diff.max()} (out of 255)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Measure what a fetch stride saves and costs: the Street View requests and fetch time of a path with every point
+fetched against every k-th point, against a local stub with a fixed latency, and the CPU time per synthesized frame of
+each tween.
+
+    python -m benchmarks.bench_fetch_stride --points 300 --strides 1 2 3 4
+"""
+import argparse
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from quiz.street_view_collector import StreetViewFetcher, fetch_street_view_images, fetch_size
+from quiz.video_creator import synthesize_frames, TWEENS
+from tests.stub_server import StubServer
+
+
+def noisy_jpeg(seed, size=(630, 400)):
+    pixels = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the fetch stride.')
+    parser.add_argument('--points', type=int, default=300, help='Number of points in the path.')
+    parser.add_argument('--strides', type=int, nargs='+', default=[1, 2, 3, 4], help='Fetch strides.')
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds per Street View request.')
+    parser.add_argument('--runs', type=int, default=20, help='Repeats of the tween timing.')
+    args = parser.parse_args()
+
+    images = [noisy_jpeg(seed) for seed in range(16)]
+
+    def handler(method, path, query, body):
+        time.sleep(args.latency)
+        lat = float(query["location"].split(",")[0])
+        return 200, "image/jpeg", images[int(round(lat * 1e4)) % len(images)]
+
+    path_coordinates = [(47.0 + i * 1e-4, 8.5) for i in range(args.points)]
+    print(f"{args.points} points, {args.latency * 1000:.0f} ms per request")
+    print(f"{'stride':>6}{'requests':>10}{'fetch':>9}")
+    with StubServer(handler) as server:
+        for stride in args.strides:
+            server.requests.clear()
+            fetcher = StreetViewFetcher(base_url=server.url)
+            with tempfile.TemporaryDirectory() as data_dir:
+                start = time.perf_counter()
+                fetch_street_view_images(path_coordinates, data_dir, "desktop", api_key="bench", fetcher=fetcher,
+                                         stride=stride)
+                fetch_time = time.perf_counter() - start
+            fetcher.close()
+            print(f"{stride:>6}{len(server.requests):>10}{fetch_time:>8.2f}s")
+
+    print(f"\n{'tween':<10}{'size':>10}{'per synthesized frame':>23}")
+    for size in (fetch_size(["desktop"]), fetch_size(["mobile", "desktop"]), "1080x1920"):
+        width, height = (int(value) for value in size.split("x"))
+        rng = np.random.default_rng(0)
+        frame_a = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        frame_b = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        for tween in TWEENS:
+            for count in (1, 3):
+                synthesize_frames(frame_a, frame_b, count, tween)
+                start = time.perf_counter()
+                for _ in range(args.runs):
+                    synthesize_frames(frame_a, frame_b, count, tween)
+                per_frame = (time.perf_counter() - start) / (args.runs * count)
+                print(f"{tween:<10}{size:>10}{per_frame * 1000:>18.2f} ms (k={count + 1})")
+
+
+if __name__ == "__main__":
+    main()
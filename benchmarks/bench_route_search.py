@@ -0,0 +1,78 @@
+"""
+Compare the serial route search of create_new_quiz (geocode and one directions request per attempt) with
+RouteFinder, against a local stub of Nominatim and the Directions API with a fixed latency.
+
+    python -m benchmarks.bench_route_search --latency 0.15 --usable 0.1
+"""
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+import polyline
+import requests
+
+from quiz.street_view_collector import RouteFinder, start_points, path_from_polyline
+from tests.stub_server import StubServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the route search.')
+    parser.add_argument('--latency', type=float, default=0.15, help='Seconds per request.')
+    parser.add_argument('--usable', type=float, default=0.1, help='Share of start locations with a usable route.')
+    parser.add_argument('--points', type=int, default=300, help='Number of points in the path.')
+    parser.add_argument('--runs', type=int, default=5, help='Number of searches.')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    route = polyline.encode([(47.4 + i * 1e-4, 8.5) for i in range(args.points + 50)])
+
+    def handler(method, path, query, body):
+        time.sleep(args.latency)
+        if path == "/search":
+            return 200, "application/json", json.dumps([{"lat": "47.37", "lon": "8.54"}]).encode()
+        if rng.random() < args.usable:
+            return 200, "application/json", json.dumps(
+                {"status": "OK", "routes": [{"overview_polyline": {"points": route}}]}).encode()
+        return 200, "application/json", json.dumps({"status": "ZERO_RESULTS", "routes": []}).encode()
+
+    with StubServer(handler) as server:
+        def geocode():
+            result = requests.get(server.url + "/search", params={"q": "Zurich", "format": "json"}).json()
+            return float(result[0]["lat"]), float(result[0]["lon"])
+
+        serial_times, serial_requests = [], []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            made = 0
+            for attempt in range(360):
+                destination_coord = geocode()
+                start_coord = start_points(destination_coord, [np.random.uniform(0, 360)], [8])[0]
+                directions = requests.get(server.url + "/directions", params={
+                    'origin': f'{start_coord[0]},{start_coord[1]}',
+                    'destination': f'{destination_coord[0]},{destination_coord[1]}'}).json()
+                made += 2
+                if directions["status"] == "OK" and path_from_polyline(
+                        polyline.decode(directions['routes'][0]['overview_polyline']['points']), args.points):
+                    break
+            serial_times.append(time.perf_counter() - start)
+            serial_requests.append(made)
+
+        finder_times, finder_requests = [], []
+        for _ in range(args.runs):
+            finder = RouteFinder(base_url=server.url + "/directions", api_key="bench")
+            start = time.perf_counter()
+            path_coordinates = finder.find("Zurich", args.points, destination_coord=geocode())
+            finder_times.append(time.perf_counter() - start)
+            finder_requests.append(finder.requests_made + 1)
+            finder.close()
+            assert len(path_coordinates) in (0, args.points)
+
+    print(f"{args.runs} searches, {args.latency * 1000:.0f} ms per request, {args.usable:.0%} usable start locations")
+    print(f"serial:      {np.mean(serial_times):6.2f}s, {np.mean(serial_requests):5.1f} requests per search")
+    print(f"RouteFinder: {np.mean(finder_times):6.2f}s, {np.mean(finder_requests):5.1f} requests per search")
+
+
+if __name__ == "__main__":
+    main()
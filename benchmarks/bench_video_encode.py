@@ -0,0 +1,59 @@
+"""
+Compare the single pass create_new_video with the two pass create_new_video_two_pass on synthetic frames.
+
+    python -m benchmarks.bench_video_encode --images 150 --audio 50
+"""
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+import imageio_ffmpeg
+import numpy as np
+from PIL import Image
+
+from quiz import video_creator
+
+
+def make_data_dir(data_dir, nbr_images, audio_duration, size=(630, 370)):
+    frames_folder = os.path.join(data_dir, "frames")
+    os.makedirs(frames_folder)
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 256, (size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+    for i in range(nbr_images):
+        # A smooth image that moves a little every frame, closer to street view than pure noise
+        image = Image.fromarray(np.roll(base, i, axis=1)).resize(size, Image.BILINEAR)
+        image.save(os.path.join(frames_folder, f"{i}.jpg"))
+    subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error", "-f", "lavfi",
+                    "-i", f"sine=frequency=440:duration={audio_duration}", os.path.join(data_dir, "quiz.mp3")],
+                   check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the video encoders.')
+    parser.add_argument('--images', type=int, default=150, help='Number of street view images.')
+    parser.add_argument('--audio', type=float, default=50, help='Duration of the quiz audio in seconds.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        make_data_dir(data_dir, args.images, args.audio)
+
+        start = time.perf_counter()
+        video_creator.create_new_video_two_pass(data_dir, add_music=False)
+        two_pass = time.perf_counter() - start
+        two_pass_duration = video_creator.read_video_manifest(os.path.join(data_dir, "quiz.mp4"))["duration"]
+
+        start = time.perf_counter()
+        video_creator.create_new_video(data_dir, add_music=False)
+        single_pass = time.perf_counter() - start
+        single_pass_duration = video_creator.read_video_manifest(os.path.join(data_dir, "quiz.mp4"))["duration"]
+
+    print(f"{args.images} images, {args.audio:.0f} s audio")
+    print(f"two pass:    {two_pass:6.2f} s  ({two_pass_duration:.2f} s of video)")
+    print(f"single pass: {single_pass:6.2f} s  ({single_pass_duration:.2f} s of video)")
+    print(f"speedup:     {two_pass / single_pass:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import argparse
+from quiz import quiz_creator
+from quiz.geocode_index import GeocodeIndex, GEOCODE_SEED_PATH, write_index, normalize_city
+
+'''
+Geocode every city in static/cities.txt and write the coordinates to static/geocodes.json, which the geocode index
+is seeded with. Cities that are already in the index are not geocoded again. Run it after changing cities.txt.
+'''
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the coordinates of the cities.')
+    parser.add_argument('--out', type=str, default=GEOCODE_SEED_PATH, help='Where to write the seed file.')
+    parser.add_argument('--cities', type=str, default="./static/cities.txt", help='The cities text file.')
+
+    args = parser.parse_args()
+
+    index = GeocodeIndex(seed_path=args.out)
+    cities = quiz_creator.load_cities(args.cities)
+    seed = {}
+    for nr, city in enumerate(cities):
+        try:
+            seed[normalize_city(city)] = list(index.lookup(city))
+        except (ValueError, ConnectionError) as e:
+            print(f"Failed to geocode {city}: {e}")
+            continue
+        print(f"{nr + 1}/{len(cities)} {city}: {seed[normalize_city(city)]}")
+
+    write_index(args.out, seed)
+    print(f"Wrote {len(seed)} of {len(cities)} cities to {args.out} ({index.misses} geocoded, {index.hits} known)")
+
+if __name__ == "__main__":
+    main()
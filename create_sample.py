@@ -1,20 +1,27 @@
 import argparse
 import os
-from quiz import quiz_creator, street_view_collector, video_creator
+from quiz import pipeline, video_creator
 
 '''
-Create a mobile version sample. Used to create a sample quiz and video for the mobile version of the quiz.
+Create a sample quiz with a video for each variant, by default the mobile and the desktop version. The frames are
+fetched and the audio is created once for all the variants.
 '''
 def main():
     parser = argparse.ArgumentParser(description='Create a new quiz.')
     parser.add_argument('out', type=str, help='The folder to use for the quiz.')
     parser.add_argument('city', type=str, help='What destination to use for the quiz.')
+    parser.add_argument('--variants', type=str, nargs='+', default=["mobile", "desktop"],
+                        choices=list(video_creator.VARIANTS), help='What videos to create.')
+    parser.add_argument('--fetch-stride', type=int, default=1,
+                        help='Fetch every n-th Street View image and synthesize the frames in between.')
+    parser.add_argument('--tween', type=str, default="dissolve", choices=video_creator.TWEENS,
+                        help='How to synthesize the frames in between.')
 
     args = parser.parse_args()
 
-    quiz_creator.create_new_quiz(args.out, args.city, True)
-    street_view_collector.create_new_frames(args.out, "mobile", 1080, 1920)
-    video_creator.create_new_video(args.out, args.out)
+    stages = pipeline.QuizStages(args.out, args.out, add_outro=True, variants=args.variants,
+                                 fetch_stride=args.fetch_stride, tween=args.tween)
+    pipeline.build_quiz(stages, args.city)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import threading
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from quiz.disk_cache import default_cache_dir
+
+
+class JobConflict(Exception):
+    """
+    Raised when a job is submitted for a data directory that another job is still working on.
+    """
+
+    def __init__(self, job_id):
+        super().__init__(f"Job {job_id} is already running on this data directory")
+        self.job_id = job_id
+
+
+class JobRunner():
+    """
+    Runs the long generation tasks on a local thread pool, so that the request that starts them returns right away.
+
+    Job records are stored as json files in jobs_dir, so every worker process can report the status of a job. An flock
+    on a lock file per data directory makes sure only one job works on a data directory at a time. The kernel drops
+    the flock when the process holding it exits, so a crashed or restarted worker never leaves a stale lock behind.
+    """
+
+    def __init__(self, jobs_dir=None, workers=1, progress_interval=1.0):
+        self.jobs_dir = jobs_dir if jobs_dir is not None else default_cache_dir("jobs")
+        self.progress_interval = progress_interval
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    def _record_path(self, job_id):
+        return os.path.join(self.jobs_dir, job_id + ".json")
+
+    def _lock_path(self, data_dir):
+        key = hashlib.sha256(os.path.abspath(data_dir).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.jobs_dir, key + ".lock")
+
+    def _save(self, record):
+        path = self._record_path(record["id"])
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def _acquire(self, lock_path, job_id):
+        """
+        Take the lock of a data directory
+        :param lock_path: path to the lock file
+        :param job_id: id of the job taking the lock, written to the lock file for the JobConflict of others
+        :return: the open lock file, pass it to _release
+        """
+        lock_file = open(lock_path, "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            try:
+                lock_file.seek(0)
+                owner = json.load(lock_file)
+            except ValueError:
+                # Still being written
+                owner = {"job_id": "unknown"}
+            lock_file.close()
+            raise JobConflict(owner.get("job_id"))
+        lock_file.truncate(0)
+        json.dump({"job_id": job_id, "pid": os.getpid()}, lock_file)
+        lock_file.flush()
+        return lock_file
+
+    def _release(self, lock_file):
+        lock_file.truncate(0)
+        lock_file.close()
+
+    @contextmanager
+    def lock(self, data_dir, owner):
+        """
+        Hold the lock of a data directory for work done outside of a job, e.g. clearing it
+        :param data_dir: data directory
+        :param owner: name of the work, reported to the jobs that conflict with it
+        :raises JobConflict: if a job works on the data directory
+        """
+        lock_file = self._acquire(self._lock_path(data_dir), owner)
+        try:
+            yield
+        finally:
+            self._release(lock_file)
+
+    def submit(self, kind, data_dir, func, *args, **kwargs):
+        """
+        Queue a job. func is called with the extra keyword argument progress, a callback taking
+        (stage, done=None, total=None).
+        :param kind: name of the job, e.g. "new_video"
+        :param data_dir: data directory the job works on
+        :param func: function to run
+        :param args: arguments for func
+        :param kwargs: keyword arguments for func
+        :return: job id
+        """
+        job_id = uuid.uuid4().hex
+        lock_file = self._acquire(self._lock_path(data_dir), job_id)
+
+        record = {
+            "id": job_id,
+            "kind": kind,
+            "data_dir": data_dir,
+            "status": "queued",
+            "stage": None,
+            "progress": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "duration": None,
+            "error": None,
+        }
+        try:
+            self._save(record)
+            self._executor.submit(self._run, record, lock_file, func, args, kwargs)
+        except Exception:
+            self._release(lock_file)
+            raise
+        return job_id
+
+    def _run(self, record, lock_file, func, args, kwargs):
+        last_saved = [0.0]
+
+        def progress(stage, done=None, total=None):
+            now = time.time()
+            stage_changed = stage != record["stage"]
+            record["stage"] = stage
+            record["progress"] = {"done": done, "total": total} if done is not None else None
+            # Writing the record for every frame would be wasteful, only write when the stage changes or every
+            # progress_interval seconds
+            if stage_changed or done == total or now - last_saved[0] >= self.progress_interval:
+                last_saved[0] = now
+                self._save(record)
+
+        record["status"] = "running"
+        record["started_at"] = time.time()
+        self._save(record)
+        try:
+            func(*args, progress=progress, **kwargs)
+            record["status"] = "done"
+        except Exception as e:
+            traceback.print_exc()
+            record["status"] = "failed"
+            record["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            record["finished_at"] = time.time()
+            record["duration"] = record["finished_at"] - record["started_at"]
+            # Released first, so the data directory is free once the record says the job finished
+            self._release(lock_file)
+            self._save(record)
+
+    def get(self, job_id):
+        """
+        Get the record of a job
+        :param job_id: job id
+        :return: dict with the job record, or None if there is no such job
+        """
+        # Job ids are uuid4 hex strings, anything else could escape jobs_dir
+        if len(job_id) != 32 or any(c not in "0123456789abcdef" for c in job_id):
+            return None
+        try:
+            with open(self._record_path(job_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def wait(self, job_id, timeout=None, poll_interval=0.1):
+        """
+        Wait for a job to finish
+        :param job_id: job id
+        :param timeout: seconds to wait at most, wait forever if None
+        :param poll_interval: seconds between checks
+        :return: the final job record
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            record = self.get(job_id)
+            if record is not None and record["status"] in ("done", "failed"):
+                return record
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError(f"Job {job_id} did not finish within {timeout} seconds")
+            time.sleep(poll_interval)
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker pool
+        :param wait: wait for the running jobs to finish
+        :return: void
+        """
+        self._executor.shutdown(wait=wait)
+
@@ -1,130 +1,277 @@
-from openai import OpenAI, AsyncOpenAI
-from pathlib import Path
-from tempfile import NamedTemporaryFile
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
 import asyncio
+import re
 from pydub import AudioSegment
+import imageio_ffmpeg
+import subprocess
+import threading
+import shutil
 import os
 
+from quiz.disk_cache import DiskCache, default_cache_dir, make_key
 
-async def generate_audio_chunk(client, voice, chunk, nr):
+TTS_MODEL = "tts-1"
+TTS_FRAME_RATE = 24000  # The TTS API returns 24 kHz mono mp3
+TTS_CACHE_BYTES = int(os.environ.get('RR_TTS_CACHE_BYTES', 200 * 1024 ** 2))
+RETRY_ERRORS = (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError)
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+_tts_cache = None
+_tts_cache_lock = threading.Lock()
+
+
+def ffmpeg_exe():
     """
-    Generate audio for a chunk of text.
+    Get the ffmpeg executable, the one on the PATH or else the one bundled with imageio-ffmpeg
+    :return: path to ffmpeg
+    """
+    return shutil.which("ffmpeg") or imageio_ffmpeg.get_ffmpeg_exe()
+
+
+# pydub exports with ffmpeg too
+AudioSegment.converter = ffmpeg_exe()
+
+
+def tts_cache():
+    """
+    Get the shared on-disk cache of synthesized speech, keyed by text, voice and model. It lives outside the quiz data
+    directory, so it survives /clear_quiz.
+    :return: DiskCache
+    """
+    global _tts_cache
+    with _tts_cache_lock:
+        if _tts_cache is None:
+            _tts_cache = DiskCache(default_cache_dir("tts"), TTS_CACHE_BYTES, suffix=".mp3")
+        return _tts_cache
+
+
+async def synthesize(client, voice, text, model=TTS_MODEL, cache=None):
+    """
+    Get the speech for a text as mp3 bytes, from the cache or from the TTS API
     :param client: client
     :param voice: what voice to use
-    :param chunk: chunk of text
-    :param nr: nr of chunk
-    :return:
+    :param text: text to read
+    :param model: TTS model
+    :param cache: DiskCache to use, the shared TTS cache if not given
+    :return: mp3 bytes
     """
+    if cache is None:
+        cache = tts_cache()
+    cache_key = make_key("tts", text, voice, model)
+    audio_data = cache.get(cache_key)
+    if audio_data is not None:
+        return audio_data
+
     response = await client.audio.speech.create(
-        model="tts-1",
+        model=model,
         voice=voice,
-        input=chunk
+        input=text
     )
-    with NamedTemporaryFile(suffix=".mp3", delete=False) as temp_file:
-        temp_file_path = temp_file.name  # Get the file path
-        response.stream_to_file(temp_file_path)  # Use the file path here
-    chunk_audio = AudioSegment.from_mp3(temp_file_path)  # Use the file path to load the audio
-    # Optionally delete the temporary file if needed
-    os.remove(temp_file_path)
-    return chunk_audio
+    audio_data = response.content
+    cache.put(cache_key, audio_data)
+    return audio_data
 
 
-async def quiz_2_speech_openai(quiz, voice, openai_api_key=""):
+def decode_mp3(audio_data, frame_rate=TTS_FRAME_RATE, channels=1):
     """
-    Generate audio for a quiz.
-    :param quiz: quiz class
-    :param voice: what voice to use
-    :param openai_api_key: api key
-    :return:
+    Decode mp3 bytes in memory, piping them through ffmpeg
+    :param audio_data: mp3 bytes
+    :param frame_rate: sample rate to decode to
+    :param channels: number of channels to decode to
+    :return: AudioSegment with 16 bit samples
+    """
+    command = [
+        ffmpeg_exe(), "-loglevel", "error",
+        "-i", "pipe:0",
+        "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(frame_rate), "-ac", str(channels),
+        "pipe:1",
+    ]
+    result = subprocess.run(command, input=audio_data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode the audio: {result.stderr.decode(errors='replace')}")
+    return AudioSegment(data=result.stdout, sample_width=2, frame_rate=frame_rate, channels=channels)
+
+
+def assemble(segments, gap=0):
+    """
+    Join audio segments in one go. Adding segments one by one copies the whole audio every time, joining the raw
+    samples once takes linear time. Segments are converted to the format of the first segment.
+    :param segments: list of AudioSegments
+    :param gap: milliseconds of silence after every segment
+    :return: AudioSegment
     """
-    if openai_api_key == "":
-        client = AsyncOpenAI()
-    else:
-        client = AsyncOpenAI(api_key=openai_api_key)
+    if not segments:
+        return AudioSegment.empty()
+    first = segments[0]
+    silence = b""
+    if gap:
+        silence = AudioSegment.silent(duration=gap, frame_rate=first.frame_rate).set_channels(
+            first.channels).set_sample_width(first.sample_width).raw_data
 
-    speech_file_path = Path(__file__).parent / "speech.mp3"
+    parts = []
+    for segment in segments:
+        if (segment.frame_rate, segment.channels, segment.sample_width) != (
+                first.frame_rate, first.channels, first.sample_width):
+            segment = segment.set_frame_rate(first.frame_rate).set_channels(first.channels).set_sample_width(
+                first.sample_width)
+        parts.append(segment.raw_data)
+        parts.append(silence)
+    return first._spawn(b"".join(parts))
 
-    print(f"Generating audio for voice {voice}, to file {speech_file_path}")
 
-    chunks = [clue for clue in quiz.clues]
+class TTSEngine():
+    """
+    Reads texts with one shared TTS client. Texts are split on sentence boundaries under the length limit of the API,
+    at most max_concurrency requests run at once, and failed requests are retried with exponential backoff.
+    Create one engine per build and use it from a single event loop.
+    """
+
+    def __init__(self, voice="echo", model=TTS_MODEL, max_concurrency=4, retries=3, backoff_factor=0.5,
+                 max_chars=4000, openai_api_key="", base_url=None, cache=None):
+        self.voice = voice
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_chars = max_chars
+        self.openai_api_key = openai_api_key
+        self.base_url = base_url
+        self.cache = cache
+        self.retries_made = 0
+        self._client = None
+        self._semaphore = None
 
-    # make sure that each chunk is less than 4000 characters, otherwise split the chunk in two entries
-    while any([len(chunk) > 4000 for chunk in chunks]):
-        new_chunks = []
-        for chunk in chunks:
-            if len(chunk) > 4000:
-                new_chunks.append(chunk[:4000])
-                new_chunks.append(chunk[4000:])
-            else:
-                new_chunks.append(chunk)
-        chunks = new_chunks
+    @property
+    def client(self):
+        if self._client is None:
+            kwargs = {"max_retries": 0}  # Retries are done here, with the concurrency limit held
+            if self.openai_api_key != "":
+                kwargs["api_key"] = self.openai_api_key
+            if self.base_url is not None:
+                kwargs["base_url"] = self.base_url
+            self._client = AsyncOpenAI(**kwargs)
+        return self._client
 
-    tasks = []
-    for nr, chunk in enumerate(chunks):
-        tasks.append(generate_audio_chunk(client, voice, chunk, nr))
-    chunk_audios = await asyncio.gather(*tasks)
+    async def synthesize(self, text):
+        """
+        Get the speech for a chunk of text as mp3 bytes, waiting for a free request slot and retrying on errors
+        :param text: text to read, at most max_chars characters
+        :return: mp3 bytes
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    return await synthesize(self.client, self.voice, text, self.model, self.cache)
+                except RETRY_ERRORS as e:
+                    if attempt == self.retries:
+                        raise
+                    delay = self.backoff_factor * 2 ** attempt
+                    print(f"TTS request failed ({type(e).__name__}), retrying in {delay:.1f} seconds")
+                    self.retries_made += 1
+                    await asyncio.sleep(delay)
 
-    concatenated_audio = AudioSegment.empty()  # Creating an empty audio segment
-    for chunk_audio in chunk_audios:
-        concatenated_audio += chunk_audio
-        concatenated_audio += AudioSegment.silent(duration=500)
+    async def speak(self, text, gap=0):
+        """
+        Read a text
+        :param text: text to read
+        :param gap: milliseconds of silence after the text
+        :return: AudioSegment
+        """
+        chunks = split_text(text, self.max_chars)
+        audio_data = await asyncio.gather(*[self.synthesize(chunk) for chunk in chunks])
+        # Decoding runs ffmpeg, keep it off the event loop
+        segments = await asyncio.gather(*[asyncio.to_thread(decode_mp3, data) for data in audio_data])
+        speech = assemble(segments)
+        if gap:
+            speech = assemble([speech], gap=gap)
+        return speech
 
-        # Export concatenated audio to a file
-        with NamedTemporaryFile(suffix=".mp3", delete=True) as temp_file:
-            temp_file_path = temp_file.name  # Get the file path
-            concatenated_audio.export(temp_file_path, format="mp3")
-            # read audio file and return raw bytes
-            with open(temp_file_path, "rb") as f:
-                raw_audio_bytes = f.read()
+    async def speak_all(self, texts, gap=0):
+        """
+        Read several texts concurrently and join them
+        :param texts: list of texts
+        :param gap: milliseconds of silence after every text
+        :return: AudioSegment
+        """
+        return assemble(await asyncio.gather(*[self.speak(text) for text in texts]), gap=gap)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+def split_text(text, max_chars=4000):
+    """
+    Split a text in chunks of at most max_chars characters. Chunks end at sentence boundaries where possible, else at
+    a space, and only words longer than max_chars are cut.
+    :param text: text to split
+    :param max_chars: maximum length of a chunk
+    :return: list of chunks
+    """
+    text = text.strip()
+    if len(text) <= max_chars:
+        return [text] if text else []
 
-    return concatenated_audio
+    pieces = []
+    for sentence in SENTENCE_END.split(text):
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        for word in sentence.split():
+            pieces.extend(word[i:i + max_chars] for i in range(0, len(word), max_chars))
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def quiz_2_speech_openai(quiz, voice, openai_api_key="", engine=None):
+    """
+    Generate audio for a quiz.
+    :param quiz: quiz class
+    :param voice: what voice to use
+    :param openai_api_key: api key
+    :param engine: TTSEngine to use, a new one if not given
+    :return:
+    """
+    print(f"Generating audio for voice {voice}")
+    own_engine = engine is None
+    if own_engine:
+        engine = TTSEngine(voice, openai_api_key=openai_api_key)
+    try:
+        # Half a second of silence after every clue
+        return await engine.speak_all(quiz.clues, gap=500)
+    finally:
+        if own_engine:
+            await engine.close()
 
 
-async def text_2_speech_openai(text, voice, openai_api_key=""):
+async def text_2_speech_openai(text, voice, openai_api_key="", engine=None):
     """
     Generate audio for a text.
     :param text: text to generate audio for
     :param voice: what voice to use
     :param openai_api_key: api key
+    :param engine: TTSEngine to use, a new one if not given
     :return:
     """
-    if openai_api_key == "":
-        client = AsyncOpenAI()
-    else:
-        client = AsyncOpenAI(api_key=openai_api_key)
-
-    speech_file_path = Path(__file__).parent / "speech.mp3"
-
-    print(f"Generating audio for voice {voice}, to file {speech_file_path}")
-
-    chunks = [text]
-
-    # make sure that each chunk is less than 4000 characters, otherwise split the chunk in two entries
-    while any([len(chunk) > 4000 for chunk in chunks]):
-        new_chunks = []
-        for chunk in chunks:
-            if len(chunk) > 4000:
-                new_chunks.append(chunk[:4000])
-                new_chunks.append(chunk[4000:])
-            else:
-                new_chunks.append(chunk)
-        chunks = new_chunks
-
-    tasks = []
-    for nr, chunk in enumerate(chunks):
-        tasks.append(generate_audio_chunk(client, voice, chunk, nr))
-    chunk_audios = await asyncio.gather(*tasks)
-
-    concatenated_audio = AudioSegment.empty()  # Creating an empty audio segment
-    for chunk_audio in chunk_audios:
-        concatenated_audio += chunk_audio
-
-        # Export concatenated audio to a file
-        with NamedTemporaryFile(suffix=".mp3", delete=True) as temp_file:
-            temp_file_path = temp_file.name  # Get the file path
-            concatenated_audio.export(temp_file_path, format="mp3")
-            # read audio file and return raw bytes
-            with open(temp_file_path, "rb") as f:
-                raw_audio_bytes = f.read()
-
-    return concatenated_audio
+    print(f"Generating audio for voice {voice}")
+    own_engine = engine is None
+    if own_engine:
+        engine = TTSEngine(voice, openai_api_key=openai_api_key)
+    try:
+        return await engine.speak(text)
+    finally:
+        if own_engine:
+            await engine.close()
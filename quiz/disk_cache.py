@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def default_cache_dir(name):
+    """
+    Get the directory for a named cache. Caches live outside the quiz data directory so that clearing the quiz
+    does not clear them. The root can be changed with the RR_CACHE_PATH environment variable.
+    :param name: name of the cache, e.g. "streetview"
+    :return: path to the cache directory
+    """
+    root = os.environ.get('RR_CACHE_PATH', os.path.join(os.path.expanduser("~"), ".cache", "roadtrip_riddle"))
+    return os.path.join(root, name)
+
+
+def make_key(*parts):
+    """
+    Create a cache key from a number of json serializable parts
+    :param parts: the parts that identify the cached value
+    :return: sha256 hex digest
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+TMP_MAX_AGE = 3600  # Seconds after which a temporary file is left over from a crashed writer
+
+
+class DiskCache():
+    """
+    A persistent key -> bytes cache stored as one file per entry. Once the cache grows over max_bytes the least
+    recently used entries are evicted. Recency is kept in the file mtimes, so it survives restarts.
+
+    Several processes (server workers, the job runner) can share a cache directory. Each instance only sees its own
+    writes, so it scans the directory again before evicting and after every rescan_bytes it writes. Entries written
+    by other processes are picked up on a lookup. The cache can go over max_bytes by at most rescan_bytes per process.
+    """
+
+    def __init__(self, cache_dir, max_bytes=500 * 1024 * 1024, suffix=".bin", rescan_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.rescan_bytes = rescan_bytes if rescan_bytes is not None else max(1, max_bytes // 20)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._written = 0  # bytes written since the last scan
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.remove_orphans()
+        with self._lock:
+            self._scan()
+            self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def _scan(self):
+        # Read the entries and their recency from the directory, other processes may have added or removed some
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self.suffix):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime_ns, entry.name[:-len(self.suffix)], stat.st_size))
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(files))
+        self.total_bytes = sum(self._entries.values())
+        self._written = 0
+
+    def remove_orphans(self, max_age=TMP_MAX_AGE):
+        """
+        Remove temporary files left over by writers that crashed. Recent ones may belong to a write in progress.
+        :param max_age: age in seconds after which a temporary file is removed
+        :return: number of files removed
+        """
+        removed = 0
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".tmp"):
+                continue
+            try:
+                if now - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def get(self, key):
+        """
+        Get a value from the cache
+        :param key: cache key
+        :return: the cached bytes, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            now = time.time_ns()
+            os.utime(path, ns=(now, now))
+        except FileNotFoundError:
+            # Never stored, or evicted by another process
+            with self._lock:
+                self.total_bytes -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            # The entry may have been written by another process
+            self.total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """
+        Store a value in the cache
+        :param key: cache key
+        :param data: bytes to store
+        :return: void
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        # Nanosecond mtimes, so entries written in quick succession keep their order
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+        with self._lock:
+            self.total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._written += len(data)
+            if self.total_bytes > self.max_bytes or self._written >= self.rescan_bytes:
+                self._scan()
+                self._evict()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def hit_rate(self):
+        """
+        Get the share of lookups that were hits
+        :return: hit rate between 0 and 1
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        Get the cache counters
+        :return: dict with the counters
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hit_rate(),
+            }
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import threading
+
+import requests
+
+from quiz.disk_cache import default_cache_dir
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+# Precomputed coordinates of the cities in static/cities.txt, written by build_geocode_index.py
+GEOCODE_SEED_PATH = os.path.join("./static", "geocodes.json")
+# Nominatim asks for an identifying User-Agent and at most one request per second
+USER_AGENT = os.environ.get('RR_NOMINATIM_USER_AGENT', "roadtrip-riddle (https://roadtrip-riddle.onrender.com)")
+
+
+def normalize_city(city):
+    """
+    Normalize a city name for lookups
+    :param city: city name
+    :return: normalized name
+    """
+    return " ".join(city.split()).lower()
+
+
+class GeocodeIndex():
+    """
+    City name -> (lat, lng) index kept in memory and on disk. It starts from the precomputed seed file and the
+    cities geocoded earlier, so lookups of known cities never go to the network. Unknown cities are geocoded with
+    Nominatim, at most one request every min_interval seconds, and added to the index.
+    """
+
+    def __init__(self, index_path=None, seed_path=GEOCODE_SEED_PATH, base_url=NOMINATIM_URL, min_interval=1.0,
+                 retries=3, timeout=10):
+        self.index_path = index_path if index_path is not None else os.path.join(default_cache_dir("geocode"),
+                                                                                 "geocodes.json")
+        self.base_url = base_url
+        self.min_interval = min_interval
+        self.retries = retries
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._network_lock = threading.Lock()
+        self._last_request = 0.0
+        self._session = requests.Session()
+        self._session.headers["User-Agent"] = USER_AGENT
+
+        self._index = {}
+        for path in (seed_path, self.index_path):
+            self._index.update(read_index(path))
+
+    def lookup(self, city):
+        """
+        Get the coordinates of a city
+        :param city: city name
+        :return: (lat, lng)
+        """
+        key = normalize_city(city)
+        with self._lock:
+            if key in self._index:
+                self.hits += 1
+                return tuple(self._index[key])
+            # Another process may have geocoded the city in the meantime
+            self._index.update(read_index(self.index_path))
+            if key in self._index:
+                self.hits += 1
+                return tuple(self._index[key])
+            self.misses += 1
+
+        coordinates = self.geocode(city)
+        with self._lock:
+            self._index[key] = list(coordinates)
+        self.save({key: list(coordinates)})
+        return coordinates
+
+    def geocode(self, city):
+        """
+        Geocode a city with Nominatim, waiting for the rate limit and retrying on 429
+        :param city: city name
+        :return: (lat, lng)
+        """
+        params = {
+            'q': city,
+            'format': 'json'
+        }
+        with self._network_lock:
+            for attempt in range(self.retries + 1):
+                wait = self._last_request + self.min_interval - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    response = self._session.get(self.base_url, params=params, timeout=self.timeout)
+                except requests.RequestException as e:
+                    raise ConnectionError(f"Failed to connect to the Nominatim API: {e}")
+                finally:
+                    self._last_request = time.monotonic()
+                if response.status_code != 429:
+                    break
+                retry_after = response.headers.get("Retry-After", "")
+                delay = float(retry_after) if retry_after.isdigit() else self.min_interval * 2 ** attempt
+                print(f"Nominatim rate limit hit, retrying {city} in {delay:.0f} seconds")
+                time.sleep(delay)
+
+        if response.status_code == 200:
+            result = response.json()
+            if result:
+                return float(result[0]['lat']), float(result[0]['lon'])
+            else:
+                raise ValueError("No results found for the given city.")
+        else:
+            raise ConnectionError("Failed to connect to the Nominatim API.")
+
+    def save(self, entries):
+        """
+        Add entries to the index file. Entries written by other processes in the meantime are kept.
+        :param entries: dict of normalized city name -> [lat, lng]
+        :return: void
+        """
+        with self._lock:
+            index = read_index(self.index_path)
+            index.update(entries)
+            write_index(self.index_path, index)
+
+    def __contains__(self, city):
+        with self._lock:
+            return normalize_city(city) in self._index
+
+    def __len__(self):
+        with self._lock:
+            return len(self._index)
+
+    def entries(self):
+        """
+        Get all the entries of the index
+        :return: dict of normalized city name -> [lat, lng]
+        """
+        with self._lock:
+            return dict(self._index)
+
+
+def read_index(path):
+    """
+    Read an index file
+    :param path: path to the json file
+    :return: dict of normalized city name -> [lat, lng], empty if the file does not exist or can not be read
+    """
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        # The cities are geocoded again and the file is rewritten
+        print(f"Ignoring the unreadable geocode index {path}: {e}")
+        return {}
+    return index if isinstance(index, dict) else {}
+
+
+def write_index(path, index):
+    """
+    Write an index file atomically
+    :param path: path to the json file
+    :param index: dict of normalized city name -> [lat, lng]
+    :return: void
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+_geocode_index = None
+_geocode_index_lock = threading.Lock()
+
+
+def geocode_index():
+    """
+    Get the shared geocode index of this process
+    :return: GeocodeIndex
+    """
+    global _geocode_index
+    with _geocode_index_lock:
+        if _geocode_index is None:
+            _geocode_index = GeocodeIndex()
+        return _geocode_index
@@ -0,0 +1,181 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from quiz import quiz_creator, street_view_collector, video_creator
+
+
+class QuizStages():
+    """
+    The stages of a quiz build. Each method does one stage on the data directory, build_quiz decides what runs
+    concurrently. Subclass it to replace stages.
+
+    With variants (names from video_creator.VARIANTS) the frames are fetched once for all the variants and every
+    variant is rendered from them, video_format, width and height are then not used. The hls_variants among them are
+    also packaged as an HLS stream.
+
+    With a fetch_stride of k only every k-th point of the path is fetched from Street View, and the video synthesizes
+    the frames in between with the tween (see video_creator.TWEENS).
+    """
+
+    def __init__(self, data_dir, out_dir="", video_format="desktop", width=-1, height=-1, add_outro=False,
+                 num_points=300, variants=None, hls_variants=(), fetch_stride=1, tween="dissolve"):
+        self.data_dir = data_dir
+        self.out_dir = out_dir
+        self.video_format = video_format
+        self.width = width
+        self.height = height
+        self.add_outro = add_outro
+        self.num_points = num_points
+        self.variants = video_creator.get_variants(variants) if variants else None
+        self.hls_variants = list(hls_variants)
+        self.fetch_stride = fetch_stride
+        self.tween = tween
+
+    def destination(self):
+        return quiz_creator.random_destination(self.data_dir)
+
+    def clues(self, city, progress):
+        return quiz_creator.create_clues(self.data_dir, city)
+
+    def audio(self, city, clues, progress):
+        quiz_creator.create_quiz_audio(self.data_dir, city, clues, self.add_outro)
+
+    def route(self, city, progress):
+        path_coordinates = quiz_creator.find_path(city, self.num_points, progress=progress)
+        if path_coordinates:
+            quiz_creator.save_path(self.data_dir, path_coordinates)
+        return path_coordinates
+
+    def frames(self, path_coordinates, progress):
+        if self.variants:
+            views = {variant.view for variant in self.variants}
+            if None in views:
+                raise ValueError("Every video variant of a build needs a view")
+            street_view_collector.create_new_frames(self.data_dir, progress=progress, views=sorted(views),
+                                                    fetch_stride=self.fetch_stride)
+        else:
+            street_view_collector.create_new_frames(self.data_dir, self.video_format, self.width, self.height,
+                                                    progress=progress, fetch_stride=self.fetch_stride)
+
+    def video(self, progress):
+        if self.variants:
+            video_creator.create_video_variants(self.data_dir, self.out_dir, self.variants, progress=progress,
+                                                hls_variants=self.hls_variants, fetch_stride=self.fetch_stride,
+                                                tween=self.tween)
+        else:
+            video_creator.create_new_video(self.data_dir, self.out_dir, progress=progress,
+                                           fetch_stride=self.fetch_stride, tween=self.tween)
+
+
+class StageTimer():
+    """
+    Records when each stage of a build starts and ends, relative to the start of the build.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def run(self, name, func, *args):
+        """
+        Run a stage and record its timing
+        :param name: name of the stage
+        :param func: function to run
+        :param args: arguments for func
+        :return: what func returns
+        """
+        stage_start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            stage_end = time.perf_counter()
+            with self._lock:
+                self.stages.append((name, stage_start - self.start, stage_end - self.start))
+
+    def report(self):
+        """
+        Get the timings
+        :return: dict with the stages as (name, start, end), the wall clock time and the sum of the stage durations
+        """
+        with self._lock:
+            stages = list(self.stages)
+        wall_clock = time.perf_counter() - self.start
+        serial = sum(end - start for _, start, end in stages)
+        return {"stages": stages, "wall_clock": wall_clock, "serial": serial, "saved": serial - wall_clock}
+
+    def print_report(self):
+        """
+        Print a table with the timing of each stage and the time saved by running stages concurrently
+        :return: the report
+        """
+        report = self.report()
+        print(f"{'Stage':<12}{'start':>10}{'end':>10}{'duration':>10}")
+        for name, start, end in report["stages"]:
+            print(f"{name:<12}{start:>9.1f}s{end:>9.1f}s{end - start:>9.1f}s")
+        saved_share = report["saved"] / report["serial"] if report["serial"] else 0.0
+        print(f"Stages one after another: {report['serial']:.1f}s, wall clock: {report['wall_clock']:.1f}s, "
+              f"saved {report['saved']:.1f}s ({saved_share:.0%})")
+        return report
+
+
+def build_quiz(stages, city="", progress=None, max_cities=5):
+    """
+    Build a complete quiz: clues, audio, path, frames and video. Once the city is known the clues and audio are
+    created while the path is searched and the frames are fetched, the video is encoded when both are done.
+    :param stages: QuizStages
+    :param city: city name, a random city if empty
+    :param progress: callback called with (stage, done=None, total=None), it can be called from several threads
+    :param max_cities: number of cities to try when no path is found for a random city
+    :return: the timing report, with the city
+    """
+    progress_lock = threading.Lock()
+
+    def report_progress(stage, done=None, total=None):
+        if progress is not None:
+            with progress_lock:
+                progress(stage, done, total)
+
+    timer = StageTimer()
+    random_city = city == ""
+
+    def clues_and_audio(city):
+        report_progress("clues")
+        clues = timer.run("clues", stages.clues, city, report_progress)
+        report_progress("audio")
+        timer.run("audio", stages.audio, city, clues, report_progress)
+
+    def route_and_frames(city):
+        report_progress("route")
+        path_coordinates = timer.run("route", stages.route, city, report_progress)
+        if not path_coordinates:
+            return False
+        report_progress("frames")
+        timer.run("frames", stages.frames, path_coordinates, report_progress)
+        return True
+
+    for attempt in range(max_cities):
+        if random_city:
+            city = timer.run("destination", stages.destination)
+        print(f"Building quiz for {city}")
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            audio_future = executor.submit(clues_and_audio, city)
+            frames_future = executor.submit(route_and_frames, city)
+            found_path = frames_future.result()
+            audio_future.result()
+
+        if found_path:
+            break
+        print(f"No path found to {city}")
+        if not random_city:
+            raise Exception(f"Failed to find a path to {city}")
+    else:
+        raise Exception(f"Failed to find a path for {max_cities} cities")
+
+    report_progress("video")
+    timer.run("video", stages.video, report_progress)
+    report = timer.print_report()
+    report["city"] = city
+    return report
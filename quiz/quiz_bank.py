@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import uuid
+import shutil
+
+BANK_DIR = "bank"
+CURRENT_LINK = "current"
+ENTRY_FILE = "bank_entry.json"
+
+
+class QuizBank():
+    """
+    Quizzes built ahead of time, each in its own version directory under data_dir/bank. The live quiz is the one the
+    data_dir/current symlink points to. Publishing the next quiz replaces the symlink with os.replace, which is atomic,
+    so readers see either the old or the new quiz and never a mix of both.
+
+    A version is ready once its bank_entry.json exists, it is written after everything else.
+    """
+
+    def __init__(self, data_dir, keep_published=2):
+        self.data_dir = data_dir
+        self.bank_dir = os.path.join(data_dir, BANK_DIR)
+        self.current_link = os.path.join(data_dir, CURRENT_LINK)
+        self.keep_published = keep_published
+
+    def _entry_path(self, version):
+        return os.path.join(self.bank_dir, version, ENTRY_FILE)
+
+    def read_entry(self, version):
+        """
+        Read the bank entry of a version
+        :param version: version name
+        :return: dict with city, built_at and published_at, or None if the version is not ready
+        """
+        try:
+            with open(self._entry_path(version)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_entry(self, version, entry):
+        path = self._entry_path(version)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def new_version(self):
+        """
+        Create the directory for a new quiz
+        :return: (version name, path to the directory)
+        """
+        version = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        version_dir = os.path.join(self.bank_dir, version)
+        os.makedirs(version_dir)
+        return version, version_dir
+
+    def add(self, build):
+        """
+        Build a quiz into a new version directory and mark it as ready. The directory is removed if the build fails.
+        :param build: function called with the version directory, returns the city of the quiz
+        :return: version name
+        """
+        version, version_dir = self.new_version()
+        try:
+            city = build(version_dir)
+        except Exception:
+            shutil.rmtree(version_dir, ignore_errors=True)
+            raise
+        self._write_entry(version, {"city": city, "built_at": time.time(), "published_at": None})
+        return version
+
+    def versions(self):
+        """
+        Get the ready versions with their entries, oldest first
+        :return: list of (version, entry)
+        """
+        if not os.path.isdir(self.bank_dir):
+            return []
+        versions = []
+        for version in os.listdir(self.bank_dir):
+            entry = self.read_entry(version)
+            if entry is not None:
+                versions.append((version, entry))
+        return sorted(versions, key=lambda item: (item[1]["built_at"], item[0]))
+
+    def pending(self):
+        """
+        Get the ready versions that were never published, oldest first
+        :return: list of version names
+        """
+        return [version for version, entry in self.versions() if entry["published_at"] is None]
+
+    def live_version(self):
+        """
+        Get the version the current symlink points to
+        :return: version name, or None if nothing was published
+        """
+        try:
+            return os.path.basename(os.readlink(self.current_link))
+        except (FileNotFoundError, OSError):
+            return None
+
+    def live_dir(self):
+        """
+        Get the directory of the live quiz
+        :return: path to the directory, or None if nothing was published
+        """
+        version = self.live_version()
+        if version is None:
+            return None
+        return os.path.join(self.bank_dir, version)
+
+    def publish(self, version=None):
+        """
+        Make a version the live quiz by atomically replacing the current symlink
+        :param version: version to publish, the oldest pending version if not given
+        :return: the published version name
+        """
+        if version is None:
+            pending = self.pending()
+            if not pending:
+                raise ValueError("There is no quiz left in the bank to publish")
+            version = pending[0]
+        entry = self.read_entry(version) if os.path.basename(version) == version else None
+        if entry is None:
+            raise ValueError(f"Quiz {version} is not in the bank or not ready")
+
+        tmp_link = f"{self.current_link}.{os.getpid()}.tmp"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        # Relative, so the data directory can be moved
+        os.symlink(os.path.join(BANK_DIR, version), tmp_link)
+        os.replace(tmp_link, self.current_link)
+
+        if entry["published_at"] is None:
+            entry["published_at"] = time.time()
+            self._write_entry(version, entry)
+        self.prune()
+        return version
+
+    def prune(self):
+        """
+        Remove old published quizzes. The live quiz and the keep_published quizzes before it are kept, so downloads that
+        started before the switch can finish.
+        :return: list of removed versions
+        """
+        live = self.live_version()
+        published = sorted((entry["published_at"], version) for version, entry in self.versions()
+                           if entry["published_at"] is not None and version != live)
+        removed = []
+        for _, version in published[:max(0, len(published) - self.keep_published)]:
+            shutil.rmtree(os.path.join(self.bank_dir, version), ignore_errors=True)
+            removed.append(version)
+        return removed
+
+    def fill(self, target, build):
+        """
+        Build quizzes until target quizzes are waiting to be published
+        :param target: number of pending quizzes to have
+        :param build: function called with the version directory, returns the city of the quiz
+        :return: list of the new versions
+        """
+        added = []
+        while len(self.pending()) < target:
+            added.append(self.add(build))
+        return added
@@ -1,7 +1,9 @@
 import os.path
 import pickle
-from pydantic import BaseModel, Field
-from openai import OpenAI
+import functools
+import threading
+from pydantic import BaseModel, Field, field_validator
+from openai import AsyncOpenAI
 import instructor
 import json
 import random
@@ -11,6 +13,15 @@ from pydub import AudioSegment
 
 from quiz import street_view_collector
 from quiz import audio_creator
+from quiz.disk_cache import DiskCache, default_cache_dir, make_key
+
+CLUE_MODEL = "gpt-4"
+PROMPT_VERSION = 1  # Bump when the prompt changes, clues cached for an older prompt are then not used
+CLUES_PER_QUIZ = 5
+CLUES_CACHE_BYTES = 50 * 1024 ** 2
+
+_clues_cache = None
+_clues_cache_lock = threading.Lock()
 
 class QuizHost():
     """
@@ -31,6 +42,18 @@ class QuizClues(BaseModel):
     clues: list[str] = Field(..., description="A list of size 5 with clues for the quiz.")
     explanations: list[str] = Field(..., description="A list of size 5 with explanations for the clues.")
 
+    @field_validator("clues", "explanations")
+    @classmethod
+    def has_one_per_round(cls, value):
+        """
+        Check that there is one clue and one explanation for every round.
+        :param value: the clues or the explanations
+        :return: value
+        """
+        if len(value) != CLUES_PER_QUIZ:
+            raise ValueError(f"There must be exactly {CLUES_PER_QUIZ} items, not {len(value)}")
+        return value
+
     def clear_city(self):
         """
         Replace the city name with "the city" in all clues.
@@ -94,28 +117,39 @@ class QuizClues(BaseModel):
             data = json.load(file)
             return cls(clues=data['clues'], explanations=data['explanations'])
 
-def random_destination(data_path) -> str:
+@functools.lru_cache(maxsize=None)
+def load_cities(path_to_cities=os.path.join("./static", "cities.txt")):
     """
-    Get a random destination from the cities text file.
-    :param data_path: path to the cities text file
-    :return: city name
+    Load the list of cities. The file is only read once.
+    :param path_to_cities: path to the cities text file
+    :return: tuple of city names
     """
-
-    # open the cities text file and pick a random city
-    # return the city
-    path_to_cities = os.path.join("./static", "cities.txt")
-
     # Opening the file
     with open(path_to_cities, 'r') as file:
         cities_text = file.read()
 
     # Splitting the text into a list of cities
-    cities_list = cities_text.split(',')
+    cities = (city.strip() for city in cities_text.split(','))
+    return tuple(city for city in cities if city)
+
 
+def random_destination(data_path) -> str:
+    """
+    Get a random destination from the cities text file.
+    :param data_path: path to the cities text file
+    :return: city name
+    """
     # Selecting a random city from the list
-    random_city = random.choice(cities_list)
+    return random.choice(load_cities())
 
-    return random_city.replace("\n", "")
+def random_destinations(count) -> list:
+    """
+    Get distinct random destinations from the cities text file.
+    :param count: number of cities
+    :return: list of city names
+    """
+    cities = load_cities()
+    return random.sample(cities, min(count, len(cities)))
 
 def create_quiz(city:str, openai_api_key="") -> QuizClues:
     """
@@ -124,12 +158,19 @@ def create_quiz(city:str, openai_api_key="") -> QuizClues:
     :param openai_api_key: openai api key
     :return:
     """
-    if openai_api_key == "":
-        client = instructor.patch(OpenAI())
-    else:
-        client = instructor.patch(OpenAI(api_key=openai_api_key))
+    clues = asyncio.run(create_quizzes([city], openai_api_key=openai_api_key))[city]
+    if isinstance(clues, Exception):
+        raise clues
+    return clues
+
 
-    prompt = f"""
+def clue_prompt(city: str) -> str:
+    """
+    Get the prompt that asks for the clues of a city. Bump PROMPT_VERSION when changing it.
+    :param city: city name
+    :return: prompt
+    """
+    return f"""
                 You are a quiz host and you are hosting a quiz where the answer is {city}. You are suppose to come up
                 with 5 clues for the city. Each clue should be easier and easier. In the beginning it 
                 shall be very hard. But in the end it shall be very easy. 
@@ -169,66 +210,178 @@ def create_quiz(city:str, openai_api_key="") -> QuizClues:
                 """
 
 
-    clues: QuizClues = client.chat.completions.create(
-        model="gpt-4",
-        response_model=QuizClues,
-        messages=[
-            {"role": "user", "content": prompt},
-        ],
-        max_retries=2,
-    )
+def clues_cache():
+    """
+    Get the shared on-disk cache of generated clues, keyed by city, prompt version and model
+    :return: DiskCache
+    """
+    global _clues_cache
+    with _clues_cache_lock:
+        if _clues_cache is None:
+            _clues_cache = DiskCache(default_cache_dir("clues"), CLUES_CACHE_BYTES, suffix=".json")
+        return _clues_cache
 
-    return clues
 
+async def create_quizzes(cities, max_concurrency=4, model=CLUE_MODEL, prompt_version=PROMPT_VERSION,
+                         openai_api_key="", base_url=None, cache=None):
+    """
+    Create the clues for many cities concurrently. Clues are only cached once they have one clue and one
+    explanation per round, and cached clues are used without calling the API.
+    :param cities: list of city names
+    :param max_concurrency: maximum number of requests at once
+    :param model: model to use
+    :param prompt_version: version of the prompt, part of the cache key
+    :param openai_api_key: openai api key
+    :param base_url: url of the API, the OpenAI API if not given
+    :param cache: DiskCache to use, the shared clues cache if not given
+    :return: dict of city -> QuizClues, or the exception if the clues could not be created
+    """
+    if cache is None:
+        cache = clues_cache()
+    kwargs = {}
+    if openai_api_key != "":
+        kwargs["api_key"] = openai_api_key
+    if base_url is not None:
+        kwargs["base_url"] = base_url
+    async_client = AsyncOpenAI(**kwargs)
+    client = instructor.apatch(async_client)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def create(city):
+        cache_key = make_key("clues", city, prompt_version, model)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return QuizClues.model_validate_json(cached)
 
-def create_new_quiz(data_dir="/var/data/", city="", add_outro=False, num_points=300):
+        async with semaphore:
+            # The response is validated against QuizClues, invalid responses are asked for again
+            clues: QuizClues = await client.chat.completions.create(
+                model=model,
+                response_model=QuizClues,
+                messages=[
+                    {"role": "user", "content": clue_prompt(city)},
+                ],
+                max_retries=2,
+            )
+        cache.put(cache_key, clues.model_dump_json().encode("utf-8"))
+        return clues
+
+    try:
+        results = await asyncio.gather(*[create(city) for city in cities], return_exceptions=True)
+    finally:
+        await async_client.close()
+
+    for city, result in zip(cities, results):
+        if isinstance(result, Exception):
+            print(f"Failed to create clues for {city}: {result}")
+    return dict(zip(cities, results))
+
+
+def create_new_quiz(data_dir="/var/data/", city="", add_outro=False, num_points=300, progress=None):
     """
     Create a new quiz.
     :param data_dir: path to the data directory
     :param city: city name
+    :param progress: callback called with the stage ("clues", "audio" or "route") and, while searching a route,
+    the number of directions requests done and planned
     :return:
     """
+    if progress is None:
+        progress = lambda stage, done=None, total=None: None
+
     path_coordinates = []
     while len(path_coordinates) == 0:
         # Create a new quiz
         if city == "":
             city = random_destination(data_dir)
-        city_quiz = create_quiz(city)
-        #city_quiz = QuizClues.open("static/quiz.json")
-        city_quiz.save(city, os.path.join(data_dir, "quiz.json"))
+        progress("clues")
+        city_quiz = create_clues(data_dir, city)
 
         # Create the audio
-        host_voice = "echo"
-        sound = asyncio.run(audio_creator.quiz_2_speech_openai(city_quiz, host_voice))
-        host = QuizHost("Where are we going?...", f"... And the correct answer is... {city}")
+        progress("audio")
+        create_quiz_audio(data_dir, city, city_quiz, add_outro)
 
-        if os.path.exists(os.path.join(data_dir, "intro.mp3")):
-            sound_intro = AudioSegment.from_mp3(os.path.join(data_dir, "intro.mp3"))
-        else:
-            sound_intro = asyncio.run(audio_creator.text_2_speech_openai(host.intro, host_voice))
-            sound_intro.export(os.path.join(data_dir, "intro.mp3"), format="mp3")
+        # Create the video
+        path_coordinates = find_path(city, num_points, progress=progress)
+
+    save_path(data_dir, path_coordinates)
 
+
+def create_clues(data_dir, city):
+    """
+    Create the clues for a city and save them to data_dir/quiz.json
+    :param data_dir: path to the data directory
+    :param city: city name
+    :return: QuizClues
+    """
+    city_quiz = create_quiz(city)
+    #city_quiz = QuizClues.open("static/quiz.json")
+    city_quiz.save(city, os.path.join(data_dir, "quiz.json"))
+    return city_quiz
+
+
+def create_quiz_audio(data_dir, city, city_quiz, add_outro=False, host_voice="echo"):
+    """
+    Read the clues with the host voice and save the audio, with intro and outro, to data_dir/quiz.mp3. The clues,
+    intro and outro are generated concurrently.
+    :param data_dir: path to the data directory
+    :param city: city name
+    :param city_quiz: QuizClues
+    :param add_outro: end with the answer, otherwise with silence
+    :param host_voice: what voice to use
+    :return: the audio
+    """
+    host = QuizHost("Where are we going?...", f"... And the correct answer is... {city}")
+
+    # One client, event loop and request limit for all the speech of the quiz
+    engine = audio_creator.TTSEngine(host_voice)
+
+    async def generate():
+        # The intro and outro rarely change, they normally come from the TTS cache
+        tasks = [audio_creator.quiz_2_speech_openai(city_quiz, host_voice, engine=engine),
+                 audio_creator.text_2_speech_openai(host.intro, host_voice, engine=engine)]
         if add_outro:
-            if os.path.exists(os.path.join(data_dir, "outro.mp3")):
-                sound_outro = AudioSegment.from_mp3(os.path.join(data_dir, "outro.mp3"))
-            else:
-                sound_outro = asyncio.run(audio_creator.text_2_speech_openai(host.outro, host_voice)) + AudioSegment.silent(duration=200)
-                sound_outro.export(os.path.join(data_dir, "outro.mp3"), format="mp3")
-        else:
-            sound_outro = AudioSegment.silent(duration=4000)
-
-        sound = sound_intro + sound + sound_outro
-        sound.export(os.path.join(data_dir, "quiz.mp3"), format="mp3")
-        #sound = AudioSegment.from_mp3("static/quiz.mp3")
+            tasks.append(audio_creator.text_2_speech_openai(host.outro, host_voice, engine=engine))
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            await engine.close()
 
-        # Create the video
-        for i in range(360):
-            print(f"Attempt {i} to get a path with {num_points} points")
-            # Try to get a path with the correct number of points
-            path_coordinates = street_view_collector.get_path_coordinates(city, "", num_points)
-            print(f"Got {len(path_coordinates)} points")
-            if len(path_coordinates) == num_points:
-                break
-
-    with open(os.path.join(data_dir,"path_coordinates.pkl"), "wb") as f:
+    sounds = asyncio.run(generate())
+    sound, sound_intro = sounds[0], sounds[1]
+    if add_outro:
+        sound_outro = sounds[2] + AudioSegment.silent(duration=200)
+    else:
+        sound_outro = AudioSegment.silent(duration=4000)
+
+    sound = audio_creator.assemble([sound_intro, sound, sound_outro])
+    sound.export(os.path.join(data_dir, "quiz.mp3"), format="mp3")
+    #sound = AudioSegment.from_mp3("static/quiz.mp3")
+    print(f"TTS: {engine.retries_made} retries, cache {audio_creator.tts_cache().stats()}")
+    return sound
+
+
+def find_path(city, num_points=300, progress=None):
+    """
+    Search for a path to the city with exactly num_points points
+    :param city: city name
+    :param num_points: number of points in the path
+    :param progress: callback called with ("route", requests done, requests planned)
+    :return: list of (lat, lng), empty if no path was found
+    """
+    route_finder = street_view_collector.RouteFinder()
+    try:
+        return route_finder.find(city, num_points, progress=progress)
+    finally:
+        route_finder.close()
+
+
+def save_path(data_dir, path_coordinates):
+    """
+    Save the path to data_dir/path_coordinates.pkl
+    :param data_dir: path to the data directory
+    :param path_coordinates: list of (lat, lng)
+    :return: void
+    """
+    with open(os.path.join(data_dir, "path_coordinates.pkl"), "wb") as f:
         pickle.dump(path_coordinates, f)
@@ -1,12 +1,33 @@
 import math
-import google_streetview.api
+import time
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import polyline
 import numpy as np
 from io import BytesIO
 from PIL import Image, ImageFilter
 import os
+import json
 import pickle
+import shutil
+
+from quiz.disk_cache import DiskCache, default_cache_dir, make_key
+from quiz.geocode_index import geocode_index
+
+STREET_VIEW_URL = "https://maps.googleapis.com/maps/api/streetview"
+DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+FRAME_STATUS_FILE = "frames_status.json"
+STREET_VIEW_CACHE_BYTES = int(os.environ.get('RR_STREET_VIEW_CACHE_BYTES', 2 * 1024 ** 3))
+GRAY_THRESHOLD = 20  # Maximum std of every color channel for an image to count as gray
+DUPLICATE_DISTANCE = 4  # Maximum number of differing bits (of 64) in the perceptual hash of two duplicates
+# Minimum distance in meters between the points of a path, on shorter routes neighbouring images are near-identical
+MIN_POINT_SPACING = 10
+VIEW_SIZES = {"mobile": (390, 640), "desktop": (630, 400)}  # Street view image size of each view
+CROP_BOTTOM_PIXELS = 30  # Height of the strip with the Google logo at the bottom of the street view images
 
 
 def add_logo_on_top(image, logo_path="./data/logo.png"):
@@ -86,22 +107,8 @@ def get_path_coordinates(destination, start_location="", num_points=10, api_key=
     destination_coord = get_coordinates_from_city(destination)
 
     if (start_location == ""):
-        # Randomly generate a start location in a ring around the destination
-        # Earth radius in kilometers
-        R = 6371.0
-        lat1 = np.radians(destination_coord[0])
-        lon1 = np.radians(destination_coord[1])
-        bearing = np.radians(np.random.uniform(0, 360))
-        d_radians = 8 / R # 8 km from the destination
-        new_lat = np.arcsin(np.sin(lat1) * np.cos(d_radians) +
-                            np.cos(lat1) * np.sin(d_radians) * np.cos(bearing))
-        new_lon = lon1 + np.arctan2(np.sin(bearing) * np.sin(d_radians) * np.cos(lat1),
-                                    np.cos(d_radians) - np.sin(lat1) * np.sin(new_lat))
-
-        new_lat_deg = np.degrees(new_lat)
-        new_lon_deg = np.degrees(new_lon)
-
-        start_coord = new_lat_deg, new_lon_deg
+        # Randomly generate a start location in a ring around the destination, 8 km from the destination
+        start_coord = start_points(destination_coord, [np.random.uniform(0, 360)], [8])[0]
     else:
         start_coord = get_coordinates_from_city(start_location)
 
@@ -109,7 +116,7 @@ def get_path_coordinates(destination, start_location="", num_points=10, api_key=
     print(f"Destination: {destination_coord}")
 
     # Set up the request to the Google Directions API
-    base_url = "https://maps.googleapis.com/maps/api/directions/json"
+    base_url = DIRECTIONS_URL
     params = {
         'origin': f'{start_coord[0]},{start_coord[1]}',
         'destination': f'{destination_coord[0]},{destination_coord[1]}',
@@ -133,147 +140,877 @@ def get_path_coordinates(destination, start_location="", num_points=10, api_key=
     # Decode the polyline
     full_path = polyline.decode(encoded_polyline)
 
-    # Select evenly spaced points from the path
-    path_coordinates = []
-    for i in range(0, min(num_points, len(full_path))):
-        path_coordinates.append(full_path[i])
+    return path_from_polyline(full_path, num_points)
+
+
+def start_points(destination_coord, bearings, radii):
+    """
+    Calculate start locations around the destination, for every combination of bearing and radius
+    :param destination_coord: (lat, lng) of the destination
+    :param bearings: bearings from the destination in degrees
+    :param radii: distances from the destination in km
+    :return: list of (lat, lng), all bearings for the first radius first
+    """
+    # Earth radius in kilometers
+    R = 6371.0
+    lat1 = np.radians(destination_coord[0])
+    lon1 = np.radians(destination_coord[1])
+    d_radians, bearing = np.meshgrid(np.asarray(radii, dtype=float) / R, np.radians(bearings), indexing="ij")
+    new_lat = np.arcsin(np.sin(lat1) * np.cos(d_radians) +
+                        np.cos(lat1) * np.sin(d_radians) * np.cos(bearing))
+    new_lon = lon1 + np.arctan2(np.sin(bearing) * np.sin(d_radians) * np.cos(lat1),
+                                np.cos(d_radians) - np.sin(lat1) * np.sin(new_lat))
+    return list(zip(np.degrees(new_lat).ravel().tolist(), np.degrees(new_lon).ravel().tolist()))
+
 
-    # Trim or extend the list to match the desired number of points
-    if len(path_coordinates) > num_points:
-        path_coordinates = path_coordinates[:num_points]
+def path_from_polyline(full_path, num_points):
+    """
+    Select the points of the video from a decoded route polyline
+    :param full_path: list of (lat, lng) of the route
+    :param num_points: number of points to select
+    :return: list of num_points (lat, lng) evenly spaced along the route, empty if the route has no length
+    """
+    path_coordinates = resample_path(full_path, num_points)
     if len(path_coordinates) < num_points:
-        print("Not enough points in the path. Only got " + str(len(path_coordinates)) + " points.")
+        print("Not enough points in the path. The route has " + str(len(full_path)) + " points.")
         return []
-
     return path_coordinates
 
 
-def fetch_street_view_images(path_coordinates, image_path, view="mobile", api_key="", crop_bottom=True, add_logo=False, width_full=-1, height_full=-1):
+def segment_distances(points):
     """
-    Fetch the street view images for the given path coordinates
+    Calculate the great circle distances between consecutive points, with the haversine formula
+    :param points: list or array of (lat, lng)
+    :return: numpy array with len(points) - 1 distances in meters
+    """
+    # Earth radius in meters
+    R = 6371000.0
+    lat, lng = np.radians(np.asarray(points, dtype=float).reshape(-1, 2)).T
+    a = (np.sin(np.diff(lat) / 2) ** 2 +
+         np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lng) / 2) ** 2)
+    return 2 * R * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def resample_path(points, num_points):
+    """
+    Resample a path to num_points points, evenly spaced by distance along the path. The first and last point are kept.
+    :param points: list of (lat, lng)
+    :param num_points: number of points to return
+    :return: list of num_points (lat, lng), empty if the path has no length
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) < 2 or num_points < 1:
+        return []
+    distances = segment_distances(points)
+    # Drop repeated points, the distances along the path have to be increasing for the interpolation
+    keep = np.concatenate([[True], distances > 0])
+    points = points[keep]
+    cumulative = np.concatenate([[0.0], np.cumsum(distances[distances > 0])])
+    if cumulative[-1] == 0:
+        return []
+
+    targets = np.linspace(0.0, cumulative[-1], num_points)
+    lat = np.interp(targets, cumulative, points[:, 0])
+    lng = np.interp(targets, cumulative, points[:, 1])
+    return list(zip(lat.tolist(), lng.tolist()))
+
+
+def calculate_headings(points):
+    """
+    Calculate the heading from every point towards the next point, for a whole path at once
+    :param points: list or array of (lat, lng)
+    :return: numpy array with len(points) - 1 headings in degrees
+    """
+    lat, lng = np.radians(np.asarray(points, dtype=float).reshape(-1, 2)).T
+    delta_lng = np.diff(lng)
+    x = np.sin(delta_lng) * np.cos(lat[1:])
+    y = np.cos(lat[:-1]) * np.sin(lat[1:]) - np.sin(lat[:-1]) * np.cos(lat[1:]) * np.cos(delta_lng)
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+def create_session(pool_size=8, retries=3, backoff_factor=0.5):
+    """
+    Create a requests session with a keep-alive connection pool that retries with backoff on 5xx and timeouts
+    :param pool_size: number of connections to keep open
+    :param retries: number of retries per request
+    :param backoff_factor: backoff factor between retries
+    :return: requests session
+    """
+    retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor,
+                  status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(["GET"]), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def street_view_cache_key(params, location_tolerance=1e-4, heading_bucket=5):
+    """
+    Create the cache key for a street view request. Locations are rounded to the tolerance (1e-4 degrees is about
+    11 meters) and headings to buckets, so neighbouring requests on overlapping routes share an entry.
+    :param params: street view request parameters
+    :param location_tolerance: tolerance in degrees
+    :param heading_bucket: bucket size in degrees
+    :return: cache key
+    """
+    lat, lng = (float(x) for x in str(params["location"]).split(","))
+    return make_key(
+        "streetview",
+        round(lat / location_tolerance),
+        round(lng / location_tolerance),
+        round(float(params["heading"]) / heading_bucket) % round(360 / heading_bucket),
+        params.get("size"),
+        str(params.get("fov")),
+        str(params.get("pitch")),
+        str(params.get("radius")),
+        params.get("source"),
+    )
+
+
+def street_view_cache(max_bytes=STREET_VIEW_CACHE_BYTES):
+    """
+    Get the shared on-disk street view image cache
+    :param max_bytes: byte budget of the cache
+    :return: DiskCache
+    """
+    return DiskCache(default_cache_dir("streetview"), max_bytes, suffix=".jpg")
+
+
+class StreetViewFetcher():
+    """
+    Fetches street view images concurrently over a pooled session. Results are returned in path order.
+    If a cache is given, images are looked up there first and only misses go to the network.
+    """
+
+    def __init__(self, workers=8, base_url=STREET_VIEW_URL, timeout=10, retries=3, backoff_factor=0.5, session=None,
+                 cache=None):
+        self.workers = workers
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = session if session is not None else create_session(workers, retries, backoff_factor)
+        self.cache = cache
+        self.frames_fetched = 0
+        self.frames_failed = 0
+        self.network_requests = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def fetch_one(self, params):
+        """
+        Fetch a single image
+        :param params: street view request parameters
+        :return: image bytes, or None if the image could not be fetched
+        """
+        if self.cache is not None:
+            cache_key = street_view_cache_key(params)
+            image_data = self.cache.get(cache_key)
+            if image_data is not None:
+                return image_data
+
+        with self._lock:
+            self.network_requests += 1
+        try:
+            response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"Failed to fetch image at {params.get('location')}: {e}")
+            return None
+        if response.status_code != 200:
+            print(f"Failed to fetch image at {params.get('location')}: status {response.status_code}")
+            return None
+        if self.cache is not None:
+            self.cache.put(cache_key, response.content)
+        return response.content
+
+    def fetch(self, frame_params):
+        """
+        Fetch the images concurrently
+        :param frame_params: list of (index, params) tuples
+        :return: generator of (index, image bytes or None), in the order of frame_params
+        """
+        indices = [index for index, _ in frame_params]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(self.fetch_one, [params for _, params in frame_params])
+            for index, image_data in zip(indices, results):
+                if image_data is None:
+                    self.frames_failed += 1
+                else:
+                    self.frames_fetched += 1
+                yield index, image_data
+        self.elapsed += time.perf_counter() - start
+
+    def frames_per_second(self):
+        """
+        Get the number of frames fetched per second
+        :return: frames per second
+        """
+        if self.elapsed == 0:
+            return 0.0
+        return self.frames_fetched / self.elapsed
+
+    def close(self):
+        self.session.close()
+
+
+class RouteFinder():
+    """
+    Searches a route to a destination that has enough points for a video. The destination is geocoded once, then
+    routes from start locations at many bearings and distances around it are requested concurrently. Every route is
+    resampled to the number of points of the video, so the search stops at the first route found, or at the longest
+    one with best=True, and never makes more than max_requests requests (one per start location by default)
+    or takes longer than time_budget seconds. Failed requests are not retried by default, there are other start
+    locations to try. Routes shorter than min_spacing meters per point of the video are not used.
+    """
+
+    def __init__(self, workers=8, max_requests=None, time_budget=60, bearings=12, radii=(8, 12, 5),
+                 base_url=DIRECTIONS_URL, api_key="", timeout=10, retries=0, backoff_factor=0.5, session=None,
+                 min_spacing=MIN_POINT_SPACING):
+        self.workers = workers
+        self.min_spacing = min_spacing
+        self.max_requests = max_requests
+        self.time_budget = time_budget
+        self.bearings = bearings
+        self.radii = radii
+        self.base_url = base_url
+        self.api_key = api_key if api_key != "" else os.environ.get('GOOGLE_API_KEY')
+        self.timeout = timeout
+        self.session = session if session is not None else create_session(workers, retries, backoff_factor)
+        self.requests_made = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def candidates(self, destination_coord):
+        """
+        Get the start locations to try, the bearings are rotated by a random offset for every search
+        :param destination_coord: (lat, lng) of the destination
+        :return: list of (lat, lng), bearings * len(radii) of them or at most max_requests
+        """
+        offset = np.random.uniform(0, 360 / self.bearings)
+        bearings = offset + np.arange(self.bearings) * 360 / self.bearings
+        return start_points(destination_coord, bearings, self.radii)[:self.max_requests]
+
+    def directions(self, start_coord, destination_coord, deadline):
+        """
+        Request the route from a start location to the destination
+        :param start_coord: (lat, lng) of the start
+        :param destination_coord: (lat, lng) of the destination
+        :param deadline: perf_counter time at which the search ends
+        :return: decoded route polyline, empty if there is no route
+        """
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return []
+        with self._lock:
+            self.requests_made += 1
+        params = {
+            'origin': f'{start_coord[0]},{start_coord[1]}',
+            'destination': f'{destination_coord[0]},{destination_coord[1]}',
+            'key': self.api_key
+        }
+        try:
+            response = self.session.get(self.base_url, params=params, timeout=min(self.timeout, remaining))
+        except requests.RequestException as e:
+            print(f"Failed to get directions from {start_coord}: {e}")
+            return []
+        if response.status_code != 200:
+            print(f"Failed to get directions from {start_coord}: status {response.status_code}")
+            return []
+        try:
+            directions = response.json()
+            if directions['status'] != "OK":
+                return []
+            return polyline.decode(directions['routes'][0]['overview_polyline']['points'])
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"Failed to read the directions from {start_coord}: {e}")
+            return []
+
+    def find(self, destination, num_points, destination_coord=None, best=False, progress=None):
+        """
+        Find a route to the destination
+        :param destination: city name
+        :param num_points: number of points in the path
+        :param destination_coord: (lat, lng) of the destination, geocoded from destination if not given
+        :param best: wait for all requests and pick the longest route, instead of the first one
+        :param progress: callback called with ("route", requests done, max_requests)
+        :return: list of num_points (lat, lng), empty if no usable route was found
+        """
+        if destination_coord is None:
+            destination_coord = get_coordinates_from_city(destination)
+
+        start = time.perf_counter()
+        deadline = start + self.time_budget
+        candidates = self.candidates(destination_coord)
+        best_path = []
+        # Shorter routes give near-identical images that are dropped as duplicates
+        min_length = max((num_points - 1) * self.min_spacing, 0)
+        best_length = 0.0
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            futures = [executor.submit(self.directions, start_coord, destination_coord, deadline)
+                       for start_coord in candidates]
+            for done, future in enumerate(as_completed(futures, timeout=self.time_budget), start=1):
+                if progress is not None:
+                    progress("route", done, len(futures))
+                full_path = future.result()
+                length = segment_distances(full_path).sum() if len(full_path) > 1 else 0.0
+                if length <= best_length:
+                    continue
+                if length < min_length:
+                    print(f"Skipping a {length:.0f} m route to {destination}, it needs at least {min_length:.0f} m")
+                    continue
+                best_path, best_length = full_path, length
+                if not best:
+                    break
+        except TimeoutError:
+            print(f"Route search for {destination} ran out of its {self.time_budget} second budget")
+        finally:
+            # Queued requests are dropped, the ones in flight end by the deadline at the latest
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.elapsed += time.perf_counter() - start
+
+        print(f"Route search for {destination}: {self.requests_made} requests in {time.perf_counter() - start:.1f}s")
+        if not best_path:
+            return []
+        return path_from_polyline(best_path, num_points)
+
+    def close(self):
+        self.session.close()
+
+
+def fetch_size(views):
+    """
+    Get the smallest street view image size that contains every view. The image of each view is cut out of the center
+    of the larger image, so a view narrower than the fetch size sees less to the sides than when it is fetched on its
+    own (about 94 instead of 120 degrees for the mobile view in a 630 pixel wide image).
+    :param views: list of view names, e.g. ["mobile", "desktop"]
+    :return: image size, e.g. "630x640"
+    """
+    width = max(VIEW_SIZES[view][0] for view in views)
+    height = max(VIEW_SIZES[view][1] for view in views)
+    return f"{width}x{height}"
+
+
+def crop_to_view(frame, view):
+    """
+    Cut the image of a view out of a frame fetched at fetch_size, and remove the strip with the Google logo at the
+    bottom like process_frame does
+    :param frame: BGR numpy array
+    :param view: view name
+    :return: BGR numpy array
+    """
+    view_width, view_height = VIEW_SIZES[view]
+    height, width = frame.shape[:2]
+    if width < view_width or height < view_height:
+        raise ValueError(f"A {width}x{height} frame is too small for the {view} view")
+    top = (height - view_height) // 2
+    left = (width - view_width) // 2
+    return frame[top:top + view_height - CROP_BOTTOM_PIXELS, left:left + view_width]
+
+
+def street_view_params(path_coordinates, size, api_key, stride=1):
+    """
+    Create the street view request parameters for every stride-th point on the path, facing the next of these points
+    :param path_coordinates: path coordinates
+    :param size: image size, e.g. "390x640"
+    :param api_key: google api key
+    :param stride: only create parameters for the points with an index that is a multiple of stride
+    :return: list of (index, params) tuples
+    """
+    indices = list(range(0, len(path_coordinates) - 1, stride))
+    if not indices:
+        return []
+    # Calculate the heading towards the next fetched point, for all points at once. The last one faces the end of
+    # the path.
+    headings = calculate_headings([path_coordinates[i] for i in indices] + [path_coordinates[-1]]).tolist()
+
+    frame_params = []
+    for i, heading in zip(indices, headings):
+        lat, lng = path_coordinates[i]
+
+        frame_params.append((i, {
+            "size": size,  # Image size
+            "fov": "120",  # Field of view
+            "radius": "100",  # How far away from the location to capture
+            "location": f"{lat},{lng}",
+            "heading": heading,  # Adjust if needed to face the direction of the path
+            "pitch": "0",
+            "source": "outdoor",  # Outdoor images only
+            "key": api_key
+        }))
+    return frame_params
+
+
+def frame_path_key(path_coordinates, stride=1):
+    """
+    Identify the frames of a path, they can only be reused for the same path and fetch stride
+    :param path_coordinates: path coordinates
+    :param stride: the fetch stride
+    :return: key stored in the frame status manifest
+    """
+    return make_key([list(point) for point in path_coordinates], stride)[:16]
+
+
+def load_frame_status(data_dir, path_key=None):
+    """
+    Load the per-index frame status manifest. Each entry maps the path index to its status
+    ("fetched", "gray", "duplicate" or "failed") and the number of attempts made.
+    :param data_dir: path to the data directory
+    :param path_key: only load the manifest if it was saved for this frame_path_key
+    :return: dict of index -> {"status": str, "attempts": int}
+    """
+    try:
+        with open(os.path.join(data_dir, FRAME_STATUS_FILE)) as f:
+            manifest = json.load(f)
+        if path_key is not None and manifest.get("path_key") != path_key:
+            return {}
+        return {int(index): entry for index, entry in manifest["frames"].items()}
+    except (FileNotFoundError, ValueError, KeyError, AttributeError):
+        return {}
+
+
+def save_frame_status(data_dir, frame_status, path_key=None):
+    """
+    Save the per-index frame status manifest. The file is replaced atomically so an interrupted run never leaves a
+    half-written manifest behind.
+    :param data_dir: path to the data directory
+    :param frame_status: dict of index -> {"status": str, "attempts": int}
+    :param path_key: frame_path_key of the path the frames belong to
+    :return: void
+    """
+    status_path = os.path.join(data_dir, FRAME_STATUS_FILE)
+    with open(status_path + ".tmp", "w") as f:
+        json.dump({"path_key": path_key,
+                   "frames": {str(index): entry for index, entry in sorted(frame_status.items())}}, f)
+    os.replace(status_path + ".tmp", status_path)
+
+
+def resume_frame_status(data_dir, path_key):
+    """
+    Load the frame status manifest to resume fetching the frames of a path. Frames and a manifest left behind for
+    another path or stride are removed first, so they never end up in the video of this one.
+    :param data_dir: path to the data directory
+    :param path_key: frame_path_key of the path
+    :return: dict of index -> {"status": str, "attempts": int}
+    """
+    frame_status = load_frame_status(data_dir, path_key)
+    frames_path = os.path.join(data_dir, "frames")
+    status_path = os.path.join(data_dir, FRAME_STATUS_FILE)
+    if not frame_status and (os.path.exists(frames_path) or os.path.exists(status_path)):
+        print("Removing the frames of another path")
+        shutil.rmtree(frames_path, ignore_errors=True)
+        try:
+            os.remove(status_path)
+        except FileNotFoundError:
+            pass
+    return frame_status
+
+
+def pending_frame_indices(frame_status, frames_folder, num_frames, stride=1):
+    """
+    Get the indices that still have to be fetched. Frames that were fetched (and are still on disk) or rejected as
+    gray or duplicate are done, everything else is pending.
+    :param frame_status: dict of index -> {"status": str, "attempts": int}
+    :param frames_folder: path to the frames folder
+    :param num_frames: total number of frames on the path
+    :param stride: only every stride-th frame is fetched
+    :return: list of indices
+    """
+    pending = []
+    for i in range(0, num_frames, stride):
+        status = frame_status.get(i, {}).get("status")
+        if status in ("gray", "duplicate"):
+            continue
+        if status == "fetched" and os.path.exists(os.path.join(frames_folder, f"{i}.jpg")):
+            continue
+        pending.append(i)
+    return pending
+
+
+def decode_image(image_data):
+    """
+    Decode a fetched image. This is the only time the image bytes are decoded.
+    :param image_data: image bytes
+    :return: RGB PIL image, or None if the bytes are not a valid image
+    """
+    try:
+        image = Image.open(BytesIO(image_data))
+        return image.convert("RGB")
+    except OSError:
+        return None
+
+
+def perceptual_hash(image):
+    """
+    Calculate the difference hash of an image: 64 bits telling if each pixel of a 9x8 grayscale thumbnail is
+    brighter than its right neighbour. Near-identical images have hashes that differ in only a few bits.
+    :param image: PIL image
+    :return: hash as an int
+    """
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(hash1, hash2):
+    """
+    Number of bits that differ between two hashes
+    :param hash1: first hash
+    :param hash2: second hash
+    :return: number of differing bits
+    """
+    return bin(hash1 ^ hash2).count("1")
+
+
+def process_frame(image, crop_bottom=True, add_logo=False, width_full=-1, height_full=-1, compositor=None):
+    """
+    Apply the crop, logo and border to a decoded image
+    :param image: PIL image
+    :param crop_bottom: crop the bottom of the image
+    :param add_logo: add a logo on top of the image
+    :param width_full: width of the image
+    :param height_full: height of the image
+    :param compositor: FrameCompositor to reuse between frames, one is created if not given
+    :return: PIL image
+    """
+    if compositor is None:
+        compositor = FrameCompositor()
+    if crop_bottom:
+        width, height = image.size
+        image = image.crop((0, 0, width, height - CROP_BOTTOM_PIXELS))
+    if add_logo:
+        image = compositor.add_logo(image)
+    if width_full != -1 and height_full != -1:
+        image = compositor.add_border(image, width_full, height_full)
+    return image
+
+
+def street_view_frames(path_coordinates, view="mobile", api_key="", crop_bottom=True, add_logo=False, width_full=-1,
+                       height_full=-1, fetcher=None, indices=None, drop_duplicates=True, batch_size=16, size=None,
+                       stride=1):
+    """
+    Fetch and process the street view images for the given path coordinates, in path order
     :param path_coordinates: path coordinates
-    :param image_path: path to save the images
     :param view: mobile or desktop
     :param api_key: google api key
     :param crop_bottom: crop the bottom of the image
     :param add_logo: add a logo on top of the image
     :param width_full: width of the image
     :param height_full: height of the image
-    :return:
+    :param fetcher: StreetViewFetcher to use, one is created if not given
+    :param indices: only fetch these path indices, all are fetched if not given
+    :param drop_duplicates: drop images that are near-duplicates of the previous image
+    :param batch_size: number of images to classify as gray at once
+    :param size: image size to fetch, e.g. "630x640", the size of the view if not given
+    :param stride: only fetch every stride-th point, video_creator.tween_frames synthesizes the frames in between
+    :return: generator of (index, status, PIL image or None), status is "fetched", "gray", "duplicate" or "failed"
     """
     if api_key == "":
         api_key = os.environ.get('GOOGLE_API_KEY')
 
-    size = "390x640" if view == "mobile" else "630x400"
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = StreetViewFetcher(cache=street_view_cache())
 
+    if size is None:
+        size = "{}x{}".format(*VIEW_SIZES["mobile" if view == "mobile" else "desktop"])
+
+    frame_params = street_view_params(path_coordinates, size, api_key, stride)
+    if indices is not None:
+        wanted = set(indices)
+        frame_params = [(i, params) for i, params in frame_params if i in wanted]
+
+    compositor = FrameCompositor()
+    results = fetcher.fetch(frame_params)
+    previous_hash = None
+    last_index = None
+    while True:
+        batch = [(i, decode_image(image_data) if image_data is not None else None)
+                 for i, image_data in itertools.islice(results, batch_size)]
+        if not batch:
+            break
+        gray = iter(is_gray_batch([image for _, image in batch if image is not None]))
+
+        for i, image in batch:
+            print(f"Fetched image {i + 1} of {len(path_coordinates) - 1}")
+            # Only compare with the previous image if it is the neighbouring point
+            if last_index is None or i != last_index + stride:
+                previous_hash = None
+            last_index = i
+
+            if image is None:
+                yield i, "failed", None
+                continue
+            if next(gray):
+                yield i, "gray", None
+                continue
+            if drop_duplicates:
+                image_hash = perceptual_hash(image)
+                if previous_hash is not None and hamming_distance(image_hash, previous_hash) <= DUPLICATE_DISTANCE:
+                    yield i, "duplicate", None
+                    continue
+                previous_hash = image_hash
+            yield i, "fetched", process_frame(image, crop_bottom, add_logo, width_full, height_full, compositor)
+
+    print(f"Fetched {fetcher.frames_fetched} frames at {fetcher.frames_per_second():.1f} frames per second")
+    if fetcher.cache is not None:
+        print(f"Street view cache: {fetcher.cache.stats()}")
+    if own_fetcher:
+        fetcher.close()
+
+
+def save_frame(image, frames_folder, index):
+    """
+    Save a frame as frames_folder/<index>.jpg. The frame is written to a temporary file first so an interrupted run
+    never leaves a truncated frame.
+    :param image: PIL image
+    :param frames_folder: path to the frames folder
+    :param index: path index of the frame
+    :return: void
+    """
+    frame_path = os.path.join(frames_folder, f"{index}.jpg")
+    image.save(frame_path + ".tmp", format="JPEG")
+    os.replace(frame_path + ".tmp", frame_path)
+
+
+def fetch_street_view_images(path_coordinates, image_path, view="mobile", api_key="", crop_bottom=True, add_logo=False,
+                             width_full=-1, height_full=-1, workers=8, fetcher=None, indices=None, frame_status=None,
+                             progress=None, size=None, stride=1, path_key=None):
+    """
+    Fetch the street view images for the given path coordinates
+    :param path_coordinates: path coordinates
+    :param image_path: path to save the images
+    :param view: mobile or desktop
+    :param api_key: google api key
+    :param crop_bottom: crop the bottom of the image
+    :param add_logo: add a logo on top of the image
+    :param width_full: width of the image
+    :param height_full: height of the image
+    :param workers: number of concurrent requests
+    :param fetcher: StreetViewFetcher to use, one is created if not given
+    :param indices: only fetch these path indices, all are fetched if not given
+    :param frame_status: status manifest to update, it is saved to image_path after every frame
+    :param progress: callback called with ("frames", done, total) after every frame
+    :param size: image size to fetch, the size of the view if not given
+    :param stride: only fetch every stride-th point
+    :param path_key: frame_path_key saved with frame_status
+    :return:
+    """
     frames_folder = os.path.join(image_path, 'frames')
 
     # Check if the frames folder exists, and create it if it doesn't
     if not os.path.exists(frames_folder):
         os.makedirs(frames_folder)
 
-    for i in range(len(path_coordinates) - 1):
-        print(f"Fetching image {i + 1} of {len(path_coordinates) - 1}")
-        lat, lng = path_coordinates[i]
-        next_lat, next_lng = path_coordinates[i + 1]
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = StreetViewFetcher(workers=workers, cache=street_view_cache())
 
-        # Calculate heading towards the next point
-        heading = calculate_heading(lat, lng, next_lat, next_lng)
+    total = len(indices) if indices is not None else len(range(0, len(path_coordinates) - 1, stride))
+    for done, (i, status, image) in enumerate(street_view_frames(path_coordinates, view, api_key, crop_bottom,
+                                                                 add_logo, width_full, height_full, fetcher, indices,
+                                                                 size=size, stride=stride),
+                                              start=1):
+        if image is not None:
+            save_frame(image, frames_folder, i)
+        if progress is not None:
+            progress("frames", done, total)
 
-        params = [{
-            "size": size,  # Image size
-            "fov": "120",  # Field of view
-            "radius": "100",  # How far away from the location to capture
-            "location": f"{lat},{lng}",
-            "heading": heading,  # Adjust if needed to face the direction of the path
-            "pitch": "0",
-            "source": "outdoor",  # Outdoor images only
-            "key": api_key
-        }]
-        results = google_streetview.api.results(params)
+        if frame_status is not None:
+            attempts = frame_status.get(i, {}).get("attempts", 0) + 1
+            frame_status[i] = {"status": status, "attempts": attempts}
+            save_frame_status(image_path, frame_status, path_key)
 
-        # Download the image
-        response = requests.get(results.links[0])
+    if own_fetcher:
+        fetcher.close()
 
-        if response.status_code == 200:
-            image_data = response.content
 
-            if not is_gray_image(image_data):
-                image = Image.open(BytesIO(image_data))
+def load_path_coordinates(data_dir):
+    """
+    Load the path coordinates saved by the quiz creator
+    :param data_dir: path to the data directory
+    :return: list of (lat, lng)
+    """
+    with open(os.path.join(data_dir, "path_coordinates.pkl"), "rb") as f:
+        return pickle.load(f)
 
-                if crop_bottom:
-                    width, height = image.size
-                    pixels = 30
-                    image = image.crop((0, 0, width, height - pixels))
-                if add_logo:
-                    image = add_logo_on_top(image)
-                if width_full != -1 and height_full != -1:
-                    image = add_boarder(image, width_full, height_full)
 
-                image.save(os.path.join(frames_folder, f"{i}.jpg"))
+def stream_new_frames(data_dir="/var/data", video_format="desktop", width=-1, height=-1, workers=8,
+                      save_frames=False, retries=2, fetch_stride=1):
+    """
+    Fetch the frames for the path in data_dir and stream them to the caller without a round trip over disk.
+    Each frame is decoded once and never re-encoded to JPEG.
+
+    Like create_new_frames the status of every frame is kept in the status manifest, a run resumes from it: frames
+    rejected as gray or duplicate are not fetched again and saved frames are read from disk. A failed frame is fetched
+    again, up to retries times, before the stream moves on. Once so many frames failed that less than half of the
+    path can be made, the stream raises right away instead of after the video is encoded.
+    :param data_dir: path to the data directory
+    :param video_format: mobile or desktop
+    :param width: width of the video
+    :param height: height of the video
+    :param workers: number of concurrent street view requests
+    :param save_frames: also write the frames to data_dir/frames, a later run reads them instead of fetching them
+    :param retries: number of times a failed frame is fetched again
+    :param fetch_stride: only fetch every fetch_stride-th point of the path, see video_creator.tween_frames
+    :return: generator of PIL images, in path order, with one item for every fetched point of the path. The item of a
+    point without a usable image (gray, duplicate or failed) is None, see video_creator.trim_frames.
+    """
+    path_coordinates = load_path_coordinates(data_dir)
+    path_key = frame_path_key(path_coordinates, fetch_stride)
+    frame_status = resume_frame_status(data_dir, path_key)
+
+    frames_path = os.path.join(data_dir, "frames")
+    if save_frames and not os.path.exists(frames_path):
+        os.makedirs(frames_path)
+
+    num_frames = len(path_coordinates) - 1
+    pending = pending_frame_indices(frame_status, frames_path, num_frames, fetch_stride)
+    max_failed = len(range(0, num_frames, fetch_stride)) - len(path_coordinates) / fetch_stride * 0.5
+    failed = 0
+
+    def frames(indices):
+        return street_view_frames(path_coordinates, video_format, width_full=width, height_full=height,
+                                  fetcher=fetcher, indices=indices, stride=fetch_stride)
+
+    fetcher = StreetViewFetcher(workers=workers, cache=street_view_cache())
+    fetched = frames(pending)
+    pending = set(pending)
+    try:
+        for i in range(0, num_frames, fetch_stride):
+            if i in pending:
+                _, status, image = next(fetched)
+                for _ in range(retries if status == "failed" else 0):
+                    [(_, status, image)] = list(frames([i]))
+                    if status != "failed":
+                        break
+                attempts = frame_status.get(i, {}).get("attempts", 0) + 1
+                frame_status[i] = {"status": status, "attempts": attempts}
+                save_frame_status(data_dir, frame_status, path_key)
+                if image is not None and save_frames:
+                    save_frame(image, frames_path, i)
+            else:
+                status = frame_status[i]["status"]
+                image = None
+                if status == "fetched":
+                    image = Image.open(os.path.join(frames_path, f"{i}.jpg")).convert("RGB")
+
+            if status == "failed":
+                failed += 1
+                if failed > max_failed:
+                    raise Exception("Failed to create frames")
+            # Dropped images stay in the stream as None, so the video can be trimmed by path position
+            yield image
+    finally:
+        fetched.close()
+        fetcher.close()
 
 
 def get_coordinates_from_city(city):
     """
-    Get the coordinates of a city
+    Get the coordinates of a city. Known cities come from the geocode index, others are geocoded with Nominatim and
+    added to it.
     :param city: city name
     :return: returns the latitude and longitude of the city
     """
-    base_url = "https://nominatim.openstreetmap.org/search"
-    params = {
-        'q': city,
-        'format': 'json'
-    }
-    response = requests.get(base_url, params=params)
-    if response.status_code == 200:
-        result = response.json()
-        if result:
-            return float(result[0]['lat']), float(result[0]['lon'])
-        else:
-            raise ValueError("No results found for the given city.")
-    else:
-        raise ConnectionError("Failed to connect to the Nominatim API.")
+    return geocode_index().lookup(city)
 
 
-def is_gray_image(image_path):
+def gray_scores(images, size=(64, 64)):
     """
-    Check if the image is predominantly gray.
-    @param image_path: path to the image
+    Score a batch of images on grayness. The score is the largest standard deviation of the color channels,
+    calculated on a small thumbnail of each image.
+    :param images: list of PIL images
+    :param size: size of the thumbnails
+    :return: numpy array with one score per image
     """
-    image = Image.open(BytesIO(image_path))
-    np_image = np.array(image)
+    if not images:
+        return np.zeros(0)
+    thumbnails = np.stack([np.asarray(image.convert("RGB").resize(size, Image.NEAREST)) for image in images])
+    # Calculate the standard deviation of the color channels, for all images at once
+    return thumbnails.reshape(len(images), -1, 3).std(axis=1).max(axis=1)
 
-    # Calculate the standard deviation of the color channels
-    std_dev = np_image.std(axis=(0, 1))
-    return all(x < 20 for x in std_dev)  # Threshold for grayness, might need adjustment
+
+def is_gray_batch(images, threshold=GRAY_THRESHOLD):
+    """
+    Check which images in a batch are predominantly gray
+    :param images: list of PIL images
+    :param threshold: threshold for grayness
+    :return: numpy array of bools
+    """
+    return gray_scores(images) < threshold
 
 
-def create_new_frames(data_dir="/var/data", video_format="desktop", width=-1, height=-1):
+def is_gray_image(image_path, threshold=GRAY_THRESHOLD):
+    """
+    Check if the image is predominantly gray.
+    @param image_path: image bytes or PIL image. Bytes are decoded at reduced resolution.
+    """
+    if isinstance(image_path, (bytes, bytearray)):
+        image = Image.open(BytesIO(image_path))
+        image.draft("RGB", (image.width // 4, image.height // 4))
+    else:
+        image = image_path
+    return bool(is_gray_batch([image], threshold)[0])
+
+
+def create_new_frames(data_dir="/var/data", video_format="desktop", width=-1, height=-1, workers=8, progress=None,
+                      views=None, fetch_stride=1):
     """
     Create new frames
     :param data_dir: path to the data directory
     :param video_format: mobile or desktop
     :param width: width of the video
     :param height: height of the video
+    :param workers: number of concurrent street view requests
+    :param progress: callback called with ("frames", done, total) as the frames come in
+    :param views: fetch the frames once for all these views instead, at fetch_size(views) and without cropping or
+    borders. video_creator.VideoVariant renders them for each view.
+    :param fetch_stride: only fetch every fetch_stride-th point of the path, the video synthesizes the frames in
+    between (see video_creator.tween_frames)
     :return: void
     """
-    with open(os.path.join(data_dir, "path_coordinates.pkl"), "rb") as f:
-        path_coordinates = pickle.load(f)
-    # Check if there is more than 100 files in the frames folder
+    path_coordinates = load_path_coordinates(data_dir)
+    # Resume from the status manifest, only the indices that are still missing are fetched
+    path_key = frame_path_key(path_coordinates, fetch_stride)
+    frame_status = resume_frame_status(data_dir, path_key)
+
     frames_path = os.path.join(data_dir, "frames")
     # Check if the frames folder exists, and create it if it doesn't
     if not os.path.exists(frames_path):
         os.makedirs(frames_path)
 
+    num_frames = len(path_coordinates) - 1
+    num_fetched = len(range(0, num_frames, fetch_stride))
+    min_files = len(path_coordinates) / fetch_stride * 0.5
+
+    fetcher = StreetViewFetcher(workers=workers, cache=street_view_cache())
     itr = 0
-    nbr_files = 0
-    while nbr_files < len(path_coordinates) * 0.5:
-        fetch_street_view_images(path_coordinates, data_dir, video_format, width_full=width, height_full=height)
-        nbr_files = len(os.listdir(os.path.join(data_dir, "frames")))
-        # if we have done this 10 times and still have less than 100 files, then we have a problem
+    pending = pending_frame_indices(frame_status, frames_path, num_frames, fetch_stride)
+    # Frames rejected as gray or duplicate are done too, a route with many similar images is not a failure
+    while num_fetched - len(pending) < min_files:
+        print(f"Fetching {len(pending)} missing frames")
+        frame_progress = None
+        if progress is not None:
+            already_done = num_fetched - len(pending)
+            frame_progress = lambda stage, done, total: progress(stage, already_done + done, num_fetched)
+        if views:
+            fetch_street_view_images(path_coordinates, data_dir, crop_bottom=False, fetcher=fetcher, indices=pending,
+                                     frame_status=frame_status, progress=frame_progress, size=fetch_size(views),
+                                     stride=fetch_stride, path_key=path_key)
+        else:
+            fetch_street_view_images(path_coordinates, data_dir, video_format, width_full=width, height_full=height,
+                                     fetcher=fetcher, indices=pending, frame_status=frame_status,
+                                     progress=frame_progress, stride=fetch_stride, path_key=path_key)
+        pending = pending_frame_indices(frame_status, frames_path, num_frames, fetch_stride)
+        # if we have done this 10 times and still have less than half of the frames, then we have a problem
         itr += 1
-        if itr > 10:
+        if num_fetched - len(pending) < min_files and itr > 10:
+            fetcher.close()
             raise Exception("Failed to create frames")
+    fetcher.close()
+    if not any(f.endswith(".jpg") for f in os.listdir(frames_path)):
+        raise Exception("Failed to create frames, there is no usable image on the path")
 
 
 def add_boarder(frame, final_width, final_height):
@@ -293,3 +1030,76 @@ def add_boarder(frame, final_width, final_height):
     final_image.paste(blurred_background, (0, 0))
     final_image.paste(frame, (border_width, border_height))
     return final_image
+
+
+class FrameCompositor():
+    """
+    Adds the logo and the blurred border to frames. Everything that only depends on the frame size (the resized
+    logo and its position) is prepared once and reused for all frames.
+
+    The blurred background of the border is calculated at 1/blur_scale of the final size and scaled up. With the
+    default scale of 4 the result differs from add_boarder by less than 1 on average and at most 8 (out of 255)
+    per pixel, at about a tenth of the cost, see benchmarks/bench_compositor.py.
+    """
+
+    def __init__(self, logo_path="./data/logo.png", blur_radius=15, blur_scale=4):
+        self.logo_path = logo_path
+        self.blur_radius = blur_radius
+        self.blur_scale = blur_scale
+        self._logo = None
+        self._logos = {}  # frame size -> (resized logo, position)
+
+    def prepare_logo(self, size):
+        """
+        Get the logo resized for a frame size, and where to paste it
+        :param size: (width, height) of the frame
+        :return: (logo, position)
+        """
+        if size not in self._logos:
+            if self._logo is None:
+                self._logo = Image.open(self.logo_path).convert("RGBA")
+            base_width, base_height = size
+            # Resize the logo to be a bit smaller than the width of the frame
+            logo_width = min(base_width - 20, self._logo.size[0])
+            logo_height = int((logo_width / self._logo.size[0]) * self._logo.size[1])
+            logo = self._logo.resize((logo_width, logo_height), Image.LANCZOS)
+            position = ((base_width - logo_width) // 2, (base_height // 3) - (logo_height // 3))
+            self._logos[size] = (logo, position)
+        return self._logos[size]
+
+    def add_logo(self, image):
+        """
+        Add the logo on top of the image
+        :param image: background image to add the logo on top of
+        :return: image with the logo on top
+        """
+        logo, position = self.prepare_logo(image.size)
+        image.paste(logo, position, logo)
+        return image
+
+    def blurred_background(self, frame, final_width, final_height):
+        """
+        Blur the frame and scale it to the final size. The blur is done at reduced resolution.
+        :param frame: PIL image
+        :param final_width: width of the background
+        :param final_height: height of the background
+        :return: PIL image
+        """
+        small_size = (max(1, final_width // self.blur_scale), max(1, final_height // self.blur_scale))
+        small = frame.resize(small_size, Image.BILINEAR).filter(
+            ImageFilter.GaussianBlur(self.blur_radius / self.blur_scale))
+        return small.resize((final_width, final_height), Image.BILINEAR)
+
+    def add_border(self, frame, final_width, final_height):
+        """
+        Place the frame, at 2/3 of the final size, on a blurred copy of itself
+        :param frame: PIL image
+        :param final_width: width of the final image
+        :param final_height: height of the final image
+        :return: PIL image
+        """
+        final_image = self.blurred_background(frame, final_width, final_height)
+        frame = frame.resize((int(final_width * 2 / 3), int(final_height * 2 / 3)))
+        frame_width, frame_height = frame.size
+        final_image.paste(frame, ((final_width - frame_width) // 2, (final_height - frame_height) // 2))
+        return final_image
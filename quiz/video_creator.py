@@ -1,16 +1,147 @@
 import os
 import cv2
+import json
+import queue
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import imageio_ffmpeg
+from datetime import datetime, timezone
+from PIL import Image
 from moviepy.editor import VideoFileClip, AudioFileClip, AudioClip, concatenate_audioclips, clips_array, CompositeAudioClip
 
+from quiz.street_view_collector import FrameCompositor, crop_to_view
 
-def images_to_video(folder, image_duration=0.4, frame_rate=24, video_codec=cv2.VideoWriter_fourcc(*'MP4V')):
+HLS_DIR = "hls"  # HLS renditions of a quiz, next to quiz.mp4
+HLS_MASTER = "master.m3u8"
+HLS_SEGMENT_SECONDS = 2
+TWEENS = ("dissolve", "zoom")  # How the frames between two fetched frames are synthesized
+
+_manifest_checksum_matches = {}  # (video path, mtime, size, sha256) -> whether the video has that checksum
+
+
+def prefetch(frames, maxsize=32):
     """
-    Creates a video from a folder of images
-    :param folder: path to the folder containing the images
+    Produce the frames on a background thread, through a bounded queue, so producing (fetching and compositing)
+    and consuming (encoding) overlap without holding more than maxsize frames in memory. When the consumer stops
+    early the producer stops too, and closes frames if it is a generator.
+    :param frames: iterable of frames
+    :param maxsize: maximum number of frames waiting in the queue
+    :return: generator of frames, in order
+    """
+    frame_queue = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Never block on a full queue once the consumer is gone
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for frame in frames:
+                if not put(("frame", frame)):
+                    return
+            put(("done", done))
+        except Exception as e:
+            put(("error", e))
+        finally:
+            # Let the source release what it holds, e.g. the fetcher of street_view_collector.stream_new_frames
+            close = getattr(frames, "close", None)
+            if close is not None:
+                close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            kind, item = frame_queue.get()
+            if kind == "error":
+                raise item
+            if kind == "done":
+                break
+            yield item
+    finally:
+        stop.set()
+
+
+def to_bgr(frame):
+    """
+    Convert a frame to the BGR array layout used by cv2
+    :param frame: PIL image (RGB) or BGR numpy array
+    :return: BGR numpy array
+    """
+    if isinstance(frame, np.ndarray):
+        return frame
+    return np.ascontiguousarray(np.asarray(frame.convert("RGB"))[:, :, ::-1])
+
+
+def frames_to_video(frames, video_path, image_duration=0.4, frame_rate=24,
+                    video_codec=cv2.VideoWriter_fourcc(*'MP4V')):
+    """
+    Creates a video from an iterable of frames
+    :param frames: iterable of PIL images or BGR numpy arrays
+    :param video_path: path of the video to write
     :param image_duration: in seconds
     :param frame_rate: frames per second
     :param video_codec: what codec to use for the video
-    :return:
+    :return: number of images written
+    """
+    out = None
+    height = width = 0
+    frame_count = int(frame_rate * image_duration)
+    nbr_images = 0
+
+    try:
+        for frame in frames:
+            frame = to_bgr(frame)
+            if out is None:
+                # Use the first frame to get the size
+                height, width = frame.shape[:2]
+                out = cv2.VideoWriter(video_path, video_codec, frame_rate, (width, height))
+
+            # Check if image sizes are consistent
+            if frame.shape[0] != height or frame.shape[1] != width:
+                raise ValueError(f"Image size of frame {nbr_images} does not match the first image size")
+
+            # Write the frame multiple times to meet the desired duration per image
+            for _ in range(frame_count):
+                out.write(frame)
+            nbr_images += 1
+    finally:
+        if out is not None:
+            out.release()
+
+    if nbr_images == 0:
+        raise ValueError("No images found in the folder")
+    return nbr_images
+
+
+def read_frames(frame_folder, sorted_filenames):
+    """
+    Read frames from disk
+    :param frame_folder: path to the folder containing the images
+    :param sorted_filenames: the image filenames, in order
+    :return: generator of BGR numpy arrays
+    """
+    for filename in sorted_filenames:
+        yield cv2.imread(os.path.join(frame_folder, filename))
+
+
+def load_frames(folder):
+    """
+    Load the frames in folder/frames, in path order
+    :param folder: path to the folder containing the frames folder
+    :return: (generator of BGR numpy arrays, number of frames)
     """
     frame_folder = os.path.join(folder, "frames")
     # Get sorted list of image filenames
@@ -19,40 +150,712 @@ def images_to_video(folder, image_duration=0.4, frame_rate=24, video_codec=cv2.V
 
     if not sorted_filenames:
         raise ValueError("No images found in the folder")
+    return read_frames(frame_folder, sorted_filenames), len(sorted_filenames)
+
+
+def images_to_video(folder, image_duration=0.4, frame_rate=24, video_codec=cv2.VideoWriter_fourcc(*'MP4V'),
+                    frames=None):
+    """
+    Creates a video from a folder of images
+    :param folder: path to the folder containing the images
+    :param image_duration: in seconds
+    :param frame_rate: frames per second
+    :param video_codec: what codec to use for the video
+    :param frames: stream these frames instead of reading folder/frames from disk
+    :return:
+    """
+    if frames is None:
+        frames, _ = load_frames(folder)
+    else:
+        frames = prefetch(frames)
+
+    frames_to_video(frames, os.path.join(folder, "quiz_no_audio.mp4"), image_duration, frame_rate, video_codec)
+
+
+def zoom_indices(height, width, scales):
+    """
+    Get the source rows and columns of zooms into the center of an image, for several scales at once
+    :param height: height of the image
+    :param width: width of the image
+    :param scales: array of zoom factors, 1 is the image itself
+    :return: (rows, cols), int arrays of shape (len(scales), height) and (len(scales), width)
+    """
+    center_y, center_x = (height - 1) / 2, (width - 1) / 2
+    rows = np.rint(center_y + (np.arange(height) - center_y) / scales[:, None]).astype(np.intp)
+    cols = np.rint(center_x + (np.arange(width) - center_x) / scales[:, None]).astype(np.intp)
+    return rows, cols
+
+
+def synthesize_frames(frame_a, frame_b, count, tween="dissolve", zoom=0.15):
+    """
+    Synthesize the frames between two fetched frames, all of them at once. "dissolve" blends from frame_a to frame_b,
+    "zoom" also zooms into the center of frame_a while blending. The camera faces the next fetched point, so the
+    center is where the car drives to.
+    :param frame_a: BGR numpy array
+    :param frame_b: BGR numpy array of the same size
+    :param count: number of frames to synthesize
+    :param tween: "dissolve" or "zoom"
+    :param zoom: how much frame_a is zoomed in when it is fully blended into frame_b
+    :return: uint8 array of shape (count, height, width, 3)
+    """
+    if frame_a.shape != frame_b.shape:
+        raise ValueError(f"Can not synthesize frames between a {frame_a.shape} and a {frame_b.shape} frame")
+    t = np.arange(1, count + 1) / (count + 1)
+    # Blend in 8 bit fixed point, uint16 holds 255 * 256
+    weights = np.rint(t * 256).astype(np.uint16)[:, None, None, None]
+    if tween == "zoom":
+        rows, cols = zoom_indices(frame_a.shape[0], frame_a.shape[1], 1 + zoom * t)
+        start = frame_a[rows[:, :, None], cols[:, None, :]]
+    elif tween == "dissolve":
+        start = frame_a[None]
+    else:
+        raise ValueError(f"Unknown tween {tween}, the tweens are {', '.join(TWEENS)}")
+    blended = (start.astype(np.uint16) * (256 - weights) + frame_b.astype(np.uint16) * weights) >> 8
+    return blended.astype(np.uint8)
+
+
+def tween_frames(frames, nbr_frames, stride, tween="dissolve", zoom=0.15):
+    """
+    Fill in the frames of the points that were not fetched, see street_view_collector.create_new_frames(fetch_stride)
+    :param frames: iterable of PIL images or BGR numpy arrays, every stride-th point of the path. None stands for a
+    dropped image, the previous image is held for it and for the frames up to it (see trim_frames).
+    :param nbr_frames: number of frames expected in frames
+    :param stride: the fetch stride, stride - 1 frames are synthesized between two fetched frames
+    :param tween: how to synthesize the frames, see synthesize_frames
+    :param zoom: zoom of the "zoom" tween
+    :return: (generator of BGR numpy arrays, number of frames with the synthesized ones)
+    """
+    if stride <= 1:
+        return frames, nbr_frames
+    if tween not in TWEENS:
+        raise ValueError(f"Unknown tween {tween}, the tweens are {', '.join(TWEENS)}")
+
+    def generate():
+        previous = None
+        first = True
+        for frame in frames:
+            if frame is None:
+                # A dropped image of a stream, trim_frames holds the previous image for it and the frames before it
+                yield from [None] * (1 if first else stride)
+            else:
+                frame = to_bgr(frame)
+                if previous is not None:
+                    yield from synthesize_frames(previous, frame, stride - 1, tween, zoom)
+                elif not first:
+                    yield from [None] * (stride - 1)
+                yield frame
+                previous = frame
+            first = False
+
+    return generate(), nbr_frames + max(0, nbr_frames - 1) * (stride - 1)
+
+
+def get_manifest_path(video_path):
+    """
+    Get the path of the manifest that belongs to a video, e.g. quiz.mp4 -> quiz_manifest.json
+    :param video_path: path to the video file
+    :return: path to the manifest file
+    """
+    return os.path.splitext(video_path)[0] + "_manifest.json"
+
+
+def file_checksum(file_path, block_size=1 << 20):
+    """
+    Calculate the sha256 checksum of a file without loading it into memory
+    :param file_path: path to the file
+    :param block_size: number of bytes to read at a time
+    :return: hex digest
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def write_video_manifest(video_path, duration):
+    """
+    Write a small manifest next to the video so that the server never has to open the video to know its duration
+    :param video_path: path to the video file
+    :param duration: duration of the video in seconds
+    :return: the manifest as a dict
+    """
+    manifest = {
+        "video": os.path.basename(video_path),
+        "duration": float(duration),
+        "size": os.path.getsize(video_path),
+        "sha256": file_checksum(video_path),
+        "built_at": datetime.now(timezone.utc).isoformat(),
+    }
+    manifest_path = get_manifest_path(video_path)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def read_video_manifest(video_path):
+    """
+    Read the manifest of a video
+    :param video_path: path to the video file
+    :return: the manifest as a dict, or None if there is no manifest
+    """
+    try:
+        with open(get_manifest_path(video_path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def read_valid_video_manifest(video_path):
+    """
+    Read the manifest of a video if it still belongs to the video. A manifest is written after its video, so a video
+    that was modified after built_at (e.g. a re-encode of the same size) is compared with the checksum, once per
+    modification time and size.
+    :param video_path: path to the video file
+    :return: the manifest as a dict, or None if there is no manifest or it belongs to another build
+    """
+    manifest = read_video_manifest(video_path)
+    if manifest is None:
+        return None
+    stat = os.stat(video_path)
+    if manifest.get("size") != stat.st_size:
+        return None
+    try:
+        if stat.st_mtime <= datetime.fromisoformat(manifest["built_at"]).timestamp():
+            return manifest
+    except (KeyError, TypeError, ValueError):
+        pass
+    key = (video_path, stat.st_mtime_ns, stat.st_size, manifest.get("sha256"))
+    if key not in _manifest_checksum_matches:
+        _manifest_checksum_matches[key] = file_checksum(video_path) == manifest.get("sha256")
+    return manifest if _manifest_checksum_matches[key] else None
+
+
+def mix_audio(data_dir, out_path, add_music=True):
+    """
+    Mix the quiz audio with the background music into a lossless wav file
+    :param data_dir: path to the data directory containing quiz.mp3
+    :param out_path: path of the wav file to write
+    :param add_music: whether to add the background music
+    :return: duration of the audio in seconds
+    """
+    audio_clip = AudioFileClip(os.path.join(data_dir, "quiz.mp3"))
+    audio_duration = audio_clip.duration
+
+    if add_music:
+        # Load the music file and adjust its duration to match the audio
+        music_clip = AudioFileClip("./static/music.mp3").set_duration(audio_duration)
+        # Mix the original audio with the music
+        audio_clip = CompositeAudioClip([audio_clip, music_clip.volumex(0.25)])  # Adjust volume of music as needed
+
+    audio_clip.write_audiofile(out_path, fps=44100, codec="pcm_s16le", logger=None)
+    audio_clip.close()
+    return audio_duration
+
+
+class VideoVariant():
+    """
+    One video of a build. All the variants of a build are rendered from the same frames and the same audio mix.
 
-    # Read the first image to get the size
-    first_image = cv2.imread(os.path.join(frame_folder, sorted_filenames[0]))
-    height, width, layers = first_image.shape
+    A variant with a view (mobile or desktop) cuts the image of that view out of frames fetched for several views.
+    With a width and height the image is placed on a blurred border of that size. crf and max_kbps set the x264 rate,
+    the video is written to file_name, quiz_<name>.mp4 if not given.
+    """
+
+    def __init__(self, name, view=None, width=-1, height=-1, crf=23, max_kbps=None, file_name=""):
+        self.name = name
+        self.view = view
+        self.width = width
+        self.height = height
+        self.crf = crf
+        self.max_kbps = max_kbps
+        self.file_name = file_name if file_name != "" else f"quiz_{name}.mp4"
+
+    def render(self, frame, compositor):
+        """
+        Render a frame for this variant
+        :param frame: PIL image (RGB) or BGR numpy array
+        :param compositor: FrameCompositor of the thread rendering this variant
+        :return: BGR numpy array
+        """
+        if self.view is None and self.width == -1:
+            return to_bgr(frame)
+        frame = to_bgr(frame)
+        if self.view is not None:
+            frame = crop_to_view(frame, self.view)
+        if self.width != -1 and self.height != -1:
+            image = Image.fromarray(np.ascontiguousarray(frame[:, :, ::-1]))
+            return to_bgr(compositor.add_border(image, self.width, self.height))
+        return np.ascontiguousarray(frame)
+
+    def rate_args(self):
+        """
+        Get the x264 rate control arguments for ffmpeg
+        :return: list of arguments
+        """
+        args = ["-crf", str(self.crf)]
+        if self.max_kbps is not None:
+            args += ["-maxrate", f"{self.max_kbps}k", "-bufsize", f"{2 * self.max_kbps}k"]
+        return args
+
+
+# The variants a build can render by name. desktop is the video the server plays.
+VARIANTS = {variant.name: variant for variant in [
+    VideoVariant("desktop", "desktop", file_name="quiz.mp4"),
+    VideoVariant("desktop_low", "desktop", crf=30, max_kbps=400),
+    VideoVariant("mobile", "mobile", 1080, 1920),
+]}
 
-    # Define the codec and create VideoWriter object
-    out = cv2.VideoWriter(os.path.join(folder, "quiz_no_audio.mp4"), video_codec, frame_rate, (width, height))
 
+def get_variants(variants):
+    """
+    Look up variants by name
+    :param variants: list of variant names or VideoVariant
+    :return: list of VideoVariant
+    """
+    try:
+        return [VARIANTS[variant] if isinstance(variant, str) else variant for variant in variants]
+    except KeyError as e:
+        raise ValueError(f"Unknown video variant {e}, the variants are {', '.join(VARIANTS)}")
+
+
+def build_variants(variants, hls_variants=()):
+    """
+    Get the variants a build renders, checked before anything is fetched
+    :param variants: names of the variants to render
+    :param hls_variants: names of the variants to package for HLS, they are rendered as well
+    :return: list of variant names
+    """
+    names = list(variants) + [name for name in hls_variants if name not in variants]
+    get_variants(names)
+    if "desktop" not in names:
+        raise ValueError("The desktop variant is required, it writes the quiz.mp4 the server plays")
+    return names
+
+
+def target_frame_count(nbr_images, audio_duration, image_duration=0.4, frame_rate=24):
+    """
+    Get the number of video frames of the video, it ends together with the audio
+    :param nbr_images: number of images
+    :param audio_duration: duration of the audio in seconds
+    :param image_duration: in seconds
+    :param frame_rate: frames per second
+    :return: number of frames
+    """
+    return min(nbr_images * int(frame_rate * image_duration), int(round(audio_duration * frame_rate)))
+
+
+def trim_frames(frames, nbr_images, audio_duration, image_duration=0.4, frame_rate=24):
+    """
+    Decide how often each image is written. Like the subclip in the two pass version, the start of the video is
+    trimmed so that it ends together with the audio, but the trimmed images are skipped before they reach an encoder.
+    :param frames: iterable of frames. None stands for an image that could not be made, the image before it is held
+    for its time (the first image if it is at the start), so the trim stays exact when images are dropped on the way.
+    :param nbr_images: number of images expected in frames, used to calculate how much to trim. If fewer images
+    arrive, the last image is held until the audio ends.
+    :param audio_duration: duration of the audio in seconds
+    :param image_duration: in seconds
+    :param frame_rate: frames per second
+    :return: generator of (frame, number of video frames to write it for)
+    """
     frame_count = int(frame_rate * image_duration)
+    # Keep the last audio_duration seconds of the video, like subclip(video_duration - audio_duration, video_duration)
+    target_frames = target_frame_count(nbr_images, audio_duration, image_duration, frame_rate)
+    skip_frames = nbr_images * frame_count - target_frames
 
-    for filename in sorted_filenames:
-        frame = cv2.imread(os.path.join(frame_folder, filename))
+    last_frame = None
+    last_repeats = 0
+    held = 0
+    skipped = 0
+    written = 0
+    for frame in frames:
+        if written >= target_frames:
+            break
+        # Skip the whole image without converting it if all its repeats are trimmed
+        if skipped + frame_count <= skip_frames:
+            skipped += frame_count
+            continue
+        repeats = min(frame_count - (skip_frames - skipped), target_frames - written)
+        skipped = skip_frames
+        written += repeats
+        # The image is yielded once the next one arrives, a missing image adds its time to the one before it
+        if frame is None:
+            if last_frame is None:
+                held += repeats
+            else:
+                last_repeats += repeats
+            continue
+        if last_frame is not None:
+            yield last_frame, last_repeats
+        last_frame = frame
+        last_repeats = held + repeats
+        held = 0
+
+    if last_frame is None:
+        raise ValueError("No images left to encode after trimming")
+
+    # Hold the last image if fewer images than expected arrived
+    yield last_frame, last_repeats + target_frames - written
+
+
+class VariantEncoder():
+    """
+    Renders the frames of one variant and pipes them into its own ffmpeg process, on its own thread, so that the
+    variants of a build are rendered and encoded side by side.
+    """
+
+    def __init__(self, variant, video_path, audio_path, frame_rate=24, preset="medium", maxsize=8,
+                 keyframe_seconds=None):
+        self.variant = variant
+        self.keyframe_seconds = keyframe_seconds
+        self.video_path = video_path
+        self.audio_path = audio_path
+        self.frame_rate = frame_rate
+        self.preset = preset
+        self.process = None
+        self.error = None
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _start_process(self, width, height):
+        keyframe_args = []
+        if self.keyframe_seconds is not None:
+            # Segments can only start at a keyframe
+            keyframe_args = ["-force_key_frames", f"expr:gte(t,n_forced*{self.keyframe_seconds})"]
+        command = [
+            imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(self.frame_rate), "-i", "-",
+            "-i", self.audio_path,
+            "-map", "0:v:0", "-map", "1:a:0",
+            "-c:v", "libx264", "-preset", self.preset, *self.variant.rate_args(), "-pix_fmt", "yuv420p",
+            *keyframe_args,
+            "-c:a", "aac",
+            "-shortest",
+            "-movflags", "+faststart",  # moov atom first, so playback starts before the download finishes
+            self.video_path,
+        ]
+        return subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def _run(self):
+        compositor = FrameCompositor()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                frame, repeats = item
+                frame = self.variant.render(frame, compositor)
+                if self.process is None:
+                    self.process = self._start_process(frame.shape[1], frame.shape[0])
+                frame_bytes = frame.tobytes()
+                for _ in range(repeats):
+                    self.process.stdin.write(frame_bytes)
+
+            if self.process is None:
+                raise ValueError(f"No frames to encode for {self.video_path}")
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed to encode {self.video_path}")
+        except Exception as e:
+            self.error = e
+            # Keep taking frames so that put never blocks
+            while item is not None:
+                item = self._queue.get()
 
-        # Check if image sizes are consistent
-        if frame.shape[0] != height or frame.shape[1] != width:
-            raise ValueError(f"Image size for {filename} does not match the first image size")
+    def put(self, frame, repeats):
+        """
+        Queue a frame, waits while the encoder is maxsize frames behind
+        :param frame: PIL image or BGR numpy array
+        :param repeats: number of video frames to write it for
+        :return: void
+        """
+        self._queue.put((frame, repeats))
+
+    def close(self, abort=False):
+        """
+        Wait for the encoder to write the video
+        :param abort: stop the encoder without waiting for the video
+        :return: void
+        """
+        if abort and self.process is not None:
+            self.process.kill()
+        self._queue.put(None)
+        self._thread.join()
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.error is not None and not abort:
+            raise self.error
+
+
+def encode_variants(frames, nbr_images, audio_path, audio_duration, outputs, image_duration=0.4, frame_rate=24,
+                    preset="medium", progress=None, keyframe_seconds=None):
+    """
+    Encode several variants of a video from the same frames and the same audio in a single pass. Every frame is
+    decoded once and handed to one encoder per variant.
+    :param frames: iterable of PIL images or BGR numpy arrays
+    :param nbr_images: number of images expected in frames, see trim_frames
+    :param audio_path: path to the final audio
+    :param audio_duration: duration of the audio in seconds
+    :param outputs: list of (VideoVariant, path of the video to write)
+    :param image_duration: in seconds
+    :param frame_rate: frames per second
+    :param preset: x264 preset
+    :param progress: callback called with ("encoding", done, total) after every image, counted in video frames
+    :param keyframe_seconds: put a keyframe at least every keyframe_seconds, so the videos can be cut into segments
+    of that length without re-encoding
+    :return: duration of the videos in seconds
+    """
+    target_frames = target_frame_count(nbr_images, audio_duration, image_duration, frame_rate)
+    encoders = [VariantEncoder(variant, video_path, audio_path, frame_rate, preset, keyframe_seconds=keyframe_seconds)
+                for variant, video_path in outputs]
+    written = 0
+    aborted = True
+    errors = []
+    try:
+        for frame, repeats in trim_frames(frames, nbr_images, audio_duration, image_duration, frame_rate):
+            for encoder in encoders:
+                encoder.put(frame, repeats)
+            written += repeats
+            if progress is not None:
+                progress("encoding", written, target_frames)
+        aborted = False
+    finally:
+        # Close every encoder, also when one of them fails, so no ffmpeg process is left behind
+        for encoder in encoders:
+            try:
+                encoder.close(abort=aborted)
+            except Exception as e:
+                errors.append(e)
+
+    if errors:
+        raise errors[0]
+    return min(written / frame_rate, audio_duration)
+
+
+def encode_video(frames, nbr_images, audio_path, audio_duration, video_path, image_duration=0.4, frame_rate=24,
+                 preset="medium", crf=23, progress=None):
+    """
+    Encode the frames and the audio into a libx264/aac video in a single pass. Like the subclip in the two pass
+    version, the start of the video is trimmed so that it ends together with the audio, but the trimmed frames are
+    skipped before they reach the encoder.
+    :param frames: iterable of PIL images or BGR numpy arrays
+    :param nbr_images: number of images expected in frames, used to calculate how much to trim. If fewer images
+    arrive, the last image is held until the audio ends.
+    :param audio_path: path to the final audio
+    :param audio_duration: duration of the audio in seconds
+    :param video_path: path of the video to write
+    :param image_duration: in seconds
+    :param frame_rate: frames per second
+    :param preset: x264 preset
+    :param crf: x264 constant rate factor
+    :param progress: callback called with ("encoding", done, total) after every image, counted in video frames
+    :return: duration of the video in seconds
+    """
+    variant = VideoVariant(os.path.splitext(os.path.basename(video_path))[0], crf=crf)
+    return encode_variants(frames, nbr_images, audio_path, audio_duration, [(variant, video_path)], image_duration,
+                           frame_rate, preset, progress)
+
+
+def create_new_video(data_dir="/var/data/", out_dir="", add_music=True, frames=None, nbr_images=None,
+                     image_duration=0.4, frame_rate=24, progress=None, fetch_stride=1, tween="dissolve"):
+    """
+    Creates a new video from the images in the data_dir, encoding video and audio in a single pass
+    :param data_dir: path to the data directory
+    :param out_dir: path to the output directory
+    :param add_music: whether to add background music to the video
+    :param frames: stream these frames straight into the encoder instead of reading data_dir/frames
+    :param nbr_images: number of images expected in frames, required when frames is given
+    :param image_duration: in seconds
+    :param frame_rate: frames per second
+    :param progress: callback called with the stage ("audio" or "encoding") and, while encoding, done and total
+    :param fetch_stride: the frames were fetched for every fetch_stride-th point, synthesize the ones in between
+    :param tween: how to synthesize the frames in between, see TWEENS
+    :return:
+    """
+    streamed = frames is not None
+    if not streamed:
+        frames, nbr_images = load_frames(data_dir)
+    elif nbr_images is None:
+        raise ValueError("nbr_images is required when streaming frames")
+
+    frames, nbr_images = tween_frames(frames, nbr_images, fetch_stride, tween)
+    if streamed or fetch_stride > 1:
+        frames = prefetch(frames)
+
+    if out_dir == "":
+        out_dir = data_dir
+    video_path = os.path.join(out_dir, "quiz.mp4")
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        audio_path = os.path.join(tmp_dir, "quiz_mix.wav")
+        if progress is not None:
+            progress("audio")
+        audio_duration = mix_audio(data_dir, audio_path, add_music)
+        duration = encode_video(frames, nbr_images, audio_path, audio_duration, video_path, image_duration,
+                                frame_rate, progress=progress)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    write_video_manifest(video_path, duration)
+
+
+def create_video_variants(data_dir="/var/data/", out_dir="", variants=("desktop",), add_music=True, image_duration=0.4,
+                          frame_rate=24, progress=None, hls_variants=(), fetch_stride=1, tween="dissolve"):
+    """
+    Creates several videos from the frames in data_dir, fetched once for all of them with
+    street_view_collector.create_new_frames(views=...). The frames are read and the audio is mixed once, and all the
+    variants are encoded in a single pass.
+    :param data_dir: path to the data directory
+    :param out_dir: path to the output directory
+    :param variants: list of variant names (see VARIANTS) or VideoVariant
+    :param add_music: whether to add background music to the videos
+    :param image_duration: in seconds
+    :param frame_rate: frames per second
+    :param progress: callback called with the stage ("audio", "encoding" or "hls") and, while encoding, done and total
+    :param hls_variants: names of the variants to also package as the renditions of an HLS stream in out_dir/hls,
+    they should have the same view
+    :param fetch_stride: the frames were fetched for every fetch_stride-th point, synthesize the ones in between
+    :param tween: how to synthesize the frames in between, see TWEENS
+    :return: dict of variant name -> path of the video
+    """
+    variants = get_variants(variants)
+    hls_variants = list(hls_variants)
+    missing = set(hls_variants) - {variant.name for variant in variants}
+    if missing:
+        raise ValueError(f"The HLS variants {', '.join(sorted(missing))} are not rendered")
+    frames, nbr_images = load_frames(data_dir)
+    # The frames in between are synthesized on the prefetch thread, while the encoders work
+    frames, nbr_images = tween_frames(frames, nbr_images, fetch_stride, tween)
+
+    if out_dir == "":
+        out_dir = data_dir
+    outputs = [(variant, os.path.join(out_dir, variant.file_name)) for variant in variants]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        audio_path = os.path.join(tmp_dir, "quiz_mix.wav")
+        if progress is not None:
+            progress("audio")
+        audio_duration = mix_audio(data_dir, audio_path, add_music)
+        duration = encode_variants(prefetch(frames), nbr_images, audio_path, audio_duration, outputs, image_duration,
+                                   frame_rate, progress=progress,
+                                   keyframe_seconds=HLS_SEGMENT_SECONDS if hls_variants else None)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for _, video_path in outputs:
+        write_video_manifest(video_path, duration)
+    videos = {variant.name: video_path for variant, video_path in outputs}
+
+    if hls_variants:
+        if progress is not None:
+            progress("hls")
+        package_hls({name: videos[name] for name in hls_variants}, os.path.join(out_dir, HLS_DIR))
+    return videos
+
+
+def read_hls_playlist(playlist_path):
+    """
+    Read the segments of a media playlist
+    :param playlist_path: path to the index.m3u8 of a rendition
+    :return: list of (duration in seconds, segment file name)
+    """
+    segments = []
+    duration = None
+    with open(playlist_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line and not line.startswith("#") and duration is not None:
+                segments.append((duration, line))
+                duration = None
+    return segments
+
+
+def hls_rendition(name, rendition_dir, video_path):
+    """
+    Get what the master playlist needs to know about a rendition
+    :param name: name of the rendition
+    :param rendition_dir: path to the directory with index.m3u8 and the segments
+    :param video_path: path to the video the rendition was cut from
+    :return: dict with name, bandwidth (peak of the segments, in bit/s), average_bandwidth and resolution
+    """
+    segments = read_hls_playlist(os.path.join(rendition_dir, "index.m3u8"))
+    if not segments:
+        raise ValueError(f"The {name} rendition has no segments")
+    sizes = [os.path.getsize(os.path.join(rendition_dir, segment)) for _, segment in segments]
+    bandwidths = [size * 8 / max(duration, 1e-3) for size, (duration, _) in zip(sizes, segments)]
+    total_duration = sum(duration for duration, _ in segments)
+
+    capture = cv2.VideoCapture(video_path)
+    resolution = f"{int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))}"
+    capture.release()
+    return {"name": name, "bandwidth": int(max(bandwidths)),
+            "average_bandwidth": int(sum(sizes) * 8 / max(total_duration, 1e-3)), "resolution": resolution}
+
+
+def package_hls(videos, hls_dir, segment_seconds=HLS_SEGMENT_SECONDS):
+    """
+    Cut videos into the renditions of an HLS stream without re-encoding them, and write the master playlist. The
+    videos need a keyframe every segment_seconds, see encode_variants. The renditions are listed from the lowest
+    bandwidth up, players start with the first one so the first frame shows up quickly on slow links.
+    The stream is written next to hls_dir and moved into place when it is complete.
+    :param videos: dict of rendition name -> path of the video
+    :param hls_dir: directory to write the stream to, hls_dir/master.m3u8 and hls_dir/<name>/index.m3u8
+    :param segment_seconds: target duration of the segments
+    :return: path to the master playlist
+    """
+    tmp_dir = f"{hls_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    try:
+        renditions = []
+        for name, video_path in videos.items():
+            rendition_dir = os.path.join(tmp_dir, name)
+            os.makedirs(rendition_dir)
+            command = [
+                imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+                "-i", video_path, "-c", "copy",
+                "-f", "hls", "-hls_time", str(segment_seconds), "-hls_playlist_type", "vod",
+                "-hls_segment_filename", os.path.join(rendition_dir, "%03d.ts"),
+                os.path.join(rendition_dir, "index.m3u8"),
+            ]
+            if subprocess.run(command).returncode != 0:
+                raise RuntimeError(f"ffmpeg failed to cut {video_path} into segments")
+            renditions.append(hls_rendition(name, rendition_dir, video_path))
 
-        # Write the frame multiple times to meet the desired duration per image
-        for _ in range(frame_count):
-            out.write(frame)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+        for rendition in sorted(renditions, key=lambda rendition: rendition["bandwidth"]):
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={rendition['bandwidth']},"
+                         f"AVERAGE-BANDWIDTH={rendition['average_bandwidth']},RESOLUTION={rendition['resolution']}")
+            lines.append(f"{rendition['name']}/index.m3u8")
+        with open(os.path.join(tmp_dir, HLS_MASTER), "w") as f:
+            f.write("\n".join(lines) + "\n")
 
-    out.release()
+        shutil.rmtree(hls_dir, ignore_errors=True)
+        os.replace(tmp_dir, hls_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return os.path.join(hls_dir, HLS_MASTER)
 
 
-def create_new_video(data_dir="/var/data/", out_dir="", add_music=True):
+def create_new_video_two_pass(data_dir="/var/data/", out_dir="", add_music=True, frames=None):
     """
-    Creates a new video from the images in the data_dir
+    Creates a new video from the images in the data_dir. Writes quiz_no_audio.mp4 first and re-encodes it with the
+    audio. Kept for comparison with the single pass create_new_video.
     :param data_dir: path to the data directory
     :param out_dir: path to the output directory
-    :param add_silent_audio: whether to add silent audio to the video
+    :param add_music: whether to add background music to the video
+    :param frames: stream these frames straight into the encoder instead of reading data_dir/frames
     :return:
     """
     # Load all images from data_dir
-    images_to_video(data_dir)
+    images_to_video(data_dir, frames=frames)
     # Load the video file
     video_clip = VideoFileClip(os.path.join(data_dir, "quiz_no_audio.mp4"))
     # Load the audio file
@@ -76,4 +879,6 @@ def create_new_video(data_dir="/var/data/", out_dir="", add_music=True):
     # Write the result to a file
     if out_dir == "":
         out_dir = data_dir
-    final_clip.write_videofile(os.path.join(out_dir, "quiz.mp4"), codec='libx264', audio_codec='aac')
+    video_path = os.path.join(out_dir, "quiz.mp4")
+    final_clip.write_videofile(video_path, codec='libx264', audio_codec='aac', ffmpeg_params=['-movflags', '+faststart'])
+    write_video_manifest(video_path, final_clip.duration)
@@ -1,23 +1,29 @@
 import os
-from flask import Flask, request, render_template, redirect, url_for, session, send_file, make_response
+from flask import Flask, request, render_template, redirect, url_for, session, send_file, make_response, jsonify, \
+    abort
+from werkzeug.security import safe_join
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import func
+from sqlalchemy.dialects import sqlite, postgresql
 from flask_oauthlib.client import OAuth
 from flask_httpauth import HTTPBasicAuth
 from datetime import datetime, timedelta, time
 import time
+import asyncio
 import platform
 
-from utils import get_answer, calculate_score, get_expiration_time, is_valid_username, get_explanations, \
-    remove_files_and_folders
-from quiz import quiz_creator, street_view_collector, video_creator
+from utils import calculate_score, get_expiration_time, is_valid_username, remove_files_and_folders, \
+    seconds_until_expiration, TimedCache, QuizStore
+from quiz import quiz_creator, street_view_collector, video_creator, pipeline
+from quiz.quiz_bank import QuizBank, BANK_DIR, CURRENT_LINK
+from jobs import JobRunner, JobConflict
 
 app = Flask(__name__)
 # if platform.system() != 'Darwin':
 #     app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:////var/data/users.db"
 # else:
 #
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('RR_DATABASE_URI', 'sqlite:///app.db')
 
 app.secret_key = os.urandom(24)  # Generate a random key
 auth = HTTPBasicAuth()
@@ -28,6 +34,26 @@ users = {
 
 db = SQLAlchemy(app)
 
+LEADERBOARD_PAGE_SIZE = 50  # Users per page on /high_scores
+SCORE_PAGE_LEADERBOARD_SIZE = 10  # Users shown on /score
+# Leaderboard query results. Invalidated on every score write, the ttl bounds how stale other workers can be.
+leaderboard_cache = TimedCache(ttl=30)
+# The quiz of the day, parsed once and kept until quiz.json changes
+quiz_store = QuizStore()
+# Runs the quiz, frame and video generation in the background. RR_JOB_WORKERS sets how many jobs run at once.
+job_runner = JobRunner(workers=int(os.environ.get('RR_JOB_WORKERS', 1)))
+QUIZ_BANK_SIZE = int(os.environ.get('RR_QUIZ_BANK_SIZE', 3))  # Quizzes /fill_bank keeps ready for publishing
+# Videos rendered by /build_quiz and /fill_bank from one fetch of the frames, see video_creator.VARIANTS
+VIDEO_VARIANTS = [name for name in os.environ.get('RR_VIDEO_VARIANTS', 'desktop').split(',') if name]
+# Variants that are also packaged as the renditions of the HLS stream the video page plays, empty for mp4 only
+HLS_VARIANTS = [name for name in os.environ.get('RR_HLS_VARIANTS', 'desktop,desktop_low').split(',') if name]
+# Checked at startup, a bad setting would otherwise only fail the first build
+BUILD_VARIANTS = video_creator.build_variants(VIDEO_VARIANTS, HLS_VARIANTS)
+HLS_MIMETYPES = {".m3u8": "application/vnd.apple.mpegurl", ".ts": "video/mp2t"}
+# Fetch every RR_FETCH_STRIDE-th Street View image and synthesize the frames in between with RR_TWEEN
+FETCH_STRIDE = int(os.environ.get('RR_FETCH_STRIDE', 1))
+TWEEN = os.environ.get('RR_TWEEN', 'dissolve')
+
 oauth = OAuth(app)
 google = oauth.remote_app(
     'google',
@@ -52,13 +78,116 @@ def home():
     return render_template('home.html')
 
 
+def send_media(file_path, mimetype=None, etag=True, as_attachment=False):
+    """
+    Send a file that belongs to today's quiz. Supports range requests (206) and conditional requests, and can be
+    cached by the browser until the quiz expires at 5 am.
+
+    If RR_MEDIA_OFFLOAD is set to "x-accel-redirect" (nginx) or "x-sendfile" (apache), only a header is returned
+    and the front proxy serves the bytes. For x-accel-redirect the file path relative to RR_DATA_PATH is appended to
+    RR_MEDIA_OFFLOAD_PREFIX, which must point to an internal location serving RR_DATA_PATH.
+    :param file_path: path to the file
+    :param mimetype: mimetype of the file, guessed from the file name if not given
+    :param etag: etag to use, or True to let werkzeug create one
+    :param as_attachment: send the file as an attachment
+    """
+    max_age = seconds_until_expiration()
+    offload = os.environ.get('RR_MEDIA_OFFLOAD', '')
+
+    if offload == 'x-accel-redirect':
+        relative_path = os.path.relpath(file_path, os.environ.get('RR_DATA_PATH'))
+        resp = make_response('')
+        resp.headers['X-Accel-Redirect'] = os.environ.get('RR_MEDIA_OFFLOAD_PREFIX', '/media/') + relative_path
+    elif offload == 'x-sendfile':
+        resp = make_response('')
+        resp.headers['X-Sendfile'] = os.path.abspath(file_path)
+    else:
+        resp = send_file(file_path, mimetype=mimetype, as_attachment=as_attachment, conditional=True, etag=etag,
+                         max_age=max_age)
+        resp.headers['Accept-Ranges'] = 'bytes'
+
+    if offload:
+        if mimetype is not None:
+            resp.mimetype = mimetype
+        if isinstance(etag, str):
+            resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = max_age
+    resp.expires = get_expiration_time()
+    return resp
+
+
 @app.route('/get_video')
-def get_video():
+def get_live_video():
+    """
+    Redirect to the versioned url of the live video
+    """
+    return redirect(url_for('get_video', version=live_version()))
+
+
+@app.route('/get_video/<version>')
+def get_video(version):
+    """
+    Get the video file. The version is part of the url, so browsers and caches never keep the video of another quiz,
+    see live_version.
+    """
+    video_path = os.path.join(media_dir(version), "quiz.mp4")
+    if not os.path.isfile(video_path):
+        abort(404)
+    # The checksum in the manifest is a strong etag that only changes with the video
+    manifest = video_creator.read_valid_video_manifest(video_path)
+    etag = manifest["sha256"] if manifest is not None else True
+    return send_media(video_path, mimetype='video/mp4', etag=etag)
+
+
+@app.route('/hls/<version>/<path:file_name>')
+def get_hls(version, file_name):
+    """
+    Get a playlist or segment of the HLS stream of the video, versioned like the video
+    """
+    mimetype = HLS_MIMETYPES.get(os.path.splitext(file_name)[1])
+    file_path = safe_join(os.path.join(media_dir(version), video_creator.HLS_DIR), file_name)
+    if mimetype is None or file_path is None or not os.path.isfile(file_path):
+        abort(404)
+    return send_media(file_path, mimetype=mimetype)
+
+
+def media_dir(version):
     """
-    Get the video file
+    Get the directory of the quiz a media url belongs to, aborts with 404 if the version is not served
+    :param version: version in the url, see live_version
+    :return: path to the directory
     """
-    video_path = os.path.join(os.environ.get('RR_DATA_PATH'), "quiz.mp4")
-    return send_file(video_path, as_attachment=True)
+    if version == live_version():
+        return live_data_dir()
+    # A player that loaded the page before a publish finishes the quiz it started, QuizBank.prune keeps it a while
+    bank = QuizBank(os.environ.get('RR_DATA_PATH'))
+    entry = bank.read_entry(version) if os.path.basename(version) == version else None
+    if entry is None or entry["published_at"] is None:
+        abort(404)
+    return os.path.join(bank.bank_dir, version)
+
+
+def live_version():
+    """
+    Get the version in the media urls of the live quiz, so the video and the HLS stream of different quizzes never
+    share a url
+    :return: the bank version of the live quiz, or if no quiz was published a checksum of the live video
+    """
+    version = QuizBank(os.environ.get('RR_DATA_PATH')).live_version()
+    if version is not None:
+        return version
+    video_path = os.path.join(live_data_dir(), "quiz.mp4")
+    try:
+        manifest = video_creator.read_valid_video_manifest(video_path)
+    except FileNotFoundError:
+        return "none"
+    if manifest is not None:
+        return manifest["sha256"][:16]
+    try:
+        return str(os.stat(video_path).st_mtime_ns)
+    except FileNotFoundError:
+        return "none"
 
 
 # Route for the video page
@@ -79,9 +208,13 @@ def video():
             return redirect(url_for('score'))
 
     # Rest of your existing code
-    quiz_path = os.path.join(os.environ.get('RR_DATA_PATH'), "quiz.json")
-    correct_answer = get_answer(quiz_path)
-    return render_template('video.html', correct_answer=correct_answer)
+    correct_answer = get_quiz()["city"]
+    version = live_version()
+    hls_url = None
+    if os.path.isfile(os.path.join(live_data_dir(), video_creator.HLS_DIR, video_creator.HLS_MASTER)):
+        hls_url = url_for('get_hls', version=version, file_name=video_creator.HLS_MASTER)
+    return render_template('video.html', correct_answer=correct_answer, hls_url=hls_url,
+                           video_url=url_for('get_video', version=version))
 
 
 @app.route('/high_scores')
@@ -89,10 +222,11 @@ def high_scores():
     """
     High scores page
     """
-    daily_scores = User.query.order_by(User.daily_score.desc()).all()
-    monthly_high_scores = get_last_month_high_scores()
+    page = max(1, request.args.get('page', 1, type=int))
+    daily_scores, has_next = get_daily_high_scores(page, LEADERBOARD_PAGE_SIZE)
+    monthly_high_scores = leaderboard_cache.get_or_set('monthly', get_last_month_high_scores)
     return render_template('high_scores.html', monthly_high_scores=monthly_high_scores,
-                           daily_high_scores=daily_scores)
+                           daily_high_scores=daily_scores, page=page, has_next=has_next)
 
 
 @app.route('/info')
@@ -108,7 +242,7 @@ def submit_answer():
     """
     Handle the answer submission
     """
-    video_path = os.path.join(os.environ.get('RR_DATA_PATH'), "quiz.mp4")
+    video_path = os.path.join(live_data_dir(), "quiz.mp4")
     start_time = float(request.form['start_time'])
     end_time = time.time()
     time_taken = end_time - start_time
@@ -132,11 +266,10 @@ def score():
     """
     user_score = session.get('latest_score', 0)
 
-    daily_scores = User.query.order_by(User.daily_score.desc()).all()
-    quiz_path = os.path.join(os.environ.get('RR_DATA_PATH'), "quiz.json")
-    correct_answer = get_answer(quiz_path)
+    daily_scores, _ = get_daily_high_scores(1, SCORE_PAGE_LEADERBOARD_SIZE)
+    correct_answer = get_quiz()["city"]
     return render_template('score.html', score=user_score, daily_high_scores=daily_scores,
-                           correct_answer=correct_answer)
+                           correct_answer=correct_answer, rank=get_daily_rank(user_score))
 
 
 @app.route('/login')
@@ -215,13 +348,13 @@ def submit_score():
         if existing_user:
             # Update existing score
             existing_user.daily_score = daily_score
-            new_game_score = GameScore(score=daily_score, user_id=existing_user.id)
-            db.session.add(new_game_score)
+            record_game_score(existing_user.id, daily_score)
         else:
             session['temp_score'] = request.args.get('score')
             return render_template('enter_username.html', google_user_id=google_user_id)
 
         db.session.commit()
+        leaderboard_cache.invalidate()
         return redirect(url_for('high_scores'))
 
 
@@ -249,9 +382,9 @@ def submit_username():
     db.session.commit()
 
     # Create new score entry for the user
-    new_game_score = GameScore(score=first_score, user_id=new_user.id)
-    db.session.add(new_game_score)
+    record_game_score(new_user.id, first_score)
     db.session.commit()
+    leaderboard_cache.invalidate()
 
     # Redirect to the appropriate page after username submission
     return redirect(url_for('high_scores'))
@@ -275,12 +408,14 @@ def delete_score():
 
     user = User.query.filter_by(google_user_id=google_user_id).first()
     if user:
-        # Delete all GameScore records associated with the user
+        # Delete all GameScore and MonthlyTotal records associated with the user
         GameScore.query.filter_by(user_id=user.id).delete()
+        MonthlyTotal.query.filter_by(user_id=user.id).delete()
 
         # Assuming you want to set the score to -1 to indicate deletion, adjust as necessary
         db.session.delete(user)
         db.session.commit()
+        leaderboard_cache.invalidate()
         return redirect(url_for('high_scores', message='Score deleted successfully.'))
     else:
         return redirect(url_for('high_scores', error='User not found.'))
@@ -292,9 +427,9 @@ class User(db.Model):
     User model
     """
     id = db.Column(db.Integer, primary_key=True)  # User ID
-    google_user_id = db.Column(db.String(100))  # Google User ID
-    user_name = db.Column(db.String(50))  # User name
-    daily_score = db.Column(db.Integer)  # Daily score
+    google_user_id = db.Column(db.String(100), index=True)  # Google User ID
+    user_name = db.Column(db.String(50), index=True)  # User name
+    daily_score = db.Column(db.Integer, index=True)  # Daily score
     scores = db.relationship('GameScore', backref='user', lazy=True)
 
     def __repr__(self):
@@ -307,15 +442,134 @@ class GameScore(db.Model):
     """
     id = db.Column(db.Integer, primary_key=True)
     score = db.Column(db.Integer, nullable=False)
-    played_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    played_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
 
     # Foreign Key to link scores to a specific user
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+
+
+class MonthlyTotal(db.Model):
+    """
+    Total score per user and month. Updated in the same transaction as every GameScore insert, so the monthly
+    high scores never have to aggregate GameScore.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    month = db.Column(db.String(7), nullable=False)  # e.g. "2024-03"
+    total_score = db.Column(db.Integer, nullable=False, default=0)
+    games_played = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'month'),
+        db.Index('ix_monthly_total_month_total_score', 'month', 'total_score'),
+    )
+
+
+def month_key(played_at):
+    """
+    Get the month a score belongs to
+    :param played_at: datetime of the game
+    :return: month as "YYYY-MM"
+    """
+    return played_at.strftime('%Y-%m')
+
+
+# INSERT ... ON CONFLICT DO UPDATE of the supported databases
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def record_game_score(user_id, score, played_at=None):
+    """
+    Add a GameScore and add it to the user's MonthlyTotal. The caller commits, so both writes end up in the same
+    transaction.
+    :param user_id: id of the user
+    :param score: the score
+    :param played_at: when the game was played, now if not given
+    :return: the new GameScore
+    """
+    score = int(score)
+    played_at = played_at or datetime.utcnow()
+    game_score = GameScore(score=score, user_id=user_id, played_at=played_at)
+    db.session.add(game_score)
+
+    # A single upsert, two workers adding the first score of a month can not both insert the row
+    insert = UPSERT_INSERTS[db.engine.dialect.name]
+    db.session.execute(
+        insert(MonthlyTotal)
+        .values(user_id=user_id, month=month_key(played_at), total_score=score, games_played=1)
+        .on_conflict_do_update(index_elements=['user_id', 'month'],
+                               set_={'total_score': MonthlyTotal.total_score + score,
+                                     'games_played': MonthlyTotal.games_played + 1}))
+    return game_score
+
+
+def rebuild_monthly_totals():
+    """
+    Recompute all MonthlyTotal rows from the GameScore history
+    :return: number of MonthlyTotal rows written
+    """
+    totals = {}
+    for user_id, score, played_at in (db.session.query(GameScore.user_id, GameScore.score, GameScore.played_at)
+                                      .yield_per(1000)):
+        key = (user_id, month_key(played_at))
+        total_score, games_played = totals.get(key, (0, 0))
+        totals[key] = (total_score + score, games_played + 1)
+
+    MonthlyTotal.query.delete()
+    for (user_id, month), (total_score, games_played) in totals.items():
+        db.session.add(MonthlyTotal(user_id=user_id, month=month, total_score=total_score,
+                                    games_played=games_played))
+    db.session.commit()
+    leaderboard_cache.invalidate()
+    return len(totals)
+
+
+def check_monthly_totals():
+    """
+    Compare this month's MonthlyTotal rows with the aggregate over GameScore
+    :return: list of (user_id, total from MonthlyTotal, total from GameScore) that differ
+    """
+    today = datetime.utcnow()
+    expected = {user_id: total for user_id, total in aggregate_monthly_scores(datetime(today.year, today.month, 1))}
+    actual = {row.user_id: row.total_score for row in MonthlyTotal.query.filter_by(month=month_key(today))}
+    return [(user_id, actual.get(user_id), expected.get(user_id))
+            for user_id in sorted(set(expected) | set(actual))
+            if actual.get(user_id) != expected.get(user_id)]
+
+
+def create_missing_indexes():
+    """
+    Create the indexes of the models. create_all only creates indexes for new tables, so existing databases get
+    them here.
+    """
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
 
 
 # Create the database tables
 with app.app_context():
     db.create_all()
+    create_missing_indexes()
+
+
+@app.cli.command('rebuild-monthly-totals')
+def rebuild_monthly_totals_command():
+    """
+    Recompute the monthly totals from the score history
+    """
+    print(f"Rebuilt {rebuild_monthly_totals()} monthly totals")
+
+
+@app.cli.command('check-monthly-totals')
+def check_monthly_totals_command():
+    """
+    Check the monthly totals of this month against the score history
+    """
+    mismatches = check_monthly_totals()
+    for user_id, actual, expected in mismatches:
+        print(f"User {user_id}: monthly total {actual}, score history {expected}")
+    print("Monthly totals are consistent" if not mismatches else f"{len(mismatches)} monthly totals differ")
 
 
 @app.route('/explanations')
@@ -323,8 +577,25 @@ def explanations():
     """
     Explanations page
     """
-    quiz_path = os.path.join(os.environ.get('RR_DATA_PATH'), "quiz.json")
-    return render_template('explanations.html', explanations=get_explanations(quiz_path))
+    return render_template('explanations.html', explanations=get_quiz()["explanations_html"])
+
+
+def get_quiz():
+    """
+    Get the current quiz from the quiz store
+    :return: dict with city, clues, explanations and explanations_html
+    """
+    return quiz_store.get(os.path.join(live_data_dir(), "quiz.json"))
+
+
+def live_data_dir():
+    """
+    Get the directory of the live quiz: the published quiz of the quiz bank, or RR_DATA_PATH if no quiz was published
+    :return: path to the directory
+    """
+    data_dir = os.environ.get('RR_DATA_PATH')
+    live_dir = QuizBank(data_dir).live_dir()
+    return live_dir if live_dir is not None else data_dir
 
 
 @google.tokengetter
@@ -358,6 +629,7 @@ def clear_daily_highscore():
             # Reset daily scores for all users
             User.query.update({User.daily_score: -1})
             db.session.commit()
+            leaderboard_cache.invalidate()
         except Exception as e:
             print("Error resetting daily high scores:", e)
             db.session.rollback()
@@ -370,7 +642,14 @@ def clear_quiz():
     """
     Clear the quiz
     """
-    remove_files_and_folders(os.environ.get('RR_DATA_PATH'))
+    # The quiz bank has its own rotation with /publish_quiz
+    try:
+        # Not while a job builds into the data directory
+        with job_runner.lock(os.environ.get('RR_DATA_PATH'), "clear_quiz"):
+            remove_files_and_folders(os.environ.get('RR_DATA_PATH'), keep=(BANK_DIR, CURRENT_LINK))
+    except JobConflict as e:
+        return jsonify(error=str(e), job_id=e.job_id), 409
+    quiz_store.invalidate()
     return "Quiz cleared!"
 
 
@@ -380,8 +659,7 @@ def new_quiz_random():
     """
     Create a new quiz
     """
-    quiz_creator.create_new_quiz(os.environ.get('RR_DATA_PATH'))
-    return "Quiz created!"
+    return submit_job("new_quiz", build_quiz, os.environ.get('RR_DATA_PATH'))
 
 
 @app.route('/new_quiz/<city_name>')
@@ -391,8 +669,150 @@ def new_quiz(city_name):
     Create a new quiz for a given city
     """
     # Ensure the city_name is properly passed to your quiz creation logic
-    quiz_creator.create_new_quiz(os.environ.get('RR_DATA_PATH'), city_name)
-    return f"Quiz created for {city_name}!"
+    return submit_job("new_quiz", build_quiz, os.environ.get('RR_DATA_PATH'), city_name)
+
+
+def build_quiz(data_dir, city="", progress=None):
+    """
+    Create a new quiz and make the quiz store pick it up
+    :param data_dir: path to the data directory
+    :param city: city name, a random city if empty
+    :param progress: progress callback
+    :return: void
+    """
+    quiz_creator.create_new_quiz(data_dir, city, progress=progress)
+    quiz_store.invalidate()
+
+
+@app.route('/build_quiz')
+@auth.login_required
+def build_full_quiz():
+    """
+    Create a new quiz with frames and video in one job, running the independent stages concurrently. The city is
+    random unless ?city= is given, ?fetch_stride= and ?tween= override RR_FETCH_STRIDE and RR_TWEEN for this build.
+    """
+    fetch_stride = max(1, request.args.get('fetch_stride', FETCH_STRIDE, type=int))
+    tween = request.args.get('tween', TWEEN)
+    if tween not in video_creator.TWEENS:
+        return f"Unknown tween {tween}, the tweens are {', '.join(video_creator.TWEENS)}", 400
+    return submit_job("build_quiz", build_quiz_pipeline, os.environ.get('RR_DATA_PATH'), request.args.get('city', ''),
+                      fetch_stride, tween)
+
+
+def quiz_stages(data_dir, fetch_stride=FETCH_STRIDE, tween=TWEEN):
+    """
+    Get the stages of a quiz build that renders the RR_VIDEO_VARIANTS and the RR_HLS_VARIANTS
+    :param data_dir: path to the data directory
+    :param fetch_stride: fetch every fetch_stride-th Street View image
+    :param tween: how to synthesize the frames in between
+    :return: QuizStages
+    """
+    return pipeline.QuizStages(data_dir, variants=BUILD_VARIANTS, hls_variants=HLS_VARIANTS, fetch_stride=fetch_stride,
+                               tween=tween)
+
+
+def build_quiz_pipeline(data_dir, city="", fetch_stride=FETCH_STRIDE, tween=TWEEN, progress=None):
+    """
+    Build the quiz, frames and video and make the quiz store pick up the new quiz
+    :param data_dir: path to the data directory
+    :param city: city name, a random city if empty
+    :param fetch_stride: fetch every fetch_stride-th Street View image
+    :param tween: how to synthesize the frames in between
+    :param progress: progress callback
+    :return: void
+    """
+    pipeline.build_quiz(quiz_stages(data_dir, fetch_stride, tween), city, progress=progress)
+    quiz_store.invalidate()
+
+
+@app.route('/fill_bank')
+@auth.login_required
+def fill_bank_route():
+    """
+    Build quizzes into the quiz bank until ?size= (default RR_QUIZ_BANK_SIZE) are waiting to be published
+    """
+    size = request.args.get('size', QUIZ_BANK_SIZE, type=int)
+    return submit_job("fill_bank", fill_bank, os.path.join(os.environ.get('RR_DATA_PATH'), BANK_DIR), size)
+
+
+def fill_bank(bank_dir, size, progress=None):
+    """
+    Fill the quiz bank with complete quizzes
+    :param bank_dir: path to the bank directory in the data directory
+    :param size: number of quizzes to have waiting
+    :param progress: progress callback
+    :return: void
+    """
+    bank = QuizBank(os.path.dirname(bank_dir))
+    missing = size - len(bank.pending())
+    if missing <= 0:
+        print("The quiz bank is already full")
+        return
+
+    # Create the clues of all the cities in one concurrent sweep, the builds then find them in the clues cache
+    if progress is not None:
+        progress("clues")
+    cities = quiz_creator.random_destinations(missing)
+    clues = asyncio.run(quiz_creator.create_quizzes(cities))
+    cities = [city for city in cities if not isinstance(clues[city], Exception)]
+
+    def build(city=""):
+        return lambda version_dir: pipeline.build_quiz(quiz_stages(version_dir), city, progress=progress)["city"]
+
+    added = []
+    for city in cities:
+        try:
+            added.append(bank.add(build(city)))
+        except Exception as e:
+            print(f"Failed to build the quiz for {city}: {e}")
+    # Random cities for the quizzes that could not be built for the chosen cities
+    added += bank.fill(size, build())
+    print(f"Added {len(added)} quizzes to the bank")
+
+
+@app.route('/publish_quiz')
+@auth.login_required
+def publish_quiz_route():
+    """
+    Make the next quiz of the bank, or ?version=, the live quiz
+    """
+    try:
+        version = QuizBank(os.environ.get('RR_DATA_PATH')).publish(request.args.get('version'))
+    except ValueError as e:
+        return str(e), 409
+    quiz_store.invalidate()
+    return f"Published quiz {version} for {get_quiz()['city']}!"
+
+
+@app.route('/quiz_bank')
+@auth.login_required
+def quiz_bank_status():
+    """
+    The quizzes in the bank and which one is live
+    """
+    bank = QuizBank(os.environ.get('RR_DATA_PATH'))
+    return jsonify(live=bank.live_version(), pending=bank.pending(),
+                   versions=[dict(entry, version=version) for version, entry in bank.versions()])
+
+
+@app.cli.command('publish-quiz')
+def publish_quiz_command():
+    """
+    Make the next quiz of the bank the live quiz
+    """
+    print(f"Published quiz {QuizBank(os.environ.get('RR_DATA_PATH')).publish()}")
+
+
+@app.route('/reload_quiz')
+@auth.login_required
+def reload_quiz():
+    """
+    Load quiz.json again, e.g. after it was replaced by hand, and show the quiz store counters
+    """
+    quiz_store.invalidate()
+    quiz = get_quiz()
+    stats = quiz_store.stats()
+    return f"Quiz reloaded for {quiz['city']}! ({stats['hits']} hits, {stats['reloads']} reloads)"
 
 
 @app.route('/new_frames')
@@ -401,41 +821,146 @@ def new_frames():
     """
     Create new frames for the quiz
     """
-    street_view_collector.create_new_frames(os.environ.get('RR_DATA_PATH'))
-    return "Frames created!"
+    return submit_job("new_frames", street_view_collector.create_new_frames, os.environ.get('RR_DATA_PATH'))
 
 @app.route('/new_video')
 @auth.login_required
 def new_video():
     """
-    Create new video from the quiz
+    Create new video from the quiz. With ?stream=1 the frames are fetched and streamed straight into the encoder,
+    without calling /new_frames first.
+    """
+    return submit_job("new_video", build_video, os.environ.get('RR_DATA_PATH'), bool(request.args.get('stream')))
+
+
+def build_video(data_dir, stream=False, progress=None):
+    """
+    Create the video, from the frames on disk or streaming them from street view
+    :param data_dir: path to the data directory
+    :param stream: fetch the frames while encoding, every RR_FETCH_STRIDE-th one with the frames in between
+    synthesized with RR_TWEEN
+    :param progress: progress callback
+    :return: void
+    """
+    if stream:
+        # The stream has one item for every fetched point of the path, dropped images included
+        nbr_images = len(range(0, len(street_view_collector.load_path_coordinates(data_dir)) - 1, FETCH_STRIDE))
+        frames = street_view_collector.stream_new_frames(data_dir, fetch_stride=FETCH_STRIDE)
+        video_creator.create_new_video(data_dir, frames=frames, nbr_images=nbr_images, progress=progress,
+                                       fetch_stride=FETCH_STRIDE, tween=TWEEN)
+    else:
+        video_creator.create_new_video(data_dir, progress=progress)
+
+
+def submit_job(kind, func, data_dir, *args):
+    """
+    Queue a generation job for a data directory
+    :param kind: name of the job
+    :param func: function to run, called with (data_dir, *args, progress=callback)
+    :param data_dir: path to the data directory
+    :param args: more arguments for func
+    :return: response with the job id, or 409 if another job works on the data directory
+    """
+    try:
+        job_id = job_runner.submit(kind, data_dir, func, data_dir, *args)
+    except JobConflict as e:
+        return jsonify(error=str(e), job_id=e.job_id), 409
+    return jsonify(job_id=job_id, status_url=url_for('job_status', job_id=job_id)), 202
+
+
+@app.route('/jobs/<job_id>')
+@auth.login_required
+def job_status(job_id):
+    """
+    Status of a generation job: stage, progress, duration and error
+    """
+    record = job_runner.get(job_id)
+    if record is None:
+        return jsonify(error="No such job"), 404
+    if record["status"] == "running":
+        record["duration"] = time.time() - record["started_at"]
+    return jsonify(record)
+
+
+def get_daily_high_scores(page=1, page_size=LEADERBOARD_PAGE_SIZE):
+    """
+    Get one page of today's high scores. Users without a score today (-1) are left out.
+    :param page: page number, starting at 1
+    :param page_size: number of users per page
+    :return: (list of (user_name, daily_score) rows, whether there is a next page)
     """
-    video_creator.create_new_video(os.environ.get('RR_DATA_PATH'))
-    return "Video created!"
+    def query():
+        rows = (db.session.query(User.user_name, User.daily_score)
+                .filter(User.daily_score >= 0)
+                .order_by(User.daily_score.desc(), User.id)
+                .offset((page - 1) * page_size)
+                .limit(page_size + 1)
+                .all())
+        return rows[:page_size], len(rows) > page_size
+
+    return leaderboard_cache.get_or_set(('daily', page, page_size), query)
+
+
+def get_daily_rank(daily_score):
+    """
+    Get the rank a score has on today's high scores
+    :param daily_score: the score
+    :return: rank, starting at 1
+    """
+    def query():
+        return User.query.filter(User.daily_score > daily_score).count() + 1
+
+    return leaderboard_cache.get_or_set(('rank', daily_score), query)
 
 
 def get_last_month_high_scores():
     """
     Get the total scores for each user over the current month, including user names.
     """
-    # Calculate the start of the current month
-    today = datetime.utcnow()
-    start_of_month = datetime(today.year, today.month, 1)
-
-    # Query to sum scores for each user over the current month and join with the User table to get user names
-    monthly_scores = (db.session.query(
-        User.user_name,  # Include user_name in the query
-        func.sum(GameScore.score).label('total_score')
-    ).join(User, User.id == GameScore.user_id)
-                      .filter(GameScore.played_at >= start_of_month)
-                      .group_by(User.id)
-                      .order_by(func.sum(GameScore.score).desc())
+    monthly_scores = (db.session.query(User.user_name, MonthlyTotal.total_score)
+                      .join(User, User.id == MonthlyTotal.user_id)
+                      .filter(MonthlyTotal.month == month_key(datetime.utcnow()))
+                      .order_by(MonthlyTotal.total_score.desc())
                       .all())
 
     # This will return a list of tuples, each containing (user_name, total_score)
     return monthly_scores
 
 
+def aggregate_monthly_scores(start_of_month):
+    """
+    Sum the scores for each user since the start of the month over the whole GameScore history. Used to check the
+    monthly totals.
+    :param start_of_month: datetime of the start of the month
+    :return: list of (user_id, total_score)
+    """
+    return (db.session.query(GameScore.user_id, func.sum(GameScore.score))
+            .filter(GameScore.played_at >= start_of_month)
+            .group_by(GameScore.user_id)
+            .all())
+
+
+@app.route('/rebuild_monthly_totals')
+@auth.login_required
+def rebuild_monthly_totals_route():
+    """
+    Recompute the monthly totals from the score history
+    """
+    return f"Rebuilt {rebuild_monthly_totals()} monthly totals!"
+
+
+@app.route('/check_monthly_totals')
+@auth.login_required
+def check_monthly_totals_route():
+    """
+    Check the monthly totals of this month against the score history
+    """
+    mismatches = check_monthly_totals()
+    if not mismatches:
+        return "Monthly totals are consistent!"
+    return "Monthly totals differ: " + ", ".join(
+        f"user {user_id} has {actual} but should have {expected}" for user_id, actual, expected in mismatches), 500
+
 
 if __name__ == '__main__':
     app.run(debug=False)
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import time
+import tempfile
+import threading
+import unittest
+from io import BytesIO
+from types import SimpleNamespace
+
+from openai import InternalServerError
+
+from pydub import AudioSegment
+from pydub.generators import Sine
+
+from quiz.audio_creator import synthesize, decode_mp3, assemble, split_text, TTSEngine, quiz_2_speech_openai, \
+    text_2_speech_openai
+from quiz.disk_cache import DiskCache
+from tests.stub_server import StubServer
+
+
+def mp3_bytes(duration, frequency=440):
+    buffer = BytesIO()
+    Sine(frequency, sample_rate=24000).to_audio_segment(duration=duration).set_channels(1).export(buffer, format="mp3")
+    return buffer.getvalue()
+
+
+class FakeSpeech():
+    """
+    Stands in for client.audio.speech, the "audio" is the request itself.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, model, voice, input):
+        self.calls.append((model, voice, input))
+        return SimpleNamespace(content=f"{model}:{voice}:{input}".encode())
+
+
+def fake_client():
+    return SimpleNamespace(audio=SimpleNamespace(speech=FakeSpeech()))
+
+
+class AudioCreatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_unchanged_text_costs_no_tts_calls(self):
+        cache = DiskCache(self.tmp_dir.name)
+        client = fake_client()
+
+        async def build():
+            first = await synthesize(client, "echo", "Where are we going?...", cache=cache)
+            second = await synthesize(client, "echo", "Where are we going?...", cache=cache)
+            return first, second
+
+        first, second = asyncio.run(build())
+
+        assert first == second == b"tts-1:echo:Where are we going?..."
+        assert len(client.audio.speech.calls) == 1
+        assert cache.hits == 1
+        assert cache.misses == 1
+        assert cache.hit_rate() == 0.5
+
+        # A new cache on the same directory, e.g. in the next build, still has the audio
+        restarted = DiskCache(self.tmp_dir.name)
+        asyncio.run(synthesize(client, "echo", "Where are we going?...", cache=restarted))
+        assert len(client.audio.speech.calls) == 1
+
+    def test_voice_and_model_are_part_of_the_key(self):
+        cache = DiskCache(self.tmp_dir.name)
+        client = fake_client()
+
+        async def build():
+            await synthesize(client, "echo", "Paris", cache=cache)
+            await synthesize(client, "nova", "Paris", cache=cache)
+            await synthesize(client, "echo", "Paris", model="tts-1-hd", cache=cache)
+
+        asyncio.run(build())
+
+        assert len(client.audio.speech.calls) == 3
+        assert len(cache) == 3
+
+    def test_cache_is_bounded(self):
+        cache = DiskCache(self.tmp_dir.name, max_bytes=100)
+        client = fake_client()
+
+        async def build():
+            for nr in range(10):
+                await synthesize(client, "echo", f"Clue number {nr}...", cache=cache)
+
+        asyncio.run(build())
+
+        assert cache.total_bytes <= 100
+        assert cache.evictions > 0
+
+
+    def test_decode_mp3_in_memory(self):
+        audio = decode_mp3(mp3_bytes(1000))
+
+        assert audio.frame_rate == 24000
+        assert audio.channels == 1
+        assert audio.sample_width == 2
+        # mp3 adds some padding
+        assert 1000 <= len(audio) < 1100
+        assert audio.rms > 0
+
+    def test_assemble(self):
+        tone = Sine(440, sample_rate=24000).to_audio_segment(duration=300).set_channels(1)
+        # Other formats are converted to the first segment's
+        other = Sine(440, sample_rate=44100).to_audio_segment(duration=200).set_channels(2)
+
+        audio = assemble([tone, other, tone], gap=500)
+
+        assert len(audio) == 300 + 200 + 300 + 3 * 500
+        assert audio.frame_rate == 24000
+        assert audio.channels == 1
+        assert audio[300:800].rms == 0
+        assert len(assemble([])) == 0
+
+    def test_quiz_speech_has_a_pause_after_every_clue(self):
+        durations = {"First clue...": 700, "Second clue...": 400}
+        audio = {text: mp3_bytes(duration) for text, duration in durations.items()}
+
+        def handler(method, path, query, body):
+            return 200, "audio/mpeg", audio[json.loads(body)["input"]]
+
+        with StubServer(handler) as server:
+            engine = TTSEngine("echo", base_url=server.url, openai_api_key="test", cache=DiskCache(self.tmp_dir.name))
+            quiz = SimpleNamespace(clues=list(durations))
+            speech = asyncio.run(quiz_2_speech_openai(quiz, "echo", engine=engine))
+
+        assert [(method, path) for method, path, _ in server.requests] == [("POST", "/audio/speech")] * 2
+        assert 700 + 400 + 2 * 500 <= len(speech) < 700 + 400 + 2 * 500 + 200
+
+    def test_engine_limits_concurrency_and_retries(self):
+        audio_data = mp3_bytes(200)
+        lock = threading.Lock()
+        state = {"in_flight": 0, "max_in_flight": 0, "failed": set()}
+
+        def handler(method, path, query, body):
+            text = json.loads(body)["input"]
+            with lock:
+                # Every text fails once
+                if text not in state["failed"]:
+                    state["failed"].add(text)
+                    return 500, "application/json", b'{"error": {"message": "busy"}}'
+                state["in_flight"] += 1
+                state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            time.sleep(0.05)
+            with lock:
+                state["in_flight"] -= 1
+            return 200, "audio/mpeg", audio_data
+
+        texts = [f"Clue number {nr}..." for nr in range(8)]
+        with StubServer(handler) as server:
+            engine = TTSEngine("echo", max_concurrency=3, backoff_factor=0, base_url=server.url,
+                               openai_api_key="test", cache=DiskCache(self.tmp_dir.name))
+
+            async def build():
+                try:
+                    return await engine.speak_all(texts)
+                finally:
+                    await engine.close()
+
+            speech = asyncio.run(build())
+
+        assert len(server.requests) == 16
+        assert engine.retries_made == 8
+        assert state["max_in_flight"] <= 3
+        assert len(speech) >= 8 * 200
+
+    def test_engine_gives_up_after_retries(self):
+        def handler(method, path, query, body):
+            return 500, "application/json", b'{"error": {"message": "down"}}'
+
+        with StubServer(handler) as server:
+            engine = TTSEngine("echo", retries=2, backoff_factor=0, base_url=server.url, openai_api_key="test",
+                               cache=DiskCache(self.tmp_dir.name))
+            with self.assertRaises(InternalServerError):
+                asyncio.run(text_2_speech_openai("Where are we going?...", "echo", engine=engine))
+
+        assert len(server.requests) == 3
+
+    def test_split_text_on_sentences(self):
+        text = "We head towards the city of light. The city is home to a museum! Which one? " + "Bonjour " * 20
+
+        chunks = split_text(text, 60)
+
+        assert chunks[0] == "We head towards the city of light."
+        assert chunks[1].startswith("The city is home to a museum! Which one? Bonjour")
+        assert all(len(chunk) <= 60 for chunk in chunks)
+        assert " ".join(chunks).split() == text.split()
+        # Only words longer than the limit are cut
+        assert split_text("a" * 25, 10) == ["a" * 10, "a" * 10, "a" * 5]
+        assert split_text("Short clue...") == ["Short clue..."]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+from quiz.disk_cache import DiskCache, make_key
+import os
+import tempfile
+import time
+import unittest
+
+
+class DiskCacheTests(unittest.TestCase):
+
+    def test_get_and_put(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiskCache(cache_dir, max_bytes=1000)
+
+            assert cache.get("a") is None
+            cache.put("a", b"12345")
+
+            assert cache.get("a") == b"12345"
+            assert "a" in cache
+            assert cache.stats()["hits"] == 1
+            assert cache.stats()["misses"] == 1
+            assert cache.hit_rate() == 0.5
+
+    def test_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiskCache(cache_dir, max_bytes=25)
+            cache.put("a", b"x" * 10)
+            cache.put("b", b"x" * 10)
+            cache.get("a")  # b is now the least recently used
+            cache.put("c", b"x" * 10)
+
+            assert "a" in cache
+            assert "b" not in cache
+            assert "c" in cache
+            assert cache.total_bytes == 20
+            assert cache.evictions == 1
+            assert not os.path.exists(os.path.join(cache_dir, "b.bin"))
+
+    def test_persists_between_instances(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiskCache(cache_dir, max_bytes=25)
+            cache.put("a", b"x" * 10)
+            time.sleep(0.01)
+            cache.put("b", b"x" * 10)
+
+            # A smaller budget on reopen evicts the oldest entry
+            reopened = DiskCache(cache_dir, max_bytes=15)
+
+            assert len(reopened) == 1
+            assert reopened.get("b") == b"x" * 10
+
+    def test_instances_share_the_budget(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # Two processes with their own instance on the same directory
+            first = DiskCache(cache_dir, max_bytes=50, rescan_bytes=20)
+            second = DiskCache(cache_dir, max_bytes=50, rescan_bytes=20)
+            for nr in range(5):
+                first.put(f"a{nr}", b"x" * 10)
+                second.put(f"b{nr}", b"x" * 10)
+
+            on_disk = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+            # Over budget by at most rescan_bytes per instance
+            assert on_disk <= 50 + 2 * 20
+            # Entries written by the other instance are found
+            assert first.get("b4") == b"x" * 10
+
+    def test_orphaned_temporary_files_are_removed(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            orphan = os.path.join(cache_dir, "a.bin.123.456.tmp")
+            in_progress = os.path.join(cache_dir, "b.bin.123.789.tmp")
+            for path in (orphan, in_progress):
+                with open(path, "wb") as f:
+                    f.write(b"partial")
+            os.utime(orphan, (time.time() - 7200, time.time() - 7200))
+
+            cache = DiskCache(cache_dir)
+
+            assert not os.path.exists(orphan)
+            assert os.path.exists(in_progress)
+            assert len(cache) == 0
+
+    def test_make_key(self):
+        assert make_key("a", 1) == make_key("a", 1)
+        assert make_key("a", 1) != make_key("a", 2)
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+
+from quiz.geocode_index import GeocodeIndex, write_index, GEOCODE_SEED_PATH
+from quiz.quiz_creator import load_cities
+from tests.stub_server import StubServer
+
+
+def nominatim_handler(method, path, query, body):
+    if query["q"] == "Atlantis":
+        return 200, "application/json", b"[]"
+    return 200, "application/json", json.dumps([{"lat": "47.37", "lon": "8.54"}]).encode()
+
+
+class GeocodeIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.tmp_dir.name, "geocodes.json")
+        self.seed_path = os.path.join(self.tmp_dir.name, "seed.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_seeded_cities_need_no_network(self):
+        write_index(self.seed_path, {"paris": [48.85, 2.35]})
+        index = GeocodeIndex(self.index_path, self.seed_path, base_url="http://127.0.0.1:9")
+
+        assert index.lookup("Paris") == (48.85, 2.35)
+        assert index.lookup("  PARIS ") == (48.85, 2.35)
+        assert index.hits == 2
+        assert index.misses == 0
+
+    def test_new_cities_are_geocoded_once_and_kept(self):
+        with StubServer(nominatim_handler) as server:
+            index = GeocodeIndex(self.index_path, self.seed_path, base_url=server.url, min_interval=0)
+            assert index.lookup("Zurich") == (47.37, 8.54)
+            assert index.lookup("zurich") == (47.37, 8.54)
+            with self.assertRaises(ValueError):
+                index.lookup("Atlantis")
+
+        assert len(server.requests) == 2
+        assert "roadtrip-riddle" in index._session.headers["User-Agent"]
+
+        # A new index, e.g. after a restart, loads the city from disk
+        restarted = GeocodeIndex(self.index_path, self.seed_path, base_url="http://127.0.0.1:9")
+        assert restarted.lookup("Zurich") == (47.37, 8.54)
+        assert "Atlantis" not in restarted
+
+    def test_rate_limit(self):
+        limited = []
+
+        def handler(method, path, query, body):
+            if not limited:
+                limited.append(time.monotonic())
+                return 429, "text/plain", b"slow down"
+            return nominatim_handler(method, path, query, body)
+
+        with StubServer(handler) as server:
+            index = GeocodeIndex(self.index_path, self.seed_path, base_url=server.url, min_interval=0.2)
+            start = time.monotonic()
+            index.lookup("Zurich")
+            index.lookup("Bern")
+
+        # The 429 is retried, and requests are at least min_interval apart
+        assert len(server.requests) == 3
+        assert time.monotonic() - start >= 0.4
+
+    def test_load_cities(self):
+        with open(os.path.join(self.tmp_dir.name, "cities.txt"), "w") as f:
+            f.write("Tokyo,\nNew York,\nLondon\n")
+
+        cities = load_cities(os.path.join(self.tmp_dir.name, "cities.txt"))
+
+        assert cities == ("Tokyo", "New York", "London")
+        assert load_cities(os.path.join(self.tmp_dir.name, "cities.txt")) is cities
+
+
+    def test_corrupt_index_is_read_as_empty(self):
+        with open(self.index_path, "w") as f:
+            f.write('{"paris": [48.85,')
+
+        with StubServer(nominatim_handler) as server:
+            index = GeocodeIndex(self.index_path, self.seed_path, base_url=server.url, min_interval=0)
+            assert index.lookup("Zurich") == (47.37, 8.54)
+
+        # The file is rewritten with the new city
+        with open(self.index_path) as f:
+            assert json.load(f) == {"zurich": [47.37, 8.54]}
+
+    def test_every_city_is_in_the_seed(self):
+        index = GeocodeIndex(self.index_path, GEOCODE_SEED_PATH, base_url="http://127.0.0.1:9")
+
+        for city in load_cities():
+            assert city in index, city
+            lat, lng = index.lookup(city)
+            assert -90 <= lat <= 90 and -180 <= lng <= 180
+        assert index.misses == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+
+from jobs import JobRunner, JobConflict
+
+
+class JobRunnerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.jobs_dir = os.path.join(self.tmp_dir.name, "jobs")
+        self.data_dir = os.path.join(self.tmp_dir.name, "data")
+        self.runner = JobRunner(self.jobs_dir, workers=2, progress_interval=0)
+
+    def tearDown(self):
+        self.runner.shutdown()
+        self.tmp_dir.cleanup()
+
+    def test_job_reports_stage_and_progress(self):
+        def build(data_dir, nbr_frames, progress=None):
+            progress("route")
+            for i in range(nbr_frames):
+                progress("frames", i + 1, nbr_frames)
+
+        job_id = self.runner.submit("new_frames", self.data_dir, build, self.data_dir, 3)
+        record = self.runner.wait(job_id, timeout=5)
+
+        assert record["status"] == "done"
+        assert record["kind"] == "new_frames"
+        assert record["stage"] == "frames"
+        assert record["progress"] == {"done": 3, "total": 3}
+        assert record["duration"] >= 0
+        assert record["error"] is None
+
+    def test_failed_job_records_error(self):
+        def build(data_dir, progress=None):
+            raise ValueError("no route found")
+
+        record = self.runner.wait(self.runner.submit("new_quiz", self.data_dir, build, self.data_dir), timeout=5)
+
+        assert record["status"] == "failed"
+        assert record["error"] == "ValueError: no route found"
+
+    def test_one_job_per_data_dir(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def build(data_dir, progress=None):
+            started.set()
+            release.wait(5)
+
+        job_id = self.runner.submit("new_video", self.data_dir, build, self.data_dir)
+        started.wait(5)
+        with self.assertRaises(JobConflict) as context:
+            self.runner.submit("new_frames", self.data_dir, build, self.data_dir)
+        assert context.exception.job_id == job_id
+
+        # Another data directory is not blocked
+        other_dir = os.path.join(self.tmp_dir.name, "other")
+        release.set()
+        other_id = self.runner.submit("new_video", other_dir, build, other_dir)
+        self.runner.wait(job_id, timeout=5)
+        self.runner.wait(other_id, timeout=5)
+
+        # The lock is released when the job is done
+        job_id = self.runner.submit("new_frames", self.data_dir, build, self.data_dir)
+        assert self.runner.wait(job_id, timeout=5)["status"] == "done"
+
+    def test_stale_lock_is_taken_over(self):
+        # A lock file left behind by a process whose pid is in use again, e.g. after a container restart
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        with open(self.runner._lock_path(self.data_dir), "w") as f:
+            json.dump({"job_id": "crashed", "pid": os.getpid()}, f)
+
+        job_id = self.runner.submit("new_frames", self.data_dir, lambda data_dir, progress=None: None, self.data_dir)
+
+        assert self.runner.wait(job_id, timeout=5)["status"] == "done"
+
+    def test_lock_conflicts_with_jobs(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def build(data_dir, progress=None):
+            started.set()
+            release.wait(5)
+
+        job_id = self.runner.submit("new_video", self.data_dir, build, self.data_dir)
+        started.wait(5)
+        with self.assertRaises(JobConflict) as context:
+            with self.runner.lock(self.data_dir, "clear_quiz"):
+                pass
+        assert context.exception.job_id == job_id
+        release.set()
+        self.runner.wait(job_id, timeout=5)
+
+        # A job can not start while the lock is held
+        with self.runner.lock(self.data_dir, "clear_quiz"):
+            with self.assertRaises(JobConflict) as context:
+                self.runner.submit("new_video", self.data_dir, build, self.data_dir)
+            assert context.exception.job_id == "clear_quiz"
+        job_id = self.runner.submit("new_video", self.data_dir, build, self.data_dir)
+        assert self.runner.wait(job_id, timeout=5)["status"] == "done"
+
+    def test_unknown_job(self):
+        assert self.runner.get("0" * 32) is None
+        assert self.runner.get("../jobs") is None
+
+
+if __name__ == '__main__':
+    unittest.main()
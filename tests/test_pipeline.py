@@ -0,0 +1,96 @@
+import time
+import threading
+import unittest
+
+from quiz.pipeline import QuizStages, build_quiz
+
+
+class StubStages(QuizStages):
+    """
+    Stages that sleep instead of calling the APIs, and record when they start and end.
+    """
+
+    def __init__(self, paths=None, delay=0.2):
+        super().__init__("/tmp/unused")
+        self.paths = paths if paths is not None else {"Paris": [(0, 0)] * 3}
+        self.delay = delay
+        self.cities = ["Nowhere", "Paris"]
+        self.events = []
+        self.spans = {}
+        # Stages that must run at the same time, they wait for each other at a barrier
+        self.barriers = {}
+        self._lock = threading.Lock()
+
+    def _run(self, name, delay, result=None):
+        start = time.perf_counter()
+        if name in self.barriers:
+            self.barriers[name].wait(timeout=5)
+        time.sleep(delay)
+        with self._lock:
+            self.events.append(name)
+            self.spans[name] = (start, time.perf_counter())
+        return result
+
+    def destination(self):
+        return self.cities.pop(0)
+
+    def clues(self, city, progress):
+        return self._run(f"clues {city}", self.delay, ["clue"])
+
+    def audio(self, city, clues, progress):
+        self._run(f"audio {city}", self.delay)
+
+    def route(self, city, progress):
+        return self._run(f"route {city}", self.delay, self.paths.get(city, []))
+
+    def frames(self, path_coordinates, progress):
+        for i in range(len(path_coordinates)):
+            progress("frames", i + 1, len(path_coordinates))
+        self._run("frames", self.delay)
+
+    def video(self, progress):
+        self._run("video", 0)
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_stages_run_concurrently(self):
+        stages = StubStages()
+        # Raises BrokenBarrierError unless each pair runs side by side
+        for pair in [("clues Paris", "route Paris"), ("audio Paris", "frames")]:
+            barrier = threading.Barrier(2)
+            stages.barriers.update({name: barrier for name in pair})
+        progress = []
+
+        report = build_quiz(stages, "Paris", progress=lambda stage, done=None, total=None: progress.append(stage))
+
+        # clues -> audio and route -> frames run side by side, the video waits for both
+        spans = stages.spans
+        assert spans["clues Paris"][1] <= spans["audio Paris"][0]
+        assert spans["route Paris"][1] <= spans["frames"][0]
+        assert spans["video"][0] >= max(spans["audio Paris"][1], spans["frames"][1])
+        assert stages.events[-1] == "video"
+        assert progress[-1] == "video"
+        assert "frames" in progress
+
+        assert [name for name, _, _ in report["stages"]].count("video") == 1
+
+    def test_random_city_without_path_is_replaced(self):
+        stages = StubStages(delay=0)
+
+        build_quiz(stages)
+
+        assert "route Nowhere" in stages.events
+        assert "frames" in stages.events
+        assert stages.events.count("frames") == 1
+
+    def test_city_without_path_fails(self):
+        stages = StubStages(paths={}, delay=0)
+
+        with self.assertRaises(Exception):
+            build_quiz(stages, "Paris")
+        assert "video" not in stages.events
+
+
+if __name__ == '__main__':
+    unittest.main()
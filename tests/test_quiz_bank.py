@@ -0,0 +1,104 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+
+from quiz.quiz_bank import QuizBank
+
+
+def build_quiz(city):
+    def build(version_dir):
+        # Write the quiz in pieces, like the real build does
+        for name in ("quiz.mp3", "quiz.mp4"):
+            with open(os.path.join(version_dir, name), "wb") as f:
+                f.write(city.encode())
+        with open(os.path.join(version_dir, "quiz.json"), "w") as f:
+            json.dump({"city": city, "clues": [], "explanations": []}, f)
+        return city
+    return build
+
+
+class QuizBankTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.bank = QuizBank(self.tmp_dir.name, keep_published=1)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_publish_in_order(self):
+        cities = iter(["Paris", "Rome", "Oslo"])
+        added = self.bank.fill(3, lambda version_dir: build_quiz(next(cities))(version_dir))
+
+        assert self.bank.pending() == added
+        assert self.bank.live_dir() is None
+
+        assert self.bank.publish() == added[0]
+        with open(os.path.join(self.bank.live_dir(), "quiz.json")) as f:
+            assert json.load(f)["city"] == "Paris"
+        # The pointer goes through the data directory, so it can be moved
+        with open(os.path.join(self.tmp_dir.name, "current", "quiz.mp4"), "rb") as f:
+            assert f.read() == b"Paris"
+        assert self.bank.pending() == added[1:]
+
+        self.bank.publish()
+        self.bank.publish()
+        # The live quiz and one before it are kept
+        assert [version for version, _ in self.bank.versions()] == added[1:]
+        assert self.bank.live_version() == added[2]
+        with self.assertRaises(ValueError):
+            self.bank.publish()
+
+        # An earlier quiz can be published again
+        self.bank.publish(added[1])
+        assert self.bank.live_version() == added[1]
+
+    def test_failed_build_leaves_nothing(self):
+        def build(version_dir):
+            raise RuntimeError("no route")
+
+        with self.assertRaises(RuntimeError):
+            self.bank.add(build)
+
+        assert os.listdir(self.bank.bank_dir) == []
+        assert self.bank.pending() == []
+
+    def test_unfinished_builds_are_not_published(self):
+        version, version_dir = self.bank.new_version()
+
+        assert self.bank.pending() == []
+        with self.assertRaises(ValueError):
+            self.bank.publish(version)
+
+    def test_readers_never_see_a_mix(self):
+        cities = [f"City {nr}" for nr in range(20)]
+        versions = [self.bank.add(build_quiz(city)) for city in cities]
+        self.bank.publish(versions[0])
+        stop = threading.Event()
+        mixed = []
+
+        def read():
+            while not stop.is_set():
+                live_dir = self.bank.live_dir()
+                with open(os.path.join(live_dir, "quiz.json")) as f:
+                    city = json.load(f)["city"]
+                with open(os.path.join(live_dir, "quiz.mp4"), "rb") as f:
+                    if f.read().decode() != city:
+                        mixed.append(city)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        bank = QuizBank(self.tmp_dir.name, keep_published=len(cities))
+        for version in versions[1:]:
+            bank.publish(version)
+        stop.set()
+        reader.join()
+
+        assert mixed == []
+        assert bank.live_version() == versions[-1]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import json
+import time
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from quiz.quiz_creator import create_quizzes, QuizClues
+from quiz.disk_cache import DiskCache
+from tests.stub_server import StubServer
+
+
+def completion(clues, explanations):
+    arguments = json.dumps({"clues": clues, "explanations": explanations})
+    return json.dumps({
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-4",
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": None,
+                        "function_call": {"name": "QuizClues", "arguments": arguments}},
+        }],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }).encode()
+
+
+def city_of(body):
+    prompt = json.loads(body)["messages"][0]["content"]
+    return prompt.split("the answer is ")[1].split(".")[0]
+
+
+class QuizCreatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = DiskCache(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_batch_is_concurrent_and_cached(self):
+        lock = threading.Lock()
+        state = {"in_flight": 0, "max_in_flight": 0}
+
+        def handler(method, path, query, body):
+            city = city_of(body)
+            with lock:
+                state["in_flight"] += 1
+                state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            time.sleep(0.1)
+            with lock:
+                state["in_flight"] -= 1
+            return 200, "application/json", completion([f"{city} clue {nr}..." for nr in range(5)],
+                                                       [f"{city} explanation {nr}" for nr in range(5)])
+
+        cities = ["Paris", "Rome", "Oslo", "Lima", "Cairo", "Quito"]
+        with StubServer(handler) as server:
+            results = asyncio.run(create_quizzes(cities, max_concurrency=3, base_url=server.url,
+                                                 openai_api_key="test", cache=self.cache))
+            assert [path for _, path, _ in server.requests] == ["/chat/completions"] * 6
+
+            again = asyncio.run(create_quizzes(cities, base_url=server.url, openai_api_key="test", cache=self.cache))
+            assert len(server.requests) == 6
+
+            # A new prompt version is not served from the cache
+            asyncio.run(create_quizzes(["Paris"], prompt_version=2, base_url=server.url, openai_api_key="test",
+                                       cache=self.cache))
+            assert len(server.requests) == 7
+
+        assert state["max_in_flight"] == 3
+        assert results["Rome"].clues[0] == "Rome clue 0..."
+        assert again["Rome"].model_dump() == results["Rome"].model_dump()
+
+    def test_only_valid_clues_are_cached(self):
+        attempts = {}
+
+        def handler(method, path, query, body):
+            city = city_of(body)
+            attempts[city] = attempts.get(city, 0) + 1
+            # Paris gets 4 clues on the first attempt, Atlantis never gets 5
+            if city == "Atlantis" or attempts[city] == 1:
+                return 200, "application/json", completion(["clue..."] * 4, ["explanation"] * 4)
+            return 200, "application/json", completion(["clue..."] * 5, ["explanation"] * 5)
+
+        with StubServer(handler) as server:
+            results = asyncio.run(create_quizzes(["Paris", "Atlantis"], base_url=server.url, openai_api_key="test",
+                                                 cache=self.cache))
+
+        assert isinstance(results["Paris"], QuizClues)
+        assert attempts["Paris"] == 2
+        assert isinstance(results["Atlantis"], Exception)
+        assert attempts["Atlantis"] == 3
+        assert len(self.cache) == 1
+
+    def test_shape_is_validated(self):
+        with self.assertRaises(ValueError):
+            QuizClues(clues=["clue..."] * 5, explanations=["explanation"] * 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
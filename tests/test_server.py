@@ -0,0 +1,188 @@
+import os
+import json
+import base64
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+# The server creates its database on import, keep it in memory
+os.environ['RR_DATABASE_URI'] = 'sqlite://'
+os.environ.setdefault('GOOGLE_OAUTH_KEY', 'test')
+os.environ.setdefault('GOOGLE_OAUTH_SECRET', 'test')
+
+import server
+from quiz.quiz_bank import QuizBank
+from quiz.video_creator import write_video_manifest
+from server import db, User, GameScore, MonthlyTotal, record_game_score, rebuild_monthly_totals, \
+    check_monthly_totals, month_key
+
+
+def build_hls_quiz(city):
+    def build(version_dir):
+        with open(os.path.join(version_dir, "quiz.json"), "w") as f:
+            json.dump({"city": city, "clues": [], "explanations": []}, f)
+        with open(os.path.join(version_dir, "quiz.mp4"), "wb") as f:
+            f.write(city.encode())
+        os.makedirs(os.path.join(version_dir, "hls", "desktop"))
+        with open(os.path.join(version_dir, "hls", "master.m3u8"), "w") as f:
+            f.write("#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=800000\ndesktop/index.m3u8\n")
+        with open(os.path.join(version_dir, "hls", "desktop", "index.m3u8"), "w") as f:
+            f.write("#EXTM3U\n#EXTINF:2.0,\nsegment_000.ts\n#EXT-X-ENDLIST\n")
+        with open(os.path.join(version_dir, "hls", "desktop", "segment_000.ts"), "wb") as f:
+            f.write(city.encode())
+        return city
+    return build
+
+
+class ServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"RR_DATA_PATH": self.tmp_dir.name})
+        self.env.start()
+        self.bank = QuizBank(self.tmp_dir.name)
+        self.client = server.app.test_client()
+        self.app_context = server.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+        self.env.stop()
+        self.tmp_dir.cleanup()
+
+    def add_user(self, user_name):
+        user = User(google_user_id=user_name, user_name=user_name, daily_score=-1)
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+    def monthly_totals(self):
+        return {(row.user_id, row.month): (row.total_score, row.games_played) for row in MonthlyTotal.query.all()}
+
+    def test_video_page_streams_the_live_version(self):
+        version = self.bank.add(build_hls_quiz("Paris"))
+        self.bank.publish(version)
+
+        page = self.client.get("/video").get_data(as_text=True)
+
+        assert f"/hls/{version}/master.m3u8" in page
+        assert "<source" not in page
+
+    def test_hls_mimetypes_and_cache_headers(self):
+        version = self.bank.add(build_hls_quiz("Paris"))
+        self.bank.publish(version)
+
+        playlist = self.client.get(f"/hls/{version}/desktop/index.m3u8")
+        segment = self.client.get(f"/hls/{version}/desktop/segment_000.ts")
+
+        assert playlist.status_code == 200
+        assert playlist.mimetype == "application/vnd.apple.mpegurl"
+        assert segment.mimetype == "video/mp2t"
+        assert segment.get_data() == b"Paris"
+        assert segment.cache_control.public
+        assert segment.cache_control.max_age > 0
+        assert segment.expires is not None
+
+    def test_hls_rejects_traversal_and_other_files(self):
+        version = self.bank.add(build_hls_quiz("Paris"))
+        self.bank.publish(version)
+        pending = self.bank.add(build_hls_quiz("Rome"))
+
+        assert self.client.get(f"/hls/{version}/../quiz.json").status_code == 404
+        assert self.client.get(f"/hls/{version}/%2e%2e/quiz.json").status_code == 404
+        assert self.client.get(f"/hls/{version}/desktop/../../quiz.json").status_code == 404
+        assert self.client.get(f"/hls/{version}/desktop").status_code == 404
+        assert self.client.get("/hls/..%2Fbank/master.m3u8").status_code == 404
+        # A quiz that was not published yet is not served
+        assert self.client.get(f"/hls/{pending}/master.m3u8").status_code == 404
+
+    def test_previous_quiz_is_served_after_a_publish(self):
+        first = self.bank.add(build_hls_quiz("Paris"))
+        second = self.bank.add(build_hls_quiz("Rome"))
+        self.bank.publish(first)
+        self.bank.publish(second)
+
+        assert self.client.get(f"/hls/{first}/desktop/segment_000.ts").get_data() == b"Paris"
+        assert self.client.get(f"/hls/{second}/desktop/segment_000.ts").get_data() == b"Rome"
+
+    def test_hls_version_without_the_bank_is_the_video_checksum(self):
+        build_hls_quiz("Paris")(self.tmp_dir.name)
+        version = write_video_manifest(os.path.join(self.tmp_dir.name, "quiz.mp4"), 1.0)["sha256"][:16]
+
+        page = self.client.get("/video").get_data(as_text=True)
+
+        assert f"/hls/{version}/master.m3u8" in page
+        assert self.client.get(f"/hls/{version}/desktop/segment_000.ts").get_data() == b"Paris"
+        assert self.client.get("/hls/fedcba9876543210/desktop/segment_000.ts").status_code == 404
+
+    def test_video_url_carries_the_version(self):
+        first = self.bank.add(build_hls_quiz("Paris"))
+        second = self.bank.add(build_hls_quiz("Rome"))
+        pending = self.bank.add(build_hls_quiz("Oslo"))
+        self.bank.publish(first)
+
+        assert f"/get_video/{first}" in self.client.get("/video").get_data(as_text=True)
+        video = self.client.get(f"/get_video/{first}")
+        assert video.get_data() == b"Paris"
+        assert video.mimetype == "video/mp4"
+        assert video.cache_control.public
+
+        # After a publish the page and the unversioned url move to the new video, the old one stays where it was
+        self.bank.publish(second)
+        assert f"/get_video/{second}" in self.client.get("/video").get_data(as_text=True)
+        assert self.client.get("/get_video").headers["Location"].endswith(f"/get_video/{second}")
+        assert self.client.get(f"/get_video/{second}").get_data() == b"Rome"
+        assert self.client.get(f"/get_video/{first}").get_data() == b"Paris"
+        assert self.client.get(f"/get_video/{pending}").status_code == 404
+        assert self.client.get("/get_video/0123456789abcdef").status_code == 404
+
+    def test_record_game_score_adds_to_the_monthly_total(self):
+        alice, bob = self.add_user("alice"), self.add_user("bob")
+        this_month = month_key(datetime.utcnow())
+
+        # Two scores of the same month in one transaction, the second one updates the row the first one inserted
+        record_game_score(alice, 10)
+        record_game_score(alice, 5)
+        record_game_score(alice, 7, played_at=datetime(2024, 3, 9))
+        record_game_score(bob, 3)
+        db.session.commit()
+
+        assert GameScore.query.count() == 4
+        assert self.monthly_totals() == {(alice, this_month): (15, 2), (alice, "2024-03"): (7, 1),
+                                         (bob, this_month): (3, 1)}
+
+    def test_rebuild_and_check_monthly_totals(self):
+        alice, bob = self.add_user("alice"), self.add_user("bob")
+        this_month = month_key(datetime.utcnow())
+        for user_id, score in [(alice, 10), (alice, 5), (bob, 3)]:
+            record_game_score(user_id, score)
+        db.session.commit()
+        assert check_monthly_totals() == []
+
+        # A score without its total, and a total that is off
+        db.session.add(GameScore(user_id=bob, score=4))
+        MonthlyTotal.query.filter_by(user_id=alice).update({MonthlyTotal.total_score: 1})
+        db.session.commit()
+        assert check_monthly_totals() == [(alice, 1, 15), (bob, 3, 7)]
+
+        assert rebuild_monthly_totals() == 2
+        assert check_monthly_totals() == []
+        assert self.monthly_totals() == {(alice, this_month): (15, 2), (bob, this_month): (7, 2)}
+
+    def test_clear_quiz_waits_for_the_jobs_of_the_data_directory(self):
+        build_hls_quiz("Paris")(self.tmp_dir.name)
+        headers = {"Authorization": "Basic " + base64.b64encode(b"admin:pw").decode()}
+
+        with mock.patch.dict(server.users, {"admin": "pw"}):
+            with server.job_runner.lock(self.tmp_dir.name, "new_video"):
+                response = self.client.get("/clear_quiz", headers=headers)
+                assert response.status_code == 409
+                assert response.get_json()["job_id"] == "new_video"
+                assert os.path.exists(os.path.join(self.tmp_dir.name, "quiz.json"))
+
+            assert self.client.get("/clear_quiz", headers=headers).status_code == 200
+            assert not os.path.exists(os.path.join(self.tmp_dir.name, "quiz.json"))
@@ -1,9 +1,77 @@
-from quiz.street_view_collector import is_gray_image, duration_to_num_points, calculate_heading
+from quiz.street_view_collector import is_gray_image, duration_to_num_points, calculate_heading, StreetViewFetcher, \
+    street_view_params, fetch_street_view_images, load_frame_status, pending_frame_indices, street_view_cache_key, \
+    is_gray_batch, perceptual_hash, hamming_distance, street_view_frames, FrameCompositor, add_boarder, \
+    add_logo_on_top, RouteFinder, start_points, resample_path, calculate_headings, segment_distances, fetch_size, \
+    crop_to_view, create_new_frames, stream_new_frames
+from quiz import street_view_collector
+from quiz.disk_cache import DiskCache
+from tests.stub_server import StubServer
+from io import BytesIO
+from PIL import Image
+import numpy as np
+import polyline
+import json
+import time
+import os
+import tempfile
+import threading
+import pickle
 import unittest
+from contextlib import contextmanager
+from unittest import mock
 
 import pytest
 
 
+def jpeg_bytes(color, size=(64, 48)):
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def image_to_jpeg(image, quality=75):
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def noisy_jpeg_bytes(seed=0, size=(64, 48)):
+    # Coarse noise scaled up, with structure like a photo rather than per pixel noise
+    pixels = np.random.default_rng(seed).integers(0, 256, (max(1, size[1] // 8), max(1, size[0] // 8), 3),
+                                                  dtype=np.uint8)
+    return image_to_jpeg(Image.fromarray(pixels).resize(size, Image.BILINEAR))
+
+
+STRAIGHT_PATH = [(i, 0.0) for i in range(9)]  # 9 points, the latitude is the index of the point
+
+
+def save_path_coordinates(data_dir, path_coordinates):
+    with open(os.path.join(data_dir, "path_coordinates.pkl"), "wb") as f:
+        pickle.dump(path_coordinates, f)
+
+
+def requested_latitudes(server):
+    return [int(float(query["location"].split(",")[0])) for _, _, query in server.requests]
+
+
+@contextmanager
+def stub_street_view(handler, path_coordinates=None):
+    """
+    A data directory, with path_coordinates if given, for a collector that fetches from a stub server without a cache
+    :param handler: handler of the StubServer
+    :param path_coordinates: path to save in the data directory
+    :return: context manager of (data directory, StubServer)
+    """
+    with tempfile.TemporaryDirectory() as data_dir, StubServer(handler) as server:
+        if path_coordinates is not None:
+            save_path_coordinates(data_dir, path_coordinates)
+        fetcher = lambda workers, cache: StreetViewFetcher(workers=workers, base_url=server.url, cache=cache,
+                                                           backoff_factor=0)
+        with mock.patch.object(street_view_collector, "StreetViewFetcher", fetcher), \
+                mock.patch.object(street_view_collector, "street_view_cache", lambda: None):
+            yield data_dir, server
+
+
 class StreetViewCollectorTests(unittest.TestCase):
 
     def test_valid_input_values(self):
@@ -48,4 +116,454 @@ class StreetViewCollectorTests(unittest.TestCase):
         result = is_gray_image(image_data)
 
         # Assert
-        assert result == False
\ No newline at end of file
+        assert result == False
+
+    def test_fetcher_keeps_path_order_and_retries(self):
+        # Arrange: the stub fails the first request for every location and answers with an image encoding the latitude
+        path_coordinates = [(i, 0.0) for i in range(21)]
+        seen = set()
+        lock = threading.Lock()
+
+        def handler(method, path, query, body):
+            lat = int(float(query["location"].split(",")[0]))
+            with lock:
+                first_attempt = lat not in seen
+                seen.add(lat)
+            if first_attempt:
+                return 503, "text/plain", b"busy"
+            return 200, "image/jpeg", jpeg_bytes((lat * 10, 0, 0))
+
+        with StubServer(handler) as server:
+            fetcher = StreetViewFetcher(workers=4, base_url=server.url, backoff_factor=0)
+            frame_params = street_view_params(path_coordinates, "64x48", "test")
+
+            # Act
+            results = list(fetcher.fetch(frame_params))
+            fetcher.close()
+
+        # Assert
+        assert [index for index, _ in results] == list(range(20))
+        for index, image_data in results:
+            red = Image.open(BytesIO(image_data)).getpixel((10, 10))[0]
+            assert abs(red - index * 10) < 5
+        assert fetcher.frames_fetched == 20
+        assert fetcher.frames_failed == 0
+        assert len(server.requests) == 40
+        assert fetcher.frames_per_second() > 0
+
+    def test_fetcher_gives_up_after_retries(self):
+        with StubServer(lambda method, path, query, body: (500, "text/plain", b"error")) as server:
+            fetcher = StreetViewFetcher(workers=2, base_url=server.url, retries=2, backoff_factor=0)
+            results = list(fetcher.fetch(street_view_params([(0, 0), (1, 0), (2, 0)], "64x48", "test")))
+            fetcher.close()
+
+        assert results == [(0, None), (1, None)]
+        assert fetcher.frames_failed == 2
+        assert len(server.requests) == 6
+
+    def test_resume_only_fetches_missing_indices(self):
+        # Arrange: even latitudes fail on the first run, latitude 3 is gray
+        path_coordinates = [(i, 0.0) for i in range(9)]
+        failing = {0, 2, 4, 6}
+
+        def handler(method, path, query, body):
+            lat = int(float(query["location"].split(",")[0]))
+            if lat in failing:
+                return 404, "text/plain", b"missing"
+            if lat == 3:
+                return 200, "image/jpeg", jpeg_bytes((128, 128, 128))
+            return 200, "image/jpeg", noisy_jpeg_bytes(lat)
+
+        with tempfile.TemporaryDirectory() as data_dir, StubServer(handler) as server:
+            fetcher = StreetViewFetcher(workers=2, base_url=server.url, backoff_factor=0)
+            frames_folder = os.path.join(data_dir, "frames")
+
+            # Act: first run
+            frame_status = load_frame_status(data_dir)
+            fetch_street_view_images(path_coordinates, data_dir, api_key="test", crop_bottom=False, fetcher=fetcher,
+                                     indices=pending_frame_indices(frame_status, frames_folder, 8),
+                                     frame_status=frame_status)
+
+            # Assert: the status manifest is on disk and only the failed indices are pending
+            frame_status = load_frame_status(data_dir)
+            assert frame_status[1] == {"status": "fetched", "attempts": 1}
+            assert frame_status[3] == {"status": "gray", "attempts": 1}
+            assert frame_status[0] == {"status": "failed", "attempts": 1}
+            assert pending_frame_indices(frame_status, frames_folder, 8) == [0, 2, 4, 6]
+
+            # Act: resume after the failures are fixed
+            failing.clear()
+            server.requests.clear()
+            fetch_street_view_images(path_coordinates, data_dir, api_key="test", crop_bottom=False, fetcher=fetcher,
+                                     indices=pending_frame_indices(frame_status, frames_folder, 8),
+                                     frame_status=frame_status)
+            fetcher.close()
+
+            # Assert
+            requested = sorted(requested_latitudes(server))
+            assert requested == [0, 2, 4, 6]
+            assert load_frame_status(data_dir)[0] == {"status": "fetched", "attempts": 2}
+            assert pending_frame_indices(load_frame_status(data_dir), frames_folder, 8) == []
+            assert sorted(os.listdir(frames_folder)) == ["0.jpg", "1.jpg", "2.jpg", "4.jpg", "5.jpg", "6.jpg", "7.jpg"]
+
+    def test_second_run_is_served_from_cache(self):
+        path_coordinates = [(i, 0.0) for i in range(6)]
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                StubServer(lambda method, path, query, body: (200, "image/jpeg", noisy_jpeg_bytes())) as server:
+            frame_params = street_view_params(path_coordinates, "64x48", "test")
+
+            first = StreetViewFetcher(workers=2, base_url=server.url, cache=DiskCache(cache_dir))
+            first_results = list(first.fetch(frame_params))
+            first.close()
+
+            second = StreetViewFetcher(workers=2, base_url=server.url, cache=DiskCache(cache_dir))
+            second_results = list(second.fetch(frame_params))
+            second.close()
+
+        assert first.network_requests == 5
+        assert second.network_requests == 0
+        assert second.cache.hits == 5
+        assert len(server.requests) == 5
+        assert second_results == first_results
+
+    def test_cache_key_tolerance(self):
+        params = {"location": "47.37690,8.54170", "heading": 90.0, "size": "390x640", "fov": "120", "pitch": "0"}
+        close_by = dict(params, location="47.376901,8.541701", heading=91.0)
+        far_away = dict(params, location="47.37790,8.54170")
+        other_heading = dict(params, heading=120.0)
+
+        assert street_view_cache_key(params) == street_view_cache_key(close_by)
+        assert street_view_cache_key(params) != street_view_cache_key(far_away)
+        assert street_view_cache_key(params) != street_view_cache_key(other_heading)
+
+    def test_gray_batch(self):
+        gray = Image.new("RGB", (64, 48), (128, 128, 128))
+        street = Image.open(BytesIO(noisy_jpeg_bytes()))
+
+        assert list(is_gray_batch([gray, street, gray])) == [True, False, True]
+        assert is_gray_image(gray) is True
+        assert is_gray_image(noisy_jpeg_bytes()) is False
+
+    def test_perceptual_hash_finds_near_duplicates(self):
+        image = Image.open(BytesIO(noisy_jpeg_bytes(1, size=(390, 610))))
+        recompressed = Image.open(BytesIO(image_to_jpeg(image, quality=60)))
+        other = Image.open(BytesIO(noisy_jpeg_bytes(2, size=(390, 610))))
+
+        assert hamming_distance(perceptual_hash(image), perceptual_hash(recompressed)) <= 4
+        assert hamming_distance(perceptual_hash(image), perceptual_hash(other)) > 4
+
+    def test_neighbouring_duplicates_are_dropped(self):
+        # Arrange: points 1 and 2 return the same panorama as point 0, point 4 the same as point 3
+        panoramas = {0: 0, 1: 0, 2: 0, 3: 3, 4: 3, 5: 5}
+        path_coordinates = [(i, 0.0) for i in range(7)]
+
+        def handler(method, path, query, body):
+            lat = int(float(query["location"].split(",")[0]))
+            return 200, "image/jpeg", noisy_jpeg_bytes(panoramas[lat], size=(128, 96))
+
+        with StubServer(handler) as server:
+            fetcher = StreetViewFetcher(workers=2, base_url=server.url)
+
+            # Act
+            frames = list(street_view_frames(path_coordinates, api_key="test", crop_bottom=False, fetcher=fetcher,
+                                             batch_size=4))
+            fetcher.close()
+
+        # Assert
+        assert [(i, status) for i, status, _ in frames] == [
+            (0, "fetched"), (1, "duplicate"), (2, "duplicate"), (3, "fetched"), (4, "duplicate"), (5, "fetched")]
+
+    def test_duplicate_frames_count_towards_the_threshold(self):
+        # Arrange: the whole route returns the same panorama, only the first frame is written
+        with stub_street_view(lambda method, path, query, body: (200, "image/jpeg", noisy_jpeg_bytes()),
+                              STRAIGHT_PATH) as (data_dir, server):
+            # Act
+            create_new_frames(data_dir, workers=2, views=["desktop"])
+
+            # Assert: a single pass, the duplicates are not fetched again
+            assert len(server.requests) == 8
+            assert os.listdir(os.path.join(data_dir, "frames")) == ["0.jpg"]
+            assert pending_frame_indices(load_frame_status(data_dir), os.path.join(data_dir, "frames"), 8) == []
+
+    def test_frames_of_another_path_are_not_reused(self):
+        # Arrange: the image tells the latitude of the point, all of them are different
+        def handler(method, path, query, body):
+            return 200, "image/jpeg", noisy_jpeg_bytes(int(float(query["location"].split(",")[0]) * 10))
+
+        with stub_street_view(handler) as (data_dir, server):
+            for path_coordinates in (STRAIGHT_PATH, [(i + 0.5, 0.0) for i in range(5)]):
+                save_path_coordinates(data_dir, path_coordinates)
+                server.requests.clear()
+
+                # Act
+                create_new_frames(data_dir, workers=2, views=["desktop"])
+
+            # Assert: the second path is fetched in full, and the frames of the first one are gone
+            assert len(server.requests) == 4
+            assert sorted(os.listdir(os.path.join(data_dir, "frames"))) == ["0.jpg", "1.jpg", "2.jpg", "3.jpg"]
+            assert sorted(load_frame_status(data_dir)) == [0, 1, 2, 3]
+
+    def test_stream_keeps_a_place_for_dropped_images(self):
+        # Arrange: points 2 and 3 are duplicates of point 1, point 5 fails
+        panoramas = {0: 0, 1: 1, 2: 1, 3: 1, 4: 4, 6: 6, 7: 7}
+
+        def handler(method, path, query, body):
+            lat = int(float(query["location"].split(",")[0]))
+            if lat not in panoramas:
+                return 404, "text/plain", b"missing"
+            return 200, "image/jpeg", noisy_jpeg_bytes(panoramas[lat])
+
+        with stub_street_view(handler, STRAIGHT_PATH) as (data_dir, server):
+            # Act
+            frames = list(stream_new_frames(data_dir, workers=2))
+
+        # Assert
+        assert [frame is not None for frame in frames] == [True, True, False, False, True, False, True, True]
+
+    def test_stream_retries_failed_frames_and_resumes(self):
+        # Arrange: point 5 always fails, point 2 fails once
+        failures = {2: 1, 5: 100}
+
+        def handler(method, path, query, body):
+            lat = int(float(query["location"].split(",")[0]))
+            if failures.get(lat, 0) > 0:
+                failures[lat] -= 1
+                return 404, "text/plain", b"missing"
+            return 200, "image/jpeg", noisy_jpeg_bytes(lat)
+
+        with stub_street_view(handler, STRAIGHT_PATH) as (data_dir, server):
+            # Act: first run
+            first = list(stream_new_frames(data_dir, workers=2, save_frames=True))
+            first_requests = requested_latitudes(server)
+
+            # Act: the second run only fetches the frame that failed
+            server.requests.clear()
+            second = list(stream_new_frames(data_dir, workers=2, save_frames=True))
+            second_requests = requested_latitudes(server)
+            frame_status = load_frame_status(data_dir)
+
+        # Assert
+        assert [frame is not None for frame in first] == [True, True, True, True, True, False, True, True]
+        assert first_requests.count(2) == 2
+        assert first_requests.count(5) == 3
+        assert frame_status[2] == {"status": "fetched", "attempts": 1}
+        assert frame_status[5] == {"status": "failed", "attempts": 2}
+        assert second_requests == [5, 5, 5]
+        assert [frame is not None for frame in second] == [frame is not None for frame in first]
+        assert second[0].size == first[0].size
+
+    def test_stream_fetches_every_stride_th_point(self):
+        def handler(method, path, query, body):
+            return 200, "image/jpeg", noisy_jpeg_bytes(int(float(query["location"].split(",")[0])))
+
+        with stub_street_view(handler, STRAIGHT_PATH) as (data_dir, server):
+            frames = list(stream_new_frames(data_dir, workers=2, fetch_stride=3))
+
+        assert len(frames) == 3
+        assert sorted(requested_latitudes(server)) == [0, 3, 6]
+
+    def test_stream_fails_as_soon_as_half_of_the_frames_failed(self):
+        frames = []
+
+        with stub_street_view(lambda method, path, query, body: (404, "text/plain", b"missing"),
+                              STRAIGHT_PATH) as (data_dir, server):
+            with pytest.raises(Exception, match="Failed to create frames"):
+                for frame in stream_new_frames(data_dir, workers=2, retries=0):
+                    frames.append(frame)
+
+        # 4 of 8 failed frames leave less than half of the 9 points, the fourth one raises
+        assert frames == [None, None, None]
+
+    def test_compositor_border_matches_add_boarder(self):
+        frame = Image.open(BytesIO(noisy_jpeg_bytes(3, size=(390, 610))))
+
+        expected = np.asarray(add_boarder(frame, 540, 960), dtype=np.int16)
+        actual = np.asarray(FrameCompositor().add_border(frame, 540, 960), dtype=np.int16)
+
+        assert actual.shape == expected.shape
+        assert np.abs(actual - expected).mean() < 1
+        assert np.abs(actual - expected).max() <= 8
+
+    def test_compositor_logo_matches_add_logo_on_top(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logo_path = os.path.join(tmp_dir, "logo.png")
+            Image.open("./static/logo.png").convert("RGBA").resize((200, 100)).save(logo_path)
+            frame = Image.open(BytesIO(noisy_jpeg_bytes(4, size=(390, 610))))
+            compositor = FrameCompositor(logo_path)
+
+            expected = add_logo_on_top(frame.copy(), logo_path)
+            actual = compositor.add_logo(frame.copy())
+            compositor.add_logo(frame.copy())
+
+        assert list(compositor._logos) == [(390, 610)]
+        assert np.array_equal(np.asarray(actual), np.asarray(expected))
+
+    def test_fetch_stride_faces_the_next_fetched_point(self):
+        path_coordinates = [(47.0 + i * 1e-3, 8.0 + (i // 4) * 1e-3) for i in range(11)]
+
+        params = street_view_params(path_coordinates, "630x400", "test", stride=4)
+
+        assert [i for i, _ in params] == [0, 4, 8]
+        assert params[0][1]["heading"] == calculate_heading(*path_coordinates[0], *path_coordinates[4])
+        assert params[2][1]["heading"] == calculate_heading(*path_coordinates[8], *path_coordinates[10])
+        assert [i for i, _ in street_view_params(path_coordinates, "630x400", "test")] == list(range(10))
+        assert pending_frame_indices({4: {"status": "gray", "attempts": 1}}, "/nonexistent", 10, 4) == [0, 8]
+
+    def test_one_fetch_size_covers_every_view(self):
+        assert fetch_size(["desktop"]) == "630x400"
+        assert fetch_size(["mobile", "desktop"]) == "630x640"
+
+        frame = np.arange(640 * 630, dtype=np.int64).reshape(640, 630, 1).repeat(3, axis=2)
+        mobile = crop_to_view(frame, "mobile")
+        desktop = crop_to_view(frame, "desktop")
+        assert mobile.shape == (610, 390, 3)
+        assert desktop.shape == (370, 630, 3)
+        # Both are cut out of the center, the bottom strip with the logo is removed
+        assert mobile[0, 0, 0] == frame[0, 120, 0]
+        assert desktop[0, 0, 0] == frame[120, 0, 0]
+        with pytest.raises(ValueError):
+            crop_to_view(desktop, "mobile")
+
+    def test_start_points_are_at_the_radius(self):
+        points = start_points((47.37, 8.54), [0, 90, 180, 270], [8, 12])
+
+        assert len(points) == 8
+        assert points[0][0] > 47.37 and abs(points[0][1] - 8.54) < 1e-9
+        assert points[2][0] < 47.37
+        # 8 km north is about 0.072 degrees, the second radius comes after all bearings of the first
+        assert abs(points[0][0] - 47.37 - 0.0719) < 1e-3
+        assert abs(points[4][0] - 47.37 - 0.1079) < 1e-3
+
+    def test_route_finder_stops_at_first_route(self):
+        route = polyline.encode([(47.4, 8.5), (47.41, 8.5), (47.41, 8.51)])
+        calls = []
+
+        def handler(method, path, query, body):
+            calls.append(query["origin"])
+            if len(calls) == 3:
+                return 200, "application/json", json.dumps(
+                    {"status": "OK", "routes": [{"overview_polyline": {"points": route}}]}).encode()
+            return 200, "application/json", json.dumps({"status": "ZERO_RESULTS", "routes": []}).encode()
+
+        with StubServer(handler) as server:
+            finder = RouteFinder(workers=1, max_requests=20, base_url=server.url, api_key="test")
+            path_coordinates = finder.find("Zurich", 30, destination_coord=(47.37, 8.54))
+            finder.close()
+
+        # A route with 3 vertices is resampled to the 30 points of the video
+        assert len(path_coordinates) == 30
+        assert path_coordinates[0] == (47.4, 8.5)
+        assert path_coordinates[-1] == (47.41, 8.51)
+        # Requests queued after the route was found are cancelled
+        assert finder.requests_made < 20
+        assert all(path == "/" for _, path, _ in server.requests)
+
+    def test_route_finder_best_picks_longest_route(self):
+        def handler(method, path, query, body):
+            lat = float(query["origin"].split(",")[0])
+            # The route from the north is the longest
+            end = (47.5, 8.5) if lat > 47.43 else (47.41, 8.5)
+            route = polyline.encode([(47.4, 8.5), end])
+            return 200, "application/json", json.dumps(
+                {"status": "OK", "routes": [{"overview_polyline": {"points": route}}]}).encode()
+
+        with StubServer(handler) as server:
+            finder = RouteFinder(workers=4, max_requests=12, radii=(8,), base_url=server.url, api_key="test")
+            path_coordinates = finder.find("Zurich", 10, destination_coord=(47.37, 8.54), best=True)
+            finder.close()
+
+        assert len(server.requests) == 12
+        assert path_coordinates[-1] == (47.5, 8.5)
+
+    def test_resample_path_is_evenly_spaced(self):
+        # An L shaped route with an uneven number of vertices per leg and a repeated point
+        route = [(47.0, 8.0), (47.001, 8.0), (47.001, 8.0), (47.01, 8.0), (47.01, 8.002), (47.01, 8.013)]
+
+        path_coordinates = resample_path(route, 50)
+
+        assert len(path_coordinates) == 50
+        assert path_coordinates[0] == route[0]
+        assert np.allclose(path_coordinates[-1], route[-1])
+        distances = segment_distances(path_coordinates)
+        assert np.allclose(distances, distances.mean(), rtol=0.05)
+        assert abs(distances.sum() - segment_distances(route).sum()) < distances.mean()
+
+        assert len(resample_path(route[:2], 300)) == 300
+        assert resample_path([(47.0, 8.0), (47.0, 8.0)], 10) == []
+        assert resample_path([(47.0, 8.0)], 10) == []
+
+    def test_calculate_headings_matches_calculate_heading(self):
+        points = [(47.0, 8.0), (47.01, 8.0), (47.01, 8.01), (47.0, 8.01), (46.99, 7.99)]
+
+        headings = calculate_headings(points)
+
+        expected = [calculate_heading(*points[i], *points[i + 1]) for i in range(len(points) - 1)]
+        assert np.allclose(headings, expected)
+        assert [params["heading"] for _, params in street_view_params(points, "64x48", "test")] == list(headings)
+
+    def test_route_finder_skips_short_routes(self):
+        short_route = polyline.encode([(47.4, 8.5), (47.4004, 8.5)])  # about 45 m
+        long_route = polyline.encode([(47.4, 8.5), (47.44, 8.5)])
+        calls = []
+
+        def handler(method, path, query, body):
+            calls.append(query["origin"])
+            route = short_route if len(calls) <= 2 else long_route
+            return 200, "application/json", json.dumps(
+                {"status": "OK", "routes": [{"overview_polyline": {"points": route}}]}).encode()
+
+        with StubServer(handler) as server:
+            finder = RouteFinder(workers=1, base_url=server.url, api_key="test")
+            path_coordinates = finder.find("Zurich", 300, destination_coord=(47.37, 8.54))
+            finder.close()
+
+        assert len(path_coordinates) == 300
+        assert path_coordinates[-1] == (47.44, 8.5)
+        assert len(calls) >= 3
+
+    def test_route_finder_skips_unreadable_responses(self):
+        route = polyline.encode([(47.4, 8.5), (47.41, 8.5)])
+        calls = []
+
+        def handler(method, path, query, body):
+            calls.append(query["origin"])
+            if len(calls) == 1:
+                return 200, "text/html", b"<html>Bad gateway</html>"
+            if len(calls) == 2:
+                return 200, "application/json", json.dumps({"status": "OK", "routes": []}).encode()
+            return 200, "application/json", json.dumps(
+                {"status": "OK", "routes": [{"overview_polyline": {"points": route}}]}).encode()
+
+        with StubServer(handler) as server:
+            finder = RouteFinder(workers=1, base_url=server.url, api_key="test")
+            # One request per start location by default
+            assert len(finder.candidates((47.37, 8.54))) == 36
+            path_coordinates = finder.find("Zurich", 10, destination_coord=(47.37, 8.54))
+            finder.close()
+
+        assert len(path_coordinates) == 10
+        assert 3 <= len(calls) < 36
+
+    def test_route_finder_respects_budgets(self):
+        def handler(method, path, query, body):
+            return 200, "application/json", json.dumps({"status": "ZERO_RESULTS", "routes": []}).encode()
+
+        with StubServer(handler) as server:
+            finder = RouteFinder(workers=4, max_requests=10, base_url=server.url, api_key="test")
+            assert finder.find("Zurich", 30, destination_coord=(47.37, 8.54)) == []
+            finder.close()
+        assert len(server.requests) == 10
+
+        def slow_handler(method, path, query, body):
+            time.sleep(0.2)
+            return handler(method, path, query, body)
+
+        with StubServer(slow_handler) as server:
+            finder = RouteFinder(workers=2, max_requests=36, time_budget=0.5, base_url=server.url, api_key="test")
+            start = time.perf_counter()
+            assert finder.find("Zurich", 30, destination_coord=(47.37, 8.54)) == []
+            finder.close()
+        assert time.perf_counter() - start < 1.5
+        assert finder.requests_made < 36
+
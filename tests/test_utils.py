@@ -1,5 +1,10 @@
-from utils import get_expiration_time, calculate_score, is_valid_username
+from utils import get_expiration_time, calculate_score, is_valid_username, get_video_duration, \
+    seconds_until_expiration, TimedCache, QuizStore, get_explanations
+from quiz.video_creator import write_video_manifest, read_video_manifest, read_valid_video_manifest
 import unittest
+import json
+import os
+import tempfile
 import pytz
 from datetime import datetime, time, timedelta
 
@@ -13,6 +18,10 @@ class TestUtils(unittest.TestCase):
             expected_datetime += timedelta(days=1)
         assert expiration_datetime == expected_datetime
 
+    def test_seconds_until_expiration(self):
+        seconds = seconds_until_expiration()
+        assert 0 <= seconds <= 24 * 60 * 60
+
     #  Calculate score for a video with time taken less than video duration
     def test_calculate_score_less_than_duration(self):
         time_taken = 20
@@ -32,6 +41,40 @@ class TestUtils(unittest.TestCase):
 
         assert actual_score == expected_score
 
+    #  Calculate score from the manifest, the video itself is never decoded
+    def test_calculate_score_from_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            video_file_path = os.path.join(tmp_dir, "quiz.mp4")
+            with open(video_file_path, "wb") as f:
+                f.write(b"not a real video")
+            write_video_manifest(video_file_path, 50.0)
+
+            assert read_video_manifest(video_file_path)["size"] == 16
+            assert get_video_duration(video_file_path) == 50.0
+            assert calculate_score(10, video_file_path) == 80
+            assert calculate_score(60, video_file_path) == 0
+
+    #  A manifest is only used while it belongs to the video, even if a rebuild has the same size
+    def test_manifest_of_another_build_is_not_used(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            video_file_path = os.path.join(tmp_dir, "quiz.mp4")
+            with open(video_file_path, "wb") as f:
+                f.write(b"not a real video")
+            write_video_manifest(video_file_path, 50.0)
+            assert read_valid_video_manifest(video_file_path)["duration"] == 50.0
+
+            # Touched after the manifest, e.g. copied, but the checksum is still the same
+            later = os.stat(video_file_path).st_mtime + 60
+            os.utime(video_file_path, (later, later))
+            assert read_valid_video_manifest(video_file_path)["duration"] == 50.0
+
+            # Rebuilt to the same size after the manifest
+            with open(video_file_path, "wb") as f:
+                f.write(b"another fake one")
+            os.utime(video_file_path, (later + 60, later + 60))
+            assert os.path.getsize(video_file_path) == read_video_manifest(video_file_path)["size"]
+            assert read_valid_video_manifest(video_file_path) is None
+
     def test_valid_username(self):
         assert is_valid_username("abc123") == True
         assert is_valid_username("1234567890") == True
@@ -47,3 +90,46 @@ class TestUtils(unittest.TestCase):
         assert is_valid_username("qwertyuiopasdfghjklzxcv") == False
         assert is_valid_username("AbCdEfGhIjKlMnOpQrStUvWxYz") == False
 
+    def test_timed_cache(self):
+        cache = TimedCache(ttl=60)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        assert cache.get_or_set("daily", compute) == 1
+        assert cache.get_or_set("daily", compute) == 1
+        cache.invalidate()
+        assert cache.get_or_set("daily", compute) == 2
+        assert cache.hits == 1
+        assert cache.misses == 2
+
+    def test_timed_cache_expires(self):
+        cache = TimedCache(ttl=0)
+        assert cache.get_or_set("daily", lambda: 1) == 1
+        assert cache.get_or_set("daily", lambda: 2) == 2
+
+    def test_quiz_store_reloads_only_on_change(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            quiz_path = os.path.join(tmp_dir, "quiz.json")
+            with open(quiz_path, "w") as f:
+                json.dump({"city": "Paris", "clues": ["A tower..."], "explanations": ["Eiffel"]}, f)
+            store = QuizStore()
+
+            quiz = store.get(quiz_path)
+            store.get(quiz_path)
+
+            assert quiz["city"] == "Paris"
+            assert quiz["explanations_html"] == get_explanations(quiz_path)
+            assert store.stats()["hits"] == 1
+            assert store.stats()["reloads"] == 1
+
+            with open(quiz_path, "w") as f:
+                json.dump({"city": "Beijing", "clues": [], "explanations": []}, f)
+            os.utime(quiz_path, ns=(0, 0))
+
+            assert store.get(quiz_path)["city"] == "Beijing"
+            store.invalidate()
+            assert store.get(quiz_path)["city"] == "Beijing"
+            assert store.stats()["reloads"] == 3
@@ -0,0 +1,292 @@
+from quiz.video_creator import prefetch, frames_to_video, images_to_video, encode_video, encode_variants, VideoVariant, \
+    package_hls, read_hls_playlist, tween_frames, synthesize_frames, build_variants
+from PIL import Image
+import numpy as np
+import cv2
+import os
+import tempfile
+import threading
+import unittest
+import wave
+
+import pytest
+
+
+def write_wav(path, duration, rate=44100):
+    samples = (np.sin(np.linspace(0, 440 * 2 * np.pi * duration, int(rate * duration))) * 10000).astype(np.int16)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(samples.tobytes())
+
+
+def count_frames(video_path):
+    capture = cv2.VideoCapture(video_path)
+    frames = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append(frame)
+    capture.release()
+    return frames
+
+
+class VideoCreatorTests(unittest.TestCase):
+
+    def test_prefetch_keeps_order(self):
+        assert list(prefetch(iter(range(100)), maxsize=4)) == list(range(100))
+
+    def test_prefetch_raises_producer_errors(self):
+        def frames():
+            yield 1
+            raise RuntimeError("fetch failed")
+
+        with pytest.raises(RuntimeError):
+            list(prefetch(frames()))
+
+    def test_prefetch_stops_and_closes_the_source(self):
+        closed = threading.Event()
+
+        def frames():
+            try:
+                i = 0
+                while True:
+                    yield i
+                    i += 1
+            finally:
+                closed.set()
+
+        # Hold a reference, so only prefetch can close the source
+        source = frames()
+        prefetched = prefetch(source, maxsize=2)
+        assert [next(prefetched) for _ in range(3)] == [0, 1, 2]
+        prefetched.close()
+
+        # The producer was blocked on the full queue, it stops and closes the source
+        assert closed.wait(timeout=5)
+
+    def test_streams_frames_without_disk_round_trip(self):
+        images = [Image.new("RGB", (64, 48), (i * 40, 100, 200 - i * 40)) for i in range(5)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            # Streamed: PIL images straight into the writer
+            images_to_video(data_dir, frames=iter(images))
+            streamed = cv2.VideoCapture(os.path.join(data_dir, "quiz_no_audio.mp4"))
+            streamed_count = int(streamed.get(cv2.CAP_PROP_FRAME_COUNT))
+            streamed.release()
+
+            assert streamed_count == 5 * int(24 * 0.4)
+            assert not os.path.exists(os.path.join(data_dir, "frames"))
+
+    def test_frames_to_video_rejects_mixed_sizes(self):
+        images = [Image.new("RGB", (64, 48)), Image.new("RGB", (32, 48))]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            with pytest.raises(ValueError):
+                frames_to_video(images, os.path.join(data_dir, "video.mp4"))
+
+    def test_encode_video_trims_the_start_in_a_single_pass(self):
+        # 10 images of 9 frames each is 3.75 seconds of video for 2 seconds of audio
+        images = [Image.new("RGB", (64, 48), (i * 25, 0, 0)) for i in range(10)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            audio_path = os.path.join(data_dir, "audio.wav")
+            video_path = os.path.join(data_dir, "quiz.mp4")
+            write_wav(audio_path, 2.0)
+
+            duration = encode_video(iter(images), 10, audio_path, 2.0, video_path)
+            frames = count_frames(video_path)
+
+        assert duration == 2.0
+        assert len(frames) == 48
+        # The last 48 frames are kept, the first frame shown is the 6th repeat of image 4
+        assert abs(int(frames[0][20, 20, 2]) - 100) < 10
+        assert abs(int(frames[-1][20, 20, 2]) - 225) < 10
+
+    def test_encode_video_holds_the_last_image_when_images_are_missing(self):
+        # 10 images expected but only 8 arrive, the last one is held until the audio ends
+        images = [Image.new("RGB", (64, 48), (i * 25, 0, 0)) for i in range(8)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            audio_path = os.path.join(data_dir, "audio.wav")
+            video_path = os.path.join(data_dir, "quiz.mp4")
+            write_wav(audio_path, 2.0)
+
+            encode_video(iter(images), 10, audio_path, 2.0, video_path)
+            frames = count_frames(video_path)
+
+        assert len(frames) == 48
+        assert abs(int(frames[-1][20, 20, 2]) - 175) < 10
+
+    def test_encode_video_holds_the_previous_image_for_dropped_images(self):
+        # A stream of 10 images where images 6 and 7 were dropped on the way, the trim is the same as without drops
+        images = [Image.new("RGB", (64, 48), (i * 25, 0, 0)) for i in range(10)]
+        images[6] = images[7] = None
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            audio_path = os.path.join(data_dir, "audio.wav")
+            video_path = os.path.join(data_dir, "quiz.mp4")
+            write_wav(audio_path, 2.0)
+
+            encode_video(iter(images), 10, audio_path, 2.0, video_path)
+            frames = count_frames(video_path)
+
+        assert len(frames) == 48
+        assert abs(int(frames[0][20, 20, 2]) - 100) < 10
+        # Image 4 is shown for 3 frames, image 5 for the 27 frames of images 5, 6 and 7, then image 8 follows
+        assert abs(int(frames[3 + 9 * 3 - 1][20, 20, 2]) - 125) < 10
+        assert abs(int(frames[3 + 9 * 3][20, 20, 2]) - 200) < 10
+        assert abs(int(frames[-1][20, 20, 2]) - 225) < 10
+
+    def test_variants_are_encoded_from_the_same_frames(self):
+        # Frames fetched at 630x640 for both views, the rows are numbered in the blue channel
+        rows = np.arange(640, dtype=np.uint8).reshape(640, 1) // 4
+        frames = []
+        for i in range(10):
+            frame = np.zeros((640, 630, 3), dtype=np.uint8)
+            frame[:, :, 0] = rows
+            frame[:, :, 2] = i * 25
+            frames.append(frame)
+        variants = [VideoVariant("desktop", "desktop"), VideoVariant("mobile", "mobile", 108, 192),
+                    VideoVariant("desktop_low", "desktop", crf=35, max_kbps=100)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            audio_path = os.path.join(data_dir, "audio.wav")
+            write_wav(audio_path, 2.0)
+            outputs = [(variant, os.path.join(data_dir, variant.file_name)) for variant in variants]
+
+            duration = encode_variants(iter(frames), 10, audio_path, 2.0, outputs)
+            videos = {variant.name: count_frames(video_path) for variant, video_path in outputs}
+
+        assert duration == 2.0
+        for name, video in videos.items():
+            assert len(video) == 48, name
+            assert abs(int(video[-1][100, 50, 2]) - 225) < 10, name
+        # The desktop view is the middle 400 rows, without the bottom 30
+        assert videos["desktop"][0].shape == (370, 630, 3)
+        assert abs(int(videos["desktop"][0][0, 300, 0]) - 120 // 4) < 4
+        assert videos["mobile"][0].shape == (192, 108, 3)
+        assert videos["desktop_low"][0].shape == (370, 630, 3)
+
+    def test_encode_variants_raises_encoder_errors(self):
+        images = [Image.new("RGB", (64, 48)) for _ in range(10)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            audio_path = os.path.join(data_dir, "audio.wav")
+            write_wav(audio_path, 2.0)
+            # The frames are too small for the desktop view
+            outputs = [(VideoVariant("desktop", "desktop"), os.path.join(data_dir, "quiz.mp4"))]
+
+            with pytest.raises(ValueError):
+                encode_variants(iter(images), 10, audio_path, 2.0, outputs)
+
+    def test_encode_variants_closes_every_encoder_when_one_fails(self):
+        images = [Image.new("RGB", (64, 48)) for _ in range(10)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            audio_path = os.path.join(data_dir, "audio.wav")
+            write_wav(audio_path, 2.0)
+            # The first variant fails on the first frame, the second one is written
+            outputs = [(VideoVariant("desktop", "desktop"), os.path.join(data_dir, "quiz.mp4")),
+                       (VideoVariant("plain"), os.path.join(data_dir, "quiz_plain.mp4"))]
+
+            with pytest.raises(ValueError):
+                encode_variants(iter(images), 10, audio_path, 2.0, outputs)
+
+            assert len(count_frames(os.path.join(data_dir, "quiz_plain.mp4"))) == 48
+
+    def test_build_variants_are_checked(self):
+        assert build_variants(["desktop", "mobile"], ["desktop", "desktop_low"]) == ["desktop", "mobile", "desktop_low"]
+        with pytest.raises(ValueError):
+            build_variants(["desktop", "tablet"])
+        with pytest.raises(ValueError):
+            build_variants(["mobile"])
+
+    def test_package_hls_cuts_short_segments_lowest_bandwidth_first(self):
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 256, (400, 630, 3), dtype=np.uint8) for _ in range(15)]
+        variants = [VideoVariant("desktop", "desktop", crf=20), VideoVariant("desktop_low", "desktop", crf=40)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            audio_path = os.path.join(data_dir, "audio.wav")
+            write_wav(audio_path, 5.0)
+            outputs = [(variant, os.path.join(data_dir, variant.file_name)) for variant in variants]
+            encode_variants(iter(frames), 15, audio_path, 5.0, outputs, keyframe_seconds=2)
+
+            hls_dir = os.path.join(data_dir, "hls")
+            master_path = package_hls({variant.name: video_path for variant, video_path in outputs}, hls_dir)
+            with open(master_path) as f:
+                master = f.read().splitlines()
+            segments = read_hls_playlist(os.path.join(hls_dir, "desktop", "index.m3u8"))
+            low_segments = read_hls_playlist(os.path.join(hls_dir, "desktop_low", "index.m3u8"))
+            segment_files = sorted(os.listdir(os.path.join(hls_dir, "desktop")))
+            leftovers = [name for name in os.listdir(data_dir) if name.endswith(".tmp")]
+
+        assert master[0] == "#EXTM3U"
+        assert [line for line in master if not line.startswith("#")] == ["desktop_low/index.m3u8",
+                                                                          "desktop/index.m3u8"]
+        assert "RESOLUTION=630x370" in master[2]
+        assert len(segments) == 3
+        assert all(duration <= 2.05 for duration, _ in segments)
+        assert abs(sum(duration for duration, _ in segments) - 5.0) < 0.1
+        assert len(low_segments) == 3
+        assert segment_files == ["000.ts", "001.ts", "002.ts", "index.m3u8"]
+        assert leftovers == []
+
+    def test_tween_frames_fills_in_the_skipped_points(self):
+        frames = [np.full((8, 10, 3), value, dtype=np.uint8) for value in (0, 100, 200)]
+
+        tweened, nbr_images = tween_frames(iter(frames), 3, 4)
+        tweened = list(tweened)
+
+        assert nbr_images == 9
+        assert len(tweened) == 9
+        assert [int(frame[0, 0, 0]) for frame in tweened] == [0, 25, 50, 75, 100, 125, 150, 175, 200]
+        untouched, nbr_images = tween_frames(frames, 3, 1)
+        assert untouched is frames and nbr_images == 3
+
+    def test_tween_frames_holds_the_image_before_dropped_images(self):
+        # A stream with a stride of 3 where the first and the third fetched images were dropped
+        frames = [None, np.full((48, 64, 3), 90, dtype=np.uint8), None, np.full((48, 64, 3), 180, dtype=np.uint8)]
+
+        tweened, nbr_images = tween_frames(iter(frames), 4, 3)
+        tweened = list(tweened)
+
+        assert nbr_images == len(tweened) == 10
+        values = [None if frame is None else int(frame[0, 0, 0]) for frame in tweened]
+        assert values[:7] == [None, None, None, 90, None, None, None]
+        # The images after the gap dissolve from the last image that arrived
+        assert abs(values[7] - 120) <= 1 and abs(values[8] - 150) <= 1 and values[9] == 180
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            audio_path = os.path.join(data_dir, "audio.wav")
+            video_path = os.path.join(data_dir, "quiz.mp4")
+            write_wav(audio_path, 4.0)
+
+            encode_video(iter(tweened), nbr_images, audio_path, 4.0, video_path)
+            video = count_frames(video_path)
+
+        # 10 images of 9 frames, the leading gap shows the first image and the dropped one the image before it
+        assert len(video) == 90
+        assert abs(int(video[0][20, 20, 0]) - 90) < 10
+        assert abs(int(video[9 * 6][20, 20, 0]) - 90) < 10
+        assert abs(int(video[-1][20, 20, 0]) - 180) < 10
+
+    def test_zoom_tween_zooms_into_the_center(self):
+        # A frame with a bright border, zooming in pushes the border out of the image
+        frame_a = np.zeros((40, 60, 3), dtype=np.uint8)
+        frame_a[:2, :] = frame_a[-2:, :] = 255
+        frame_b = np.zeros_like(frame_a)
+
+        dissolved = synthesize_frames(frame_a, frame_b, 3, "dissolve")
+        zoomed = synthesize_frames(frame_a, frame_b, 3, "zoom", zoom=0.5)
+
+        assert dissolved.shape == zoomed.shape == (3, 40, 60, 3)
+        assert dissolved[0, 0, 30, 0] > 150
+        assert zoomed[2, 0, 30, 0] == 0
+        # The center is not moved
+        assert zoomed[:, 20, 30, 0].tolist() == [0, 0, 0]
+        with pytest.raises(ValueError):
+            synthesize_frames(frame_a, frame_b, 3, "morph")
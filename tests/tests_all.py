@@ -2,6 +2,15 @@ import unittest
 
 from tests.test_utils import TestUtils
 from tests.test_street_view_collector import StreetViewCollectorTests
+from tests.test_disk_cache import DiskCacheTests
+from tests.test_video_creator import VideoCreatorTests
+from tests.test_jobs import JobRunnerTests
+from tests.test_pipeline import PipelineTests
+from tests.test_geocode_index import GeocodeIndexTests
+from tests.test_audio_creator import AudioCreatorTests
+from tests.test_quiz_bank import QuizBankTests
+from tests.test_quiz_creator import QuizCreatorTests
+from tests.test_server import ServerTests
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -5,6 +5,13 @@ import shutil
 from datetime import datetime, timedelta, time
 import pytz
 import re
+import threading
+import time as time_module
+
+from quiz.video_creator import read_valid_video_manifest
+
+# Video durations keyed on the video path. Each entry is (mtime, size, duration).
+_video_duration_cache = {}
 
 def get_expiration_time():
     """
@@ -31,6 +38,15 @@ def get_expiration_time():
     return expiration_datetime
 
 
+def seconds_until_expiration():
+    """
+    Get the number of seconds until the quiz expires. Used as max-age for everything that belongs to today's quiz.
+    :return: seconds as an int
+    """
+    timezone = pytz.timezone('Europe/Brussels')
+    return max(0, int((get_expiration_time() - datetime.now(timezone)).total_seconds()))
+
+
 def calculate_score(time_taken, video_file_path):
     """
     Calculate the score for the quiz
@@ -40,11 +56,8 @@ def calculate_score(time_taken, video_file_path):
     """
     if time_taken <= 0:
         raise ValueError("time_taken must be a positive number")
-    if not os.path.isfile(video_file_path):
-        raise ValueError("video_file_path is not a valid file path")
 
-    with VideoFileClip(video_file_path) as video:
-        video_duration = video.duration
+    video_duration = get_video_duration(video_file_path)
 
     # Calculate the score as a percentage
     if time_taken > video_duration:
@@ -53,15 +66,31 @@ def calculate_score(time_taken, video_file_path):
         return int(((video_duration - time_taken) / video_duration) * 100)
 
 
-def get_answer(file_path):
+def get_video_duration(video_file_path):
     """
-    Get the answer from the JSON file
-    :param file_path: path to the JSON file
-    :return:
+    Get the duration of a video. The duration is read from the manifest written by the video creator and kept in
+    memory until the video file changes, so the video itself is only opened if there is no valid manifest.
+    :param video_file_path: video file path
+    :return: duration in seconds
     """
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-    return data["city"]
+    if not os.path.isfile(video_file_path):
+        raise ValueError("video_file_path is not a valid file path")
+
+    stat = os.stat(video_file_path)
+    cached = _video_duration_cache.get(video_file_path)
+    if cached is not None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+
+    manifest = read_valid_video_manifest(video_file_path)
+    if manifest is not None:
+        video_duration = manifest["duration"]
+    else:
+        # No manifest (or it belongs to another build), fall back to probing the video
+        with VideoFileClip(video_file_path) as video:
+            video_duration = video.duration
+
+    _video_duration_cache[video_file_path] = (stat.st_mtime, stat.st_size, video_duration)
+    return video_duration
 
 
 def get_explanations(file_path):
@@ -73,6 +102,15 @@ def get_explanations(file_path):
     # Load the JSON data
     with open(file_path) as f:
         quiz_data = json.load(f)
+    return render_explanations(quiz_data)
+
+
+def render_explanations(quiz_data):
+    """
+    Render the clues and explanations of a quiz for the explanations page
+    :param quiz_data: the quiz as loaded from the JSON file
+    :return: list of html snippets
+    """
     explanations = quiz_data.get('explanations', [])
     clues = quiz_data.get('clues', [])
     clues_and_explanations = []
@@ -83,15 +121,18 @@ def get_explanations(file_path):
     return clues_and_explanations
 
 
-def remove_files_and_folders(folder_path):
+def remove_files_and_folders(folder_path, keep=()):
     """
     Remove all files and folders in the specified folder
     :param folder_path: path to the folder
+    :param keep: names of files and folders to leave alone
     :return:
     """
     # Check each item in the folder
     for item in os.listdir(folder_path):
         item_path = os.path.join(folder_path, item)
+        if item in keep:
+            continue
 
         # If the item is a file, remove it
         if os.path.isfile(item_path) and not item_path.endswith('.db'):
@@ -114,3 +155,103 @@ def is_valid_username(username):
 
     # Check if the username matches the pattern
     return bool(pattern.match(username))
+
+
+class TimedCache():
+    """
+    A small in-process cache. Entries expire after ttl seconds, and the whole cache can be invalidated when the
+    underlying data is written. The ttl bounds how stale other worker processes can be.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, compute):
+        """
+        Get a value from the cache, or compute and store it
+        :param key: cache key
+        :param compute: function without arguments that computes the value
+        :return: the value
+        """
+        now = time_module.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self):
+        """
+        Remove all entries
+        :return: void
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class QuizStore():
+    """
+    Keeps the quiz in memory, with the explanations already rendered. The quiz file is only parsed again when its
+    mtime or size changes, or after invalidate() is called when a new quiz is published.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.reloads = 0
+        self._file_path = None
+        self._signature = None
+        self._quiz = None
+        self._lock = threading.Lock()
+
+    def get(self, file_path):
+        """
+        Get the quiz
+        :param file_path: path to the JSON file
+        :return: dict with city, clues, explanations and explanations_html
+        """
+        stat = os.stat(file_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if self._quiz is not None and self._file_path == file_path and self._signature == signature:
+                self.hits += 1
+                return self._quiz
+
+        with open(file_path) as f:
+            quiz_data = json.load(f)
+        quiz = {
+            "city": quiz_data["city"],
+            "clues": quiz_data.get("clues", []),
+            "explanations": quiz_data.get("explanations", []),
+            "explanations_html": render_explanations(quiz_data),
+        }
+        with self._lock:
+            self._file_path = file_path
+            self._signature = signature
+            self._quiz = quiz
+            self.reloads += 1
+        return quiz
+
+    def invalidate(self):
+        """
+        Forget the quiz, it is loaded again on the next get
+        :return: void
+        """
+        with self._lock:
+            self._quiz = None
+
+    def stats(self):
+        """
+        Get the counters
+        :return: dict with the counters
+        """
+        with self._lock:
+            return {"hits": self.hits, "reloads": self.reloads, "file_path": self._file_path}